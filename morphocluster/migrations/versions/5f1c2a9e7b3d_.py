@@ -0,0 +1,26 @@
+"""Add nodes._vector_sum
+
+Revision ID: 5f1c2a9e7b3d
+Revises: 762c3a983d96
+Create Date: 2026-10-16 21:02:11.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5f1c2a9e7b3d"
+down_revision = "762c3a983d96"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing nodes derive the sum from _centroid and _n_objects_deep
+    # until they are consolidated again.
+    op.add_column("nodes", sa.Column("_vector_sum", sa.PickleType(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("nodes", "_vector_sum")
@@ -0,0 +1,32 @@
+"""Add nodes.version and projects.version
+
+Revision ID: a8c3e5f1b7d4
+Revises: f5d1a7b3c8e6
+Create Date: 2026-10-17 09:12:44.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a8c3e5f1b7d4"
+down_revision = "f5d1a7b3c8e6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "nodes",
+        sa.Column("version", sa.BigInteger(), nullable=False, server_default="0"),
+    )
+    op.add_column(
+        "projects",
+        sa.Column("version", sa.BigInteger(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_column("projects", "version")
+    op.drop_column("nodes", "version")
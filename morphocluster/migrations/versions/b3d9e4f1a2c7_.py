@@ -0,0 +1,111 @@
+"""Store centroids and prototypes in a binary format instead of pickles
+
+Revision ID: b3d9e4f1a2c7
+Revises: 5f1c2a9e7b3d
+Create Date: 2026-10-16 22:14:37.120931
+
+"""
+import pickle
+
+from alembic import op
+import sqlalchemy as sa
+from morphocluster.sql.types import (
+    decode_array,
+    decode_prototypes,
+    encode_array,
+    encode_prototypes,
+)
+
+# revision identifiers, used by Alembic.
+revision = "b3d9e4f1a2c7"
+down_revision = "5f1c2a9e7b3d"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def _convert(convert_row):
+    """
+    Convert the cached values of all nodes in batches.
+
+    Nodes whose values can not be converted are invalidated.
+    """
+    connection = op.get_bind()
+
+    result = connection.execution_options(stream_results=True).execute(
+        sa.text(
+            "SELECT node_id, _centroid, _vector_sum, _prototypes FROM nodes"
+            " WHERE _centroid IS NOT NULL"
+            " OR _vector_sum IS NOT NULL"
+            " OR _prototypes IS NOT NULL"
+        )
+    )
+
+    update = sa.text(
+        "UPDATE nodes SET _centroid = :_centroid, _vector_sum = :_vector_sum,"
+        " _prototypes = :_prototypes, cache_valid = cache_valid AND :valid"
+        " WHERE node_id = :node_id"
+    )
+
+    while True:
+        rows = result.fetchmany(BATCH_SIZE)
+
+        if not rows:
+            break
+
+        values = []
+        for row in rows:
+            try:
+                values.append(dict(convert_row(row), node_id=row.node_id, valid=True))
+            except Exception as exc:  # pylint: disable=broad-except
+                print("Invalidating node {}: {}".format(row.node_id, exc))
+                values.append(
+                    dict(
+                        node_id=row.node_id,
+                        _centroid=None,
+                        _vector_sum=None,
+                        _prototypes=None,
+                        valid=False,
+                    )
+                )
+
+        connection.execute(update, values)
+
+
+def _apply(func, value):
+    return None if value is None else func(bytes(value))
+
+
+def upgrade():
+    def convert_row(row):
+        return {
+            "_centroid": _apply(
+                lambda v: encode_array(pickle.loads(v), "float32"), row._centroid
+            ),
+            "_vector_sum": _apply(
+                lambda v: encode_array(pickle.loads(v), "float64"), row._vector_sum
+            ),
+            "_prototypes": _apply(
+                lambda v: encode_prototypes(pickle.loads(v)), row._prototypes
+            ),
+        }
+
+    _convert(convert_row)
+
+
+def downgrade():
+    def convert_row(row):
+        return {
+            "_centroid": _apply(
+                lambda v: pickle.dumps(decode_array(v)[0].copy()), row._centroid
+            ),
+            "_vector_sum": _apply(
+                lambda v: pickle.dumps(decode_array(v)[0].copy()), row._vector_sum
+            ),
+            "_prototypes": _apply(
+                lambda v: pickle.dumps(decode_prototypes(v)), row._prototypes
+            ),
+        }
+
+    _convert(convert_row)
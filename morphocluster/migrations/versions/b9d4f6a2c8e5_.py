@@ -0,0 +1,53 @@
+"""Add nodes.path (materialized path)
+
+Revision ID: b9d4f6a2c8e5
+Revises: a8c3e5f1b7d4
+Create Date: 2026-10-17 11:03:27.904412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "b9d4f6a2c8e5"
+down_revision = "a8c3e5f1b7d4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "nodes", sa.Column("path", postgresql.ARRAY(sa.BigInteger()), nullable=True)
+    )
+
+    # Fill the paths of existing nodes
+    op.execute(
+        """
+        WITH RECURSIVE q AS
+        (
+            SELECT  n.node_id, ARRAY[n.node_id] AS path
+            FROM    nodes AS n
+            WHERE   n.parent_id IS NULL
+            UNION ALL
+            SELECT  c.node_id, q.path || c.node_id
+            FROM    q
+            JOIN    nodes AS c
+            ON      c.parent_id = q.node_id
+        )
+        UPDATE nodes
+        SET path = q.path
+        FROM q
+        WHERE nodes.node_id = q.node_id
+        """
+    )
+
+    op.create_index(
+        "ix_nodes_path", "nodes", ["path"], unique=False, postgresql_using="gin"
+    )
+
+
+def downgrade():
+    op.drop_index("ix_nodes_path", table_name="nodes")
+    op.drop_column("nodes", "path")
@@ -0,0 +1,24 @@
+"""Add projects.n_prototypes
+
+Revision ID: c4e8a1f7d2b9
+Revises: b3d9e4f1a2c7
+Create Date: 2026-10-16 22:41:09.372015
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c4e8a1f7d2b9"
+down_revision = "b3d9e4f1a2c7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("projects", sa.Column("n_prototypes", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("projects", "n_prototypes")
@@ -0,0 +1,24 @@
+"""Add nodes._own_prototypes
+
+Revision ID: d3a7c9e5f2b8
+Revises: b9d4f6a2c8e5
+Create Date: 2026-10-18 09:12:44.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d3a7c9e5f2b8"
+down_revision = "b9d4f6a2c8e5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("nodes", sa.Column("_own_prototypes", sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("nodes", "_own_prototypes")
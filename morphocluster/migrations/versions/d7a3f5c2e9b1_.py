@@ -0,0 +1,35 @@
+"""Add nodes_samples
+
+Revision ID: d7a3f5c2e9b1
+Revises: c4e8a1f7d2b9
+Create Date: 2026-10-16 23:05:52.804113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d7a3f5c2e9b1"
+down_revision = "c4e8a1f7d2b9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The samples are filled lazily by the next consolidation of each node.
+    op.create_table(
+        "nodes_samples",
+        sa.Column("node_id", sa.BigInteger(), nullable=False),
+        sa.Column("object_id", sa.String(), nullable=False),
+        sa.Column("rand", sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(["node_id"], ["nodes.node_id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(
+            ["object_id"], ["objects.object_id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("node_id", "object_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("nodes_samples")
@@ -0,0 +1,25 @@
+"""Add GiST index on objects.vector
+
+Revision ID: e2b6c8d4f0a3
+Revises: d7a3f5c2e9b1
+Create Date: 2026-10-16 23:31:18.647390
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b6c8d4f0a3"
+down_revision = "d7a3f5c2e9b1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_objects_vector", "objects", ["vector"], postgresql_using="gist"
+    )
+
+
+def downgrade():
+    op.drop_index("ix_objects_vector", table_name="objects")
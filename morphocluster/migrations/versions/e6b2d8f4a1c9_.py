@@ -0,0 +1,43 @@
+"""Replace projects.version with nodes_version_seq
+
+Revision ID: e6b2d8f4a1c9
+Revises: d3a7c9e5f2b8
+Create Date: 2026-10-19 10:21:05.733914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e6b2d8f4a1c9"
+down_revision = "d3a7c9e5f2b8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence("nodes_version_seq")))
+
+    # New versions are larger than all existing ones
+    op.execute(
+        "SELECT setval('nodes_version_seq', COALESCE(MAX(version), 0) + 1, false) FROM nodes"
+    )
+
+    op.create_index(
+        "ix_nodes_project_id_version",
+        "nodes",
+        ["project_id", "version"],
+        unique=False,
+    )
+
+    op.drop_column("projects", "version")
+
+
+def downgrade():
+    op.add_column(
+        "projects",
+        sa.Column("version", sa.BigInteger(), nullable=False, server_default="0"),
+    )
+    op.drop_index("ix_nodes_project_id_version", table_name="nodes")
+    op.execute(sa.schema.DropSequence(sa.Sequence("nodes_version_seq")))
@@ -0,0 +1,44 @@
+"""Add objects.vector_array
+
+Revision ID: f5d1a7b3c8e6
+Revises: e2b6c8d4f0a3
+Create Date: 2026-10-16 23:58:40.215376
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from morphocluster.sql.types import VECTOR_DIST_FUNCTION
+
+# revision identifiers, used by Alembic.
+revision = "f5d1a7b3c8e6"
+down_revision = "e2b6c8d4f0a3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "objects",
+        sa.Column("vector_array", postgresql.ARRAY(sa.REAL()), nullable=True),
+    )
+    op.execute(VECTOR_DIST_FUNCTION)
+
+    # Copy existing vectors so that VECTOR_STORAGE can be switched to "array"
+    op.execute(
+        """
+        UPDATE objects
+        SET vector_array = ARRAY(
+            SELECT cube_ll_coord(vector, i)
+            FROM generate_series(1, cube_dim(vector)) AS i
+            ORDER BY i
+        )::real[]
+        WHERE vector IS NOT NULL
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP FUNCTION IF EXISTS vector_dist(real[], real[])")
+    op.drop_column("objects", "vector_array")
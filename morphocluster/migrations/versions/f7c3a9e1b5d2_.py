@@ -0,0 +1,27 @@
+"""Add nodes.objects_version
+
+Revision ID: f7c3a9e1b5d2
+Revises: e6b2d8f4a1c9
+Create Date: 2026-10-19 14:48:12.160337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f7c3a9e1b5d2"
+down_revision = "e6b2d8f4a1c9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "nodes",
+        sa.Column("objects_version", sa.BigInteger(), nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_column("nodes", "objects_version")
@@ -62,12 +62,21 @@ def create_app(test_config=None):
     app.wsgi_app = ReverseProxied(app.wsgi_app, app.config)
 
     # Register extensions
-    from morphocluster.extensions import database, migrate, redis_lru, rq
+    from morphocluster.extensions import (
+        database,
+        invalidation_listener,
+        migrate,
+        page_cache,
+        redis_lru,
+        rq,
+    )
 
     database.init_app(app)
     redis_lru.init_app(app)
+    page_cache.init_app(app)
     migrate.init_app(app, database)
     rq.init_app(app)
+    invalidation_listener.init_app(app)
 
     # Register cli
     from morphocluster import cli
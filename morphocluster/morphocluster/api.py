@@ -3,12 +3,14 @@ Created on 19.03.2018
 
 @author: mschroeder
 """
+import collections
+import hashlib
 import json
 import os
+import threading
 import traceback
 import uuid
 import warnings
-import zlib
 from datetime import datetime
 from distutils.util import strtobool
 from functools import wraps
@@ -30,8 +32,9 @@ from timer_cm import Timer
 
 from morphocluster import background, models
 from morphocluster.classifier import Classifier
-from morphocluster.extensions import database, redis_lru, rq
+from morphocluster.extensions import database, page_cache, rq
 from morphocluster.helpers import keydefaultdict, seq2array
+from morphocluster.processing.rf_rank import rf_rank_incremental
 from morphocluster.schemas import JobSchema, LogSchema
 from morphocluster.tree import Tree
 
@@ -195,23 +198,57 @@ def get_tree_root():
 
 @api.route("/tree/<int:node_id>", methods=["GET"])
 def get_subtree(node_id):
-    flags = {k: request.args.get(k, 0, strtobool) for k in ("supertree",)}  # type: ignore
+    flags = {k: request.args.get(k, 0, strtobool) for k in ("supertree", "stale")}  # type: ignore
 
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
         if flags["supertree"]:
             children = tree.get_children(
-                node_id, supertree=True, include="starred", order_by="_n_children DESC"
+                node_id,
+                supertree=True,
+                include="starred",
+                order_by="_n_children DESC",
+                allow_stale=flags["stale"],
             )
         else:
-            children = tree.get_children(node_id, order_by="_n_children DESC")
+            children = tree.get_children(
+                node_id, order_by="_n_children DESC", allow_stale=flags["stale"]
+            )
 
         result = [_tree_node(c, flags["supertree"]) for c in children]
 
         return jsonify(result)
 
 
+def _etag(*inputs):
+    """
+    Build an ETag from the (versioned) inputs of a response.
+    """
+    return hashlib.sha1(json_dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _not_modified(etag):
+    """
+    Return a "304 Not Modified" response if the client already has the current representation.
+    """
+    if etag is None or etag not in request.if_none_match:
+        return None
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def _set_etag(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+        # Always revalidate
+        response.cache_control.no_cache = True
+
+    return response
+
+
 # ===============================================================================
 # /projects
 # ===============================================================================
@@ -246,11 +283,17 @@ def get_project(project_id):
         tree = Tree(connection)
         result = tree.get_project(project_id)
 
+        # result contains the version of the project
+        etag = _etag(result, arguments["include_progress"])
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+
         if arguments["include_progress"]:
             progress = tree.calculate_progress(result["node_id"])
             result["progress"] = progress
 
-        return jsonify(result)
+        return _set_etag(jsonify(result), etag)
 
 
 @api.route("/projects/<int:project_id>/unfilled_nodes", methods=["GET"])
@@ -349,38 +392,58 @@ def create_node():
         return jsonify(result)
 
 
-def _node(tree, node, include_children=False):
+def _node(tree, node, include_children=False, allow_stale=False, path=None):
+    """
+    Serialize a node.
+
+    Parameters:
+        path: Path of the node, if already known (see Tree.get_paths).
+    """
     if node["name"] is None:
         node["name"] = node["node_id"]
 
+    if path is None:
+        path = tree.get_path_ids(node["node_id"])
+
     result = {
         "node_id": node["node_id"],
         "id": node["node_id"],
-        "path": tree.get_path_ids(node["node_id"]),
+        "path": path,
         "text": "{} ({})".format(node["name"], node["_n_children"]),
         "name": node["name"],
         "children": node["_n_children"] > 0,
         "n_children": node["_n_children"],
         "icon": _node_icon(node),
-        "type_objects": node["_type_objects"],
+        # Nodes that have never been consolidated have no values yet (stale reads)
+        "type_objects": node["_type_objects"] or [],
         "starred": node["starred"],
         "approved": node["approved"],
-        "own_type_objects": node["_own_type_objects"],
+        "own_type_objects": node["_own_type_objects"] or [],
         "n_objects_deep": node["_n_objects_deep"] or 0,
         "n_objects": node["_n_objects"] or 0,
         "parent_id": node["parent_id"],
         "project_id": node["project_id"],
         "filled": node["filled"],
+        "stale": node.get("stale", False),
+        "version": node["version"],
     }
 
     if include_children:
-        result["children"] = [
-            _node(tree, c) for c in tree.get_children(node["node_id"])
-        ]
+        result["children"] = _nodes(
+            tree, tree.get_children(node["node_id"], allow_stale=allow_stale)
+        )
 
     return result
 
 
+def _nodes(tree, nodes):
+    """
+    Serialize multiple nodes, resolving their paths in a single query.
+    """
+    paths = tree.get_paths([n["node_id"] for n in nodes])
+    return [_node(tree, n, path=paths[n["node_id"]]) for n in nodes]
+
+
 def _object(object_):
     return {"object_id": object_["object_id"]}
 
@@ -430,70 +493,86 @@ def _arrange_by_nleaves(result):
 
 
 def _members(tree, members):
-    return [_node(tree, m) if "node_id" in m else _object(m) for m in members]
+    paths = tree.get_paths([m["node_id"] for m in members if "node_id" in m])
+    return [
+        _node(tree, m, path=paths[m["node_id"]]) if "node_id" in m else _object(m)
+        for m in members
+    ]
 
 
-def _load_or_calc(func, func_kwargs, request_id, page, page_size=100, compress=True):
+def _load_or_calc(
+    func, func_kwargs, request_id, page, page_size=100, version=None, ttl=None
+):
     print("Load or calc {}...".format(func.__name__))
 
     # If a request_id is given, load the result from the cache
     if request_id is not None:
         cache_key = "{}:{}".format(func.__name__, request_id)
-        try:
-            print("Loading cache key {}...".format(cache_key))
-            page_result = redis_lru.lindex(cache_key, page)
+        cached = page_cache.get_page(cache_key, page)
 
-            if page_result is None:
-                raise ValueError("Unknown cache_key: {}".format(cache_key))
+        if cached is None:
+            raise ValueError("Unknown cache_key: {}".format(cache_key))
 
-            n_pages = redis_lru.llen(cache_key)
+        page_result, n_pages = cached
 
-            if compress:
-                page_result = zlib.decompress(page_result).decode()
+        return page_result, n_pages, request_id
 
-            # print("Returning page {} from cached result".format(page))
+    # If the inputs of func can be identified by a version,
+    # the result is stored under a deterministic request_id and shared between requests.
+    if version is not None:
+        func_version = version(**func_kwargs)
 
-            return page_result, n_pages, request_id
+        if func_version is not None:
+            request_id = _versioned_request_id(func.__name__, func_kwargs, func_version)
+            cache_key = "{}:{}".format(func.__name__, request_id)
+            cached = page_cache.get_page(cache_key, page)
 
-        except RedisError as exc:
-            raise ValueError(
-                "Could not retrieve cache_key: {}".format(cache_key)
-            ) from exc
+            if cached is not None:
+                page_result, n_pages = cached
+                return page_result, n_pages, request_id
 
     # Otherwise calculate a result
-    request_id = uuid.uuid4().hex
-    cache_key = "{}:{}".format(func.__name__, request_id)
-
-    # Calculate result
     result = func(**func_kwargs)
 
-    # Paginate full_result
-    pages = batch(result, page_size)
+    pages, n_pages, request_id = _cache_pages(
+        func.__name__, result, page_size, request_id, ttl
+    )
 
-    # Serialize individual pages
-    pages = [json_dumps(p) for p in pages]
+    if 0 <= page < n_pages:
+        return pages[page], n_pages, request_id
 
-    n_pages = len(pages)
+    return "[]", n_pages, request_id
 
-    if n_pages:
-        if compress:
-            # raw_length = sum(len(p) for p in pages)
-            cache_pages = [zlib.compress(p.encode()) for p in pages]
-            # compressed_length = sum(len(p) for p in pages)
 
-            # print("Compressed pages. Ratio: {:.2%}".format(compressed_length / raw_length))
-        else:
-            cache_pages = pages
+def _versioned_request_id(name, func_kwargs, func_version):
+    key = json_dumps([name, func_kwargs, func_version], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:32]
 
-        try:
-            redis_lru.rpush(cache_key, *cache_pages)
-        except RedisError as e:
-            warnings.warn("RedisError: {}".format(e))
 
-    if 0 <= page < n_pages:
-        return pages[page], n_pages, request_id
+def _cache_pages(name, result, page_size=100, request_id=None, ttl=None):
+    """
+    Paginate and serialize a result and store the pages in the cache.
 
-    return "[]", n_pages, request_id
+    Parameters:
+        request_id: Identification of the result. (Default: A new random id.)
+        ttl: Expiry of the cached result (see PageCache.set).
+
+    Returns:
+        (pages, n_pages, request_id)
+    """
+    if request_id is None:
+        request_id = uuid.uuid4().hex
+    cache_key = "{}:{}".format(name, request_id)
+
+    # Paginate full_result
+    pages = batch(result, page_size)
+
+    # Serialize individual pages
+    pages = [json_dumps(p) for p in pages]
+
+    page_cache.set(cache_key, pages, ttl)
+
+    return pages, len(pages), request_id
 
 
 def cache_serialize_page(endpoint, **kwargs):
@@ -501,6 +580,14 @@ def cache_serialize_page(endpoint, **kwargs):
     `func` is expected to return a json-serializable list.
     It gains the `page` and `request_id` parameter. The resulting list is split into batches of `page_size` items.
 
+    Parameters:
+        page_size: Number of items per page.
+        version: Optional function version(**func_kwargs) -> str or None
+            identifying the state of the inputs of func.
+            If it returns a value, the result is shared between requests
+            with the same arguments until the version changes.
+        ttl: Expiry of the cached result (seconds).
+
     Decorated Function:
         func: func(**kwargs) -> list
 
@@ -577,7 +664,10 @@ def cache_serialize_page(endpoint, **kwargs):
 
             response.headers["Link"] = ",".join(link_header_fields)
 
-            return response
+            # A cached result never changes, so the page can be identified by its request_id
+            _set_etag(response, _etag(request_id, page))
+
+            return response.make_conditional(request)
 
         return wrapper
 
@@ -620,7 +710,16 @@ def _arrange_by_starred_sim(result, starred):
         raise
 
 
-@cache_serialize_page(".get_node_members")
+def _node_members_version(node_id, arrange_by="", **_):
+    # A random arrangement is not shared
+    if arrange_by == "random":
+        return None
+
+    with database.engine.connect() as connection:
+        return Tree(connection).get_members_version(node_id)
+
+
+@cache_serialize_page(".get_node_members", version=_node_members_version)
 def _get_node_members(
     node_id,
     nodes=False,
@@ -754,6 +853,16 @@ def get_node_stats(node_id):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
+        etag = None
+        if arguments["log"] is None:
+            # The progress depends on the whole subtree
+            version = tree.get_subtree_version(node_id)
+            if version is not None:
+                etag = _etag("progress", node_id, version)
+                not_modified = _not_modified(etag)
+                if not_modified is not None:
+                    return not_modified
+
         with connection.begin():
             progress = tree.calculate_progress(node_id)
 
@@ -765,7 +874,7 @@ def get_node_stats(node_id):
                     data=json_dumps(progress),
                 )
 
-            return jsonify(progress)
+            return _set_etag(jsonify(progress), etag)
 
 
 @api.route("/nodes/<int:node_id>/members", methods=["POST"])
@@ -791,14 +900,29 @@ def get_node(node_id):
         tree = Tree(connection)
 
         flags = {k: request.args.get(k, 0, strtobool) for k in ("include_children",)}
-
-        node = tree.get_node(node_id)
+        allow_stale = request.args.get(
+            "stale", app.config.get("NODE_READ_STALE", False), strtobool
+        )
 
         log(connection, "get_node", node_id=node_id)
 
-        result = _node(tree, node, **flags)
+        # The path (and the children) are part of the response
+        # but not covered by the version of the node
+        version = tree.get_node_version(node_id)
+        if version is not None and flags["include_children"]:
+            version = tree.get_members_version(node_id)
+        etag = None
+        if version is not None:
+            etag = _etag(node_id, version, tree.get_path_ids(node_id), flags)
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
 
-        return jsonify(result)
+        node = tree.get_node(node_id, allow_stale=allow_stale)
+
+        result = _node(tree, node, allow_stale=allow_stale, **flags)
+
+        return _set_etag(jsonify(result), etag)
 
 
 @api.route("/nodes/<int:node_id>", methods=["PATCH"])
@@ -829,6 +953,17 @@ def patch_node(node_id):
 
             node = tree.get_node(node_id, True)
 
+        # Annotators usually grow a node right after approving it
+        if (
+            app.config.get("PRECOMPUTE_RECOMMENDATIONS", False)
+            and "approved" in data
+            and strtobool(str(data["approved"]))
+        ):
+            try:
+                background.precompute_recommended_objects.queue(node_id)
+            except RedisError as exc:
+                warnings.warn("Could not schedule precomputation: {}".format(exc))
+
         result = _node(tree, node, **flags)
 
         return jsonify(result)
@@ -869,6 +1004,137 @@ def node_adopt_members(parent_id):
         return jsonify({})
 
 
+# Forests of re-ranked recommendations of this worker process (request_id -> forest).
+# They are not serialized: A call that reaches another worker starts a new forest
+# (the training data is collected anew with every call).
+_RERANK_MODELS_SIZE = 32
+_rerank_models = collections.OrderedDict()
+_rerank_models_lock = threading.Lock()
+
+
+def _get_rerank_model(request_id):
+    with _rerank_models_lock:
+        return _rerank_models.pop(request_id, None)
+
+
+def _set_rerank_model(request_id, model):
+    with _rerank_models_lock:
+        _rerank_models[request_id] = model
+        while len(_rerank_models) > _RERANK_MODELS_SIZE:
+            _rerank_models.popitem(last=False)
+
+
+@api.route("/nodes/<int:node_id>/rerank_recommended_objects", methods=["POST"])
+def rerank_recommended_objects(node_id):
+    """
+    Re-order the remaining pages of recommendations using the feedback on the reviewed pages.
+
+    A random forest (see processing.rf_rank.rf_rank_incremental) is trained on
+    the accepted and rejected objects and ranks the objects after last_page.
+    The re-ordered result is stored under a new request_id
+    (as the original result may be shared with other requests).
+    The forest is kept with the new result (in the memory of the worker process)
+    and grows with every call.
+
+    URL parameters:
+        node_id (int): ID of the node that receives recommendations
+
+    Request parameters:
+        request_id: ID of the recommendations.
+        rejected_members: Rejected members on the pages up to last_page.
+        last_page: Last reviewed page. All members on these pages that were not rejected are accepted.
+
+    Returns:
+        n_reranked: Number of re-ordered objects.
+        request_id: ID of the re-ordered recommendations.
+    """
+
+    parameters = request.get_json()
+
+    request_id = parameters["request_id"]
+    last_page = int(parameters["last_page"])
+    cache_key = "{}:{}".format(_node_get_recommended_objects.__name__, request_id)
+
+    max_samples = app.config.get("RERANK_MAX_SAMPLES", 1000)
+
+    with Timer("rerank_recommended_objects") as t:
+        with t.child("load pages"):
+            pages = page_cache.get(cache_key)
+
+            if pages is None:
+                raise ValueError("Unknown cache_key: {}".format(cache_key))
+
+            pages = [json.loads(p) for p in pages]
+
+            reviewed = [o["object_id"] for p in pages[: last_page + 1] for o in p]
+            remaining = [o for p in pages[last_page + 1 :] for o in p]
+
+        rejected_object_ids = set(
+            m[1:] for m in parameters["rejected_members"] if m.startswith("o")
+        )
+        accepted_object_ids = [o for o in reviewed if o not in rejected_object_ids]
+
+        if not remaining:
+            return jsonify({"n_reranked": 0, "request_id": request_id})
+
+        with database.engine.connect() as connection:
+            tree = Tree(connection)
+
+            with t.child("load vectors"):
+                # Complement the feedback with current and previously rejected members
+                member_vectors = [
+                    o["vector"] for o in tree.get_objects(node_id, limit=max_samples)
+                ]
+                rejected_object_ids = list(rejected_object_ids) + [
+                    o
+                    for o in tree.get_rejected_object_ids(node_id, limit=max_samples)
+                    if o not in rejected_object_ids
+                ]
+
+                vectors = tree.get_vectors(
+                    accepted_object_ids
+                    + rejected_object_ids
+                    + [o["object_id"] for o in remaining]
+                )
+
+        n_accepted, n_rejected = len(accepted_object_ids), len(rejected_object_ids)
+        valid = [
+            v for v in vectors[:n_accepted] + member_vectors if v is not None
+        ]
+        rejected = [
+            v for v in vectors[n_accepted : n_accepted + n_rejected] if v is not None
+        ]
+        candidates = vectors[n_accepted + n_rejected :]
+
+        # Without examples of both classes, there is nothing to learn
+        if not valid or not rejected:
+            return jsonify({"n_reranked": 0, "request_id": request_id})
+
+        with t.child("rank"):
+            order, model = rf_rank_incremental(
+                seq2array(candidates, len(candidates)),
+                np.stack(valid),
+                np.stack(rejected),
+                classifier=_get_rerank_model(request_id),
+                max_samples=max_samples,
+                max_depth=8,
+            )
+
+        with t.child("store pages"):
+            remaining = [remaining[i] for i in order]
+            page_size = len(pages[0])
+
+            _, _, request_id = _cache_pages(
+                _node_get_recommended_objects.__name__,
+                [o for p in pages[: last_page + 1] for o in p] + remaining,
+                page_size,
+            )
+
+            _set_rerank_model(request_id, model)
+
+    return jsonify({"n_reranked": len(remaining), "request_id": request_id})
+
+
 @api.route("/nodes/<int:node_id>/accept_recommended_objects", methods=["POST"])
 def accept_recommended_objects(node_id):
     """
@@ -953,7 +1219,11 @@ def accept_recommended_objects(node_id):
         with database.engine.connect() as connection:
             tree = Tree(connection)
             with t.child("save accepted/rejected to database"), connection.begin():
-                tree.relocate_objects(object_ids, node_id)
+                # Recommendations are drawn from the ancestors. Objects that were
+                # moved elsewhere in the meantime are not taken back.
+                tree.relocate_objects(
+                    object_ids, node_id, src_node_ids=tree.get_path_ids(node_id)[:-1]
+                )
                 tree.reject_objects(node_id, rejected_object_ids)
 
             log(
@@ -976,7 +1246,7 @@ def accept_recommended_objects(node_id):
 def _node_get_recommended_children(node_id, max_n):
     with database.engine.connect() as connection:
         tree = Tree(connection)
-        result = [_node(tree, c) for c in tree.recommend_children(node_id, max_n=max_n)]
+        result = _nodes(tree, tree.recommend_children(node_id, max_n=max_n))
         return result
 
 
@@ -1004,7 +1274,19 @@ def node_get_recommended_children(node_id):
     return _node_get_recommended_children(node_id=node_id, **arguments)
 
 
-@cache_serialize_page(".node_get_recommended_objects", page_size=50)
+RECOMMENDED_OBJECTS_PAGE_SIZE = 50
+
+
+def _recommended_objects_version(node_id=None, max_n=None):
+    with database.engine.connect() as connection:
+        return Tree(connection).get_recommendation_version(node_id)
+
+
+@cache_serialize_page(
+    ".node_get_recommended_objects",
+    page_size=RECOMMENDED_OBJECTS_PAGE_SIZE,
+    version=_recommended_objects_version,
+)
 def _node_get_recommended_objects(node_id=None, max_n=None):
     with database.engine.connect() as connection:
         tree = Tree(connection)
@@ -1039,6 +1321,37 @@ def node_get_recommended_objects(node_id):
     return _node_get_recommended_objects(node_id=node_id, **arguments)
 
 
+def precompute_recommended_objects(node_id, max_n=1000):
+    """
+    Calculate the recommended objects for a node and store them in the page cache.
+
+    The first request for recommendations is then served from the cache
+    until the recommendation inputs of the node (see Tree.get_recommendation_version) change.
+
+    Returns:
+        request_id of the cached result.
+    """
+
+    _, _, request_id = _load_or_calc(
+        _node_get_recommended_objects.__wrapped__,
+        dict(node_id=node_id, max_n=max_n),
+        None,
+        0,
+        page_size=RECOMMENDED_OBJECTS_PAGE_SIZE,
+        version=_recommended_objects_version,
+    )
+
+    return request_id
+
+
+@api.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    """
+    Hit and miss counters of the page cache (of the worker process that handles the request).
+    """
+    return jsonify(dict(page_cache.get_stats(), pid=os.getpid()))
+
+
 @api.route("/nodes/<int:node_id>/tip", methods=["GET"])
 def node_get_tip(node_id):
     with database.engine.connect() as connection:
@@ -1058,20 +1371,7 @@ def node_get_next(node_id):
     with database.engine.connect() as connection:
         tree = Tree(connection)
 
-        # Descend if the successor is not approved
-        # Rationale: Approval is for a whole subtree.
-        def recurse(_, s):
-            return s.c.approved == False
-
-        # Filter descendants that are not approved
-        def filter(subtree):
-            return subtree.c.approved == False
-
-        return jsonify(
-            tree.get_next_node(
-                node_id, leaf=arguments["leaf"], recurse_cb=recurse, filter=filter
-            )
-        )
+        return jsonify(tree.get_next_unapproved(node_id, leaf=arguments["leaf"]))
 
 
 @api.route("/nodes/<int:node_id>/next_unfilled", methods=["GET"])
@@ -1,9 +1,16 @@
+import concurrent.futures
+import threading
+
 import flask_rq2
+import sqlalchemy
+from sqlalchemy.pool import NullPool
 
 from morphocluster.extensions import database, rq
 from morphocluster.tree import Tree
 import os
+import warnings
 import datetime as dt
+from redis.exceptions import RedisError
 from morphocluster.processing.recluster import Recluster
 from flask import current_app as app
 
@@ -17,6 +24,111 @@ def add(x, y):
     return x + y
 
 
+def _consolidation_pending_key(project_id):
+    return "morphocluster:consolidation-pending:{}".format(project_id)
+
+
+def schedule_consolidation(project_id):
+    """
+    Queue consolidate_project unless a consolidation of the project is already queued.
+
+    This coalesces the invalidations of many requests into one job.
+    """
+    try:
+        # The key expires in case the job gets lost
+        if rq.connection.set(
+            _consolidation_pending_key(project_id), 1, nx=True, ex=3600
+        ):
+            consolidate_project.queue(project_id)
+    except RedisError as exc:
+        warnings.warn("Could not schedule consolidation: {}".format(exc))
+
+
+@rq.job(timeout=3600)
+def consolidate_project(project_id):
+    """
+    Consolidate all invalid nodes of a project.
+    """
+
+    # Invalidations from now on schedule a new job
+    rq.connection.delete(_consolidation_pending_key(project_id))
+
+    with database.engine.connect() as conn:
+        return Tree(conn).consolidate_invalid(project_id)
+
+
+_revalidation = {"pid": None, "executor": None, "engine": None, "pending": set()}
+_revalidation_lock = threading.Lock()
+
+
+def revalidate_nodes(node_ids):
+    """
+    Consolidate nodes in a thread of the current process
+    (used for stale reads if CONSOLIDATE_IN_BACKGROUND is not set).
+
+    Nodes that are already pending are skipped, so that repeated reads
+    of a stale node queue only one consolidation.
+    """
+
+    pid = os.getpid()
+
+    with _revalidation_lock:
+        if _revalidation["pid"] != pid:
+            # Threads and connections do not survive a fork
+            _revalidation.update(
+                pid=pid,
+                executor=concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="revalidate"
+                ),
+                # The app engine uses a single connection (StaticPool)
+                # that must not be shared with the request thread
+                engine=sqlalchemy.create_engine(database.engine.url, poolclass=NullPool),
+                pending=set(),
+            )
+
+        node_ids = [n for n in node_ids if n not in _revalidation["pending"]]
+        _revalidation["pending"].update(node_ids)
+
+        if not node_ids:
+            return
+
+        _revalidation["executor"].submit(
+            _revalidate_nodes,
+            app._get_current_object(),  # pylint: disable=protected-access
+            _revalidation["engine"],
+            node_ids,
+        )
+
+
+def _revalidate_nodes(app_, engine, node_ids):
+    try:
+        with app_.app_context(), engine.connect() as conn:
+            tree = Tree(conn)
+            for node_id in node_ids:
+                tree.consolidate_node(node_id)
+
+                # Stale reads during consolidation must not queue the node again
+                with _revalidation_lock:
+                    _revalidation["pending"].discard(node_id)
+    except Exception:  # pylint: disable=broad-except
+        app_.logger.exception("Could not revalidate nodes %r", node_ids)
+    finally:
+        with _revalidation_lock:
+            _revalidation["pending"].difference_update(node_ids)
+
+
+@rq.job
+def precompute_recommended_objects(node_id, max_n=1000):
+    """
+    Calculate the recommended objects of a node ahead of the first request.
+    """
+
+    # Imported here to avoid a circular import
+    from morphocluster.api import precompute_recommended_objects as _precompute
+
+    return _precompute(node_id, max_n)
+
+
 @rq.job
 def export_project(project_id):
     config = app.config
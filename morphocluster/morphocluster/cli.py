@@ -1,6 +1,7 @@
 import itertools
 import os
 import time
+import uuid
 import zipfile
 from typing import Dict, List, Optional
 from xmlrpc.client import Boolean
@@ -21,7 +22,11 @@ from werkzeug.security import generate_password_hash
 
 from morphocluster import models, processing
 from morphocluster.extensions import database
-from morphocluster.tree import Tree
+from morphocluster.processing.ann import IVFIndex
+from morphocluster.processing.distance import top_k_min_distances
+from morphocluster.processing.prototypes import Prototypes
+from morphocluster.sql.bulk import bulk_update
+from morphocluster.tree import Tree, _rquery_subtree, _vector_column
 
 
 def _add_user(username, password):
@@ -34,6 +39,142 @@ def _add_user(username, password):
         conn.execute(stmt)
 
 
+def _benchmark_recommend_synthetic_sql(vectors, prototypes, max_n, reference):
+    """
+    Time the "sql" backend of recommend_objects on synthetic vectors.
+
+    The vectors are loaded into a temporary project
+    in a transaction that is rolled back afterwards.
+    """
+    n_objects, n_features = vectors.shape
+
+    if _vector_column() is not models.objects.c.vector or n_features > 100:
+        print("  sql: skipped (requires CUBE vectors with at most 100 features)")
+        return
+
+    # Unique object_ids, as objects are shared between projects
+    prefix = "benchmark-recommend-{}-".format(uuid.uuid4().hex)
+
+    with database.engine.connect() as conn:
+        tree = Tree(conn)
+
+        txn = conn.begin()
+        try:
+            project_id = tree.create_project("benchmark-recommend")
+            root_id = tree.create_node(project_id)
+            node_id = tree.create_node(project_id, parent_id=root_id)
+
+            print(f"Loading {n_objects:,d} vectors into a temporary project...")
+            progress = tqdm.tqdm(total=n_objects, unit_scale=True)
+            for start in range(0, n_objects, 10000):
+                chunk = range(start, min(start + 10000, n_objects))
+                conn.execute(
+                    models.objects.insert(),  # pylint: disable=no-value-for-parameter
+                    [
+                        {"object_id": f"{prefix}{i}", "path": "", "vector": vectors[i]}
+                        for i in chunk
+                    ],
+                )
+                conn.execute(
+                    models.nodes_objects.insert(),
+                    [
+                        {
+                            "node_id": root_id,
+                            "project_id": project_id,
+                            "object_id": f"{prefix}{i}",
+                        }
+                        for i in chunk
+                    ],
+                )
+                progress.update(len(chunk))
+            progress.close()
+
+            # The node has no objects of its own, so its prototypes are set directly
+            prots = Prototypes(None)
+            prots.prototypes_ = prototypes
+            prots.support_ = np.ones(len(prototypes), dtype=int)
+            conn.execute(
+                models.nodes.update()
+                .where(models.nodes.c.node_id == node_id)
+                .values(_prototypes=prots, cache_valid=True)
+            )
+
+            conn.execute("ANALYZE objects")
+            conn.execute("ANALYZE nodes_objects")
+
+            start = time.perf_counter()
+            result = tree.recommend_objects(node_id, max_n, backend="sql")
+            duration = time.perf_counter() - start
+
+            result = set(o["object_id"][len(prefix) :] for o in result)
+            recall = len(result & reference) / len(reference) if reference else 1.0
+
+            print(
+                f"  sql: {duration:8.3f}s, {len(result):,d} objects, recall {recall:.2%}"
+            )
+        finally:
+            txn.rollback()
+
+
+def _benchmark_recommend_synthetic(
+    n_objects,
+    n_features,
+    n_prototypes,
+    max_n,
+    max_cells,
+    random_state=None,
+    sql=True,
+):
+    """
+    Compare the distance kernels on n_objects random vectors.
+
+    The exact results of top_k_min_distances are the reference
+    for the "sql" backend (if sql is True) and the approximate nearest neighbour index.
+    """
+    rng = np.random.default_rng(random_state)
+
+    print(f"Generating {n_objects:,d} vectors with {n_features:d} features...")
+    vectors = rng.standard_normal((n_objects, n_features), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    object_ids = np.arange(n_objects).astype(str)
+
+    # Prototypes close to random objects, like the prototypes of a real node
+    prototypes = vectors[rng.choice(n_objects, n_prototypes, replace=False)]
+    prototypes = prototypes + 0.05 * rng.standard_normal(
+        prototypes.shape, dtype=np.float32
+    )
+
+    start = time.perf_counter()
+    indices, _ = top_k_min_distances(vectors, prototypes, max_n, normalized=True)
+    duration = time.perf_counter() - start
+    reference = set(object_ids[indices])
+
+    print(f" blas: {duration:8.3f}s, {len(indices):,d} objects, recall 100.00%")
+
+    if sql:
+        _benchmark_recommend_synthetic_sql(vectors, prototypes, max_n, reference)
+
+    start = time.perf_counter()
+    index = IVFIndex.build(object_ids, vectors, random_state=random_state)
+    duration = time.perf_counter() - start
+
+    print(f"  ann: {duration:8.3f}s to build {index.n_lists:,d} cells")
+
+    start = time.perf_counter()
+    candidate_ids, candidate_distances = [], []
+    for ids, distances in index.iter_candidates(prototypes, max_cells=max_cells):
+        candidate_ids.append(ids)
+        candidate_distances.append(distances)
+    candidate_ids = np.concatenate(candidate_ids)
+    candidate_distances = np.concatenate(candidate_distances)
+    result = candidate_ids[np.argsort(candidate_distances, kind="stable")[:max_n]]
+    duration = time.perf_counter() - start
+
+    recall = len(set(result) & reference) / len(reference) if reference else 1.0
+
+    print(f"  ann: {duration:8.3f}s, {len(result):,d} objects, recall {recall:.2%}")
+
+
 def init_app(app):
     # pylint: disable=unused-variable
 
@@ -262,9 +403,13 @@ def init_app(app):
             print("Explained variance ratio:", pca_transformer.explained_variance_ratio_.sum())
             del pca_transformer
 
-        if vectors.shape[1] > 100:
+        vector_column = (
+            "vector_array" if app.config["VECTOR_STORAGE"] == "array" else "vector"
+        )
+
+        if vector_column == "vector" and vectors.shape[1] > 100:
             raise ValueError(
-                "The features can not have more than 100 dimensions. Try --truncate or --pca."
+                "The features can not have more than 100 dimensions. Try --truncate or --pca or set VECTOR_STORAGE=array."
             )
 
         print("Moving feature vectors to the database...")
@@ -273,39 +418,30 @@ def init_app(app):
 
             if clear:
                 print("Clearing previous features...")
-                stmt = models.objects.update().values({"vector": None})
+                stmt = models.objects.update().values({vector_column: None})
                 conn.execute(stmt)
 
-            stmt = (
-                models.objects.update()
-                .where(models.objects.c.object_id == bindparam("_object_id"))
-                .values({"vector": bindparam("vector")})
+            n_updated = bulk_update(
+                conn,
+                models.objects,
+                "object_id",
+                (
+                    {"object_id": str(object_id), vector_column: vector}
+                    for (object_id, vector) in tqdm.tqdm(
+                        zip(object_ids, vectors),  # type: ignore
+                        total=len(object_ids),
+                        unit="obj",
+                        unit_scale=True,
+                    )
+                ),
             )
-
-            # TODO: Use UPDATE ... RETURNING to get the number of affected rows
-
-            progress = tqdm.tqdm(total=len(object_ids), unit="obj", unit_scale=True)
-            obj_iter = iter(zip(object_ids, vectors))  # type: ignore
-            while True:
-                chunk = tuple(itertools.islice(obj_iter, 1000))
-                if not chunk:
-                    break
-                conn.execute(
-                    stmt,
-                    [
-                        {"_object_id": str(object_id), "vector": vector}
-                        for (object_id, vector) in chunk
-                    ],
-                )
-
-                progress.update(len(chunk))
-            progress.close()
+            print(f"Updated {n_updated:,d} objects.")
 
             # TODO: In the end, print a summary of how many objects have a feature vector now.
             stmt = (
                 select([func.count()])
                 .select_from(models.objects)
-                .where(models.objects.c.vector.isnot(None))
+                .where(models.objects.c[vector_column].isnot(None))
             )
             n_initialized = conn.execute(stmt).scalar()
 
@@ -316,7 +452,25 @@ def init_app(app):
                 f"{n_initialized:,d} out of {n_total:,d} objects ({n_initialized/n_initialized:.2%}) now have a feature vector."
             )
 
-            print("Done.")
+        _build_vector_store()
+
+        print("Done.")
+
+    def _build_vector_store():
+        if app.config.get("VECTOR_STORE_DIR") is None:
+            return
+
+        print("Writing vector store...")
+        with database.engine.connect() as conn:
+            n_vectors = Tree(conn).build_vector_store()
+        print(f"Stored {n_vectors:,d} vectors in {app.config['VECTOR_STORE_DIR']}.")
+
+    @app.cli.command()
+    def build_vector_store():
+        """
+        (Re)build the memory-mapped vector store from the database.
+        """
+        _build_vector_store()
 
     @app.cli.command()
     @click.argument("tree_fn")
@@ -445,7 +599,13 @@ def init_app(app):
 
     @app.cli.command()
     @click.argument("root_id", default="visible", callback=validate_consolidate_root_id)
-    def consolidate(root_id):
+    @click.option(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes for the calculation of each tree level.",
+    )
+    def consolidate(root_id, workers):
         with database.engine.connect() as conn, Timer("Consolidate") as timer:
             tree = Tree(conn)
 
@@ -462,9 +622,155 @@ def init_app(app):
             for rid in root_ids:
                 with timer.child(str(rid)):
                     print("Consolidating {}...".format(rid))
-                    tree.consolidate_node(rid)
+                    tree.consolidate_node(rid, workers=workers)
             print("Done.")
 
+    @app.cli.command()
+    @click.argument("project_id", type=int)
+    @click.option("--n-lists", type=int, help="Number of cells (default: sqrt(N)).")
+    def build_ann_index(project_id: int, n_lists: Optional[int]):
+        """
+        Build the approximate nearest neighbour index of a project.
+
+        Set RECOMMEND_BACKEND="ann" to use it for recommendations.
+        """
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            index = tree.build_ann_index(project_id, n_lists)
+
+            print(
+                f"Indexed {index.vectors.shape[0]:,d} objects in {index.n_lists:,d} cells."
+            )
+
+    @app.cli.command()
+    @click.argument("node_id", type=int, required=False)
+    @click.option("--max-n", type=int, default=1000)
+    @click.option(
+        "--backend",
+        "backends",
+        multiple=True,
+        default=("sql", "knn", "ann", "blas"),
+        help="Backend to benchmark (can be given multiple times).",
+    )
+    @click.option(
+        "--synthetic",
+        "n_objects",
+        type=int,
+        help="Benchmark on this many random vectors instead of a node.",
+    )
+    @click.option("--n-features", type=int, default=32)
+    @click.option("--n-prototypes", type=int, default=16)
+    @click.option("--seed", type=int)
+    def benchmark_recommend(
+        node_id: Optional[int],
+        max_n: int,
+        backends,
+        n_objects: Optional[int],
+        n_features: int,
+        n_prototypes: int,
+        seed: Optional[int],
+    ):
+        """
+        Compare the runtime and results of the recommend_objects backends for a node.
+
+        The results of each backend are compared to the exact "sql" backend.
+
+        With --synthetic N, the exact in-process distance kernel ("blas"),
+        the "sql" backend and the approximate nearest neighbour index ("ann")
+        are compared on N random vectors, e.g. --synthetic 1000000.
+        For "sql", the vectors are loaded into a temporary project
+        that is rolled back afterwards.
+        """
+        if n_objects is not None:
+            _benchmark_recommend_synthetic(
+                n_objects,
+                n_features,
+                n_prototypes,
+                max_n,
+                app.config.get("ANN_MAX_PROBE_CELLS", 64),
+                seed,
+                sql="sql" in backends,
+            )
+            return
+
+        if node_id is None:
+            raise click.UsageError("Either NODE_ID or --synthetic is required.")
+
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            # Make sure that the node is consolidated beforehand
+            tree.get_node(node_id)
+
+            reference = None
+            for backend in ("sql",) + tuple(b for b in backends if b != "sql"):
+                start = time.perf_counter()
+                result = tree.recommend_objects(node_id, max_n, backend=backend)
+                duration = time.perf_counter() - start
+
+                object_ids = set(o["object_id"] for o in result)
+                if reference is None:
+                    reference = object_ids
+
+                recall = (
+                    len(object_ids & reference) / len(reference) if reference else 1.0
+                )
+
+                print(
+                    f"{backend:>5s}: {duration:8.3f}s, {len(result):,d} objects, recall {recall:.2%}"
+                )
+
+    @app.cli.command()
+    @click.option("--depth", type=int, default=1000)
+    @click.option("--n-repeat", type=int, default=10)
+    def benchmark_ancestry(depth: int, n_repeat: int):
+        """
+        Compare recursive queries and the materialized path (nodes.path) on a deep tree.
+
+        A chain of depth nodes is created in a transaction that is rolled back afterwards.
+        """
+        with database.engine.connect() as conn:
+            tree = Tree(conn)
+
+            txn = conn.begin()
+            try:
+                project_id = tree.create_project("benchmark-ancestry")
+                root_id = node_id = tree.create_node(project_id)
+                for _ in range(depth):
+                    node_id = tree.create_node(project_id, parent_id=node_id)
+
+                conn.execute("ANALYZE nodes")
+
+                benchmarks = [
+                    (
+                        "path of the deepest node",
+                        lambda: tree._get_path_ids_recursive(node_id),
+                        lambda: tree.get_path_ids(node_id),
+                    ),
+                    (
+                        "descendants of the root",
+                        lambda: conn.execute(
+                            select([func.count()]).select_from(_rquery_subtree(root_id))
+                        ).scalar(),
+                        lambda: tree.node_n_descendants(root_id),
+                    ),
+                ]
+
+                for name, recursive, materialized in benchmarks:
+                    if recursive() != materialized():
+                        raise click.ClickException(f"Results differ: {name}")
+
+                    for method, f in (("recursive", recursive), ("path", materialized)):
+                        start = time.perf_counter()
+                        for _ in range(n_repeat):
+                            f()
+                        duration = (time.perf_counter() - start) / n_repeat
+
+                        print(f"{name} ({method:>9s}): {duration * 1000:8.3f}ms")
+            finally:
+                txn.rollback()
+
     @app.cli.command()
     @click.argument("project_id", type=int)
     def reset_grown(project_id: int):
@@ -6,6 +6,19 @@ _env.read_env()
 # Redis (LRU for caching)
 REDIS_LRU_URL = "redis://redis-lru:6379/0"
 
+# Page cache (in front of redis-lru)
+# Expiry of cached results (seconds, 0 = never)
+PAGE_CACHE_TTL = _env.int("PAGE_CACHE_TTL", default=3600)
+# Maximum number of pages kept in each worker process
+PAGE_CACHE_LOCAL_SIZE = _env.int("PAGE_CACHE_LOCAL_SIZE", default=1000)
+# Compression of cached pages ("none", "zlib", "bz2" or "lzma")
+PAGE_CACHE_CODEC = _env.str("PAGE_CACHE_CODEC", default="zlib")
+
+# Listen for modifications by other workers (PostgreSQL LISTEN/NOTIFY)
+# and evict the affected entries of in-process caches. Off by default:
+# The in-process caches validate their entries against the versions on read.
+INVALIDATION_LISTENER = _env.bool("INVALIDATION_LISTENER", default=False)
+
 # Redis for rq
 RQ_REDIS_URL = "redis://redis-rq:6379/0"
 
@@ -25,6 +38,48 @@ SAVE_RECOMMENDATION_STATS = False
 
 DATASET_PATH = _env.str("DATASET_PATH", default="/data")
 
+# Consolidate invalidated nodes in a background job (requires a running rq worker).
+# Otherwise, nodes returned stale by reads with allow_stale (e.g. GET /api/nodes/<node_id>?stale=1)
+# are consolidated in a thread of the worker process.
+CONSOLIDATE_IN_BACKGROUND = _env.bool("CONSOLIDATE_IN_BACKGROUND", default=False)
+
+# Stale-while-revalidate for GET /api/nodes/<node_id> (unless overridden with ?stale=0):
+# Return the cached values without waiting for the project lock
+# and consolidate invalid nodes asynchronously.
+NODE_READ_STALE = _env.bool("NODE_READ_STALE", default=False)
+
+# Maximum number of prototypes per node (unless set per project in projects.n_prototypes).
+# Small nodes get fewer prototypes.
+N_PROTOTYPES = _env.int("N_PROTOTYPES", default=16)
+
+# Storage of object vectors: "cube" (objects.vector, at most 100 dimensions)
+# or "array" (objects.vector_array, unlimited; populated by flask db upgrade and flask load-features)
+VECTOR_STORAGE = _env.str("VECTOR_STORAGE", default="cube")
+
+# Calculate the recommended objects of a node in a background job when it is approved
+# (requires a running rq worker).
+PRECOMPUTE_RECOMMENDATIONS = _env.bool("PRECOMPUTE_RECOMMENDATIONS", default=False)
+
+# Maximum number of accepted and rejected objects (each) used to re-rank recommendations
+RERANK_MAX_SAMPLES = 1000
+
+# Backend of Tree.recommend_objects ("sql", "ann", "knn" or "blas")
+RECOMMEND_BACKEND = _env.str("RECOMMEND_BACKEND", default="sql")
+
+# The feature vectors have unit length (saves a dot product per object in the "blas" backend)
+FEATURES_NORMALIZED = _env.bool("FEATURES_NORMALIZED", default=False)
+
+# Directory of the approximate nearest neighbour indexes (see flask build-ann-index), e.g. /data/ann.
+# If None, the "ann" backend falls back to "sql".
+ANN_INDEX_DIR = _env.str("ANN_INDEX_DIR", default=None)
+
+# Maximum number of index cells searched per recommendation request ("ann" backend)
+ANN_MAX_PROBE_CELLS = _env.int("ANN_MAX_PROBE_CELLS", default=64)
+
+# Directory of the memory-mapped vector store (written by flask load-features), e.g. /data/vectors.
+# If None, vectors are read from the database.
+VECTOR_STORE_DIR = _env.str("VECTOR_STORE_DIR", default=None)
+
 # ORDER BY clause for node_get_next_unfilled
 NODE_GET_NEXT_UNFILLED_ORDER_BY = "largest"
 
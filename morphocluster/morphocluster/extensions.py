@@ -11,8 +11,17 @@ from flask_rq2 import RQ
 
 from sqlalchemy.pool import StaticPool
 
+from morphocluster import topology
+from morphocluster.notify import InvalidationListener
+from morphocluster.page_cache import PageCache
+
 # StaticPool: Use one connection throughout
 database = SQLAlchemy(engine_options=dict(poolclass=StaticPool))
 redis_lru = FlaskRedis(config_prefix="REDIS_LRU")
+page_cache = PageCache(redis_lru)
 migrate = Migrate()
 rq = RQ()
+
+# Evict in-process caches when other workers modify a project
+invalidation_listener = InvalidationListener()
+invalidation_listener.subscribe(topology.invalidate)
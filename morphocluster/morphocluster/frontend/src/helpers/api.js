@@ -104,6 +104,13 @@ export function nodeAcceptRecommendations(node_id, request_id, rejected_members,
         { request_id, rejected_members, last_page, log_data });
 }
 
+export function nodeRerankRecommendations(node_id, request_id, rejected_members, last_page) {
+    return axios.post(`/api/nodes/${node_id}/rerank_recommended_objects`,
+        { request_id, rejected_members, last_page }).then(response => {
+        return response.data;
+    });
+}
+
 export function getUnfilledNodes(project_id) {
     return axios.get(`/api/projects/${project_id}/unfilled_nodes`).then(response => {
         return response.data;
@@ -6,26 +6,34 @@ Created on 13.03.2018
 import datetime
 
 # pylint: disable=W,C,R
-from sqlalchemy import Column, ForeignKey, Index, Table
+from sqlalchemy import DDL, Column, ForeignKey, Index, Table, event
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql import func
-from sqlalchemy.sql.schema import CheckConstraint, UniqueConstraint
+from sqlalchemy.sql.schema import CheckConstraint, Sequence, UniqueConstraint
 from sqlalchemy.types import (
     BigInteger,
     Boolean,
     DateTime,
     Float,
     Integer,
-    PickleType,
     String,
     Text,
 )
 
 from morphocluster.extensions import database as db
-from morphocluster.sql.types import Point
+from morphocluster.sql.types import (
+    VECTOR_DIST_FUNCTION,
+    BinaryArray,
+    BinaryPrototypes,
+    FloatArray,
+    Point,
+)
 
 metadata = db.metadata
 
+#: Source of the node versions (see Tree.bump_versions)
+nodes_version_seq = Sequence("nodes_version_seq", metadata=metadata)
+
 #: :type objects: sqlalchemy.sql.schema.Table
 objects = Table(
     "objects",
@@ -33,9 +41,15 @@ objects = Table(
     Column("object_id", String, primary_key=True),
     Column("path", String, nullable=False),
     Column("vector", Point(numpy=True), nullable=True),
+    # Alternative storage without the dimensionality limit of CUBE (see VECTOR_STORAGE)
+    Column("vector_array", FloatArray, nullable=True),
     Column("rand", Float, server_default=func.random()),
+    # GiST index for nearest neighbour (ORDER BY vector <-> ...) queries
+    Index("ix_objects_vector", "vector", postgresql_using="gist"),
 )
 
+event.listen(objects, "after_create", DDL(VECTOR_DIST_FUNCTION))
+
 #: :type projects: sqlalchemy.sql.schema.Table
 projects = Table(
     "projects",
@@ -44,6 +58,8 @@ projects = Table(
     Column("name", String),
     Column("creation_date", DateTime, default=datetime.datetime.now),
     Column("visible", Boolean, nullable=False, server_default="t"),
+    # Maximum number of prototypes per node (NULL: use N_PROTOTYPES config value)
+    Column("n_prototypes", Integer, nullable=True),
 )
 
 #: :type nodes: sqlalchemy.sql.schema.Table
@@ -85,9 +101,13 @@ nodes = Table(
     # The following fields are cached values
     # ===========================================================================
     # Centroid (single)
-    Column("_centroid", PickleType, nullable=True),
+    Column("_centroid", BinaryArray("float32"), nullable=True),
+    # Sum of the vectors of all objects anywhere below this node (maintained incrementally)
+    Column("_vector_sum", BinaryArray("float64"), nullable=True),
     # Prototypes (multiple centroid)
-    Column("_prototypes", PickleType, nullable=True),
+    Column("_prototypes", BinaryPrototypes, nullable=True),
+    # Prototypes of the objects directly below this node (warm start of the next fit)
+    Column("_own_prototypes", BinaryPrototypes, nullable=True),
     # object_ids of type objects representative for all descendants (used as preview)
     Column("_type_objects", ARRAY(String), nullable=True),
     # object_ids of type objects directly under this node (used as preview for the node's objects)
@@ -100,6 +120,17 @@ nodes = Table(
     Column("_n_objects_deep", BigInteger, nullable=True),
     # Validity of cached values
     Column("cache_valid", Boolean, nullable=False, server_default="f"),
+    # Set to the next value of nodes_version_seq by every modification of the node
+    # (see Tree.bump_versions)
+    Column("version", BigInteger, nullable=False, server_default="0"),
+    # Set to the next value of nodes_version_seq when the objects directly below the node change
+    # (see Tree.get_recommendation_version)
+    Column("objects_version", BigInteger, nullable=False, server_default="0"),
+    # Aggregated versions of subtrees and projects (see Tree.get_project_version)
+    Index("ix_nodes_project_id_version", "project_id", "version"),
+    # Materialized path: node_ids from the root to this node (maintained by Tree)
+    Column("path", ARRAY(BigInteger), nullable=True),
+    Index("ix_nodes_path", "path", postgresql_using="gin"),
     # An orig_id must be unique inside a project
     Index("idx_orig_proj", "orig_id", "project_id", unique=True),
     # A node may not be its own child
@@ -133,6 +164,27 @@ nodes_objects = Table(
     UniqueConstraint("project_id", "object_id"),
 )
 
+# Persisted random sample of the objects directly below a node:
+# The (up to) SAMPLE_SIZE objects with the smallest objects.rand.
+nodes_samples = Table(
+    "nodes_samples",
+    metadata,
+    Column(
+        "node_id",
+        None,
+        ForeignKey("nodes.node_id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "object_id",
+        None,
+        ForeignKey("objects.object_id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    # Copy of objects.rand
+    Column("rand", Float, nullable=False),
+)
+
 nodes_rejected_objects = Table(
     "nodes_rejected_objects",
     metadata,
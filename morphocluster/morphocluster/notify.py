@@ -0,0 +1,187 @@
+"""
+Cross-process invalidation of in-process caches via PostgreSQL LISTEN/NOTIFY.
+
+Every modification of the tree bumps the versions of the affected nodes
+and emits a notification (see Tree.bump_versions).
+PostgreSQL only delivers it when the transaction commits.
+A listener thread in every worker receives the notifications and passes them to
+the subscribed callbacks, which evict the matching entries of their caches.
+"""
+
+import collections
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.expression import select as sql_select
+from sqlalchemy.sql.functions import func
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "morphocluster_invalidation"
+
+# PostgreSQL limits payloads to 8000 bytes
+_MAX_PAYLOAD = 7900
+
+#: A notification.
+#: project_id: None if all projects are affected.
+#: node_ids: None if all nodes of the project are affected.
+#: version: Version assigned to the nodes (see Tree.bump_versions) or None.
+Invalidation = collections.namedtuple(
+    "Invalidation", ["project_id", "node_ids", "version"]
+)
+
+
+def encode_payload(invalidation):
+    payload = json.dumps(invalidation._asdict())
+
+    if len(payload) > _MAX_PAYLOAD:
+        # Too many nodes: Invalidate the whole project
+        payload = json.dumps(invalidation._replace(node_ids=None)._asdict())
+
+    return payload
+
+
+def decode_payload(payload):
+    return Invalidation(**json.loads(payload))
+
+
+def notify(connection, project_id, node_ids, version):
+    """
+    Emit an invalidation on connection.
+
+    Inside of a transaction, the notification is delivered on commit
+    and dropped on rollback.
+    """
+    payload = encode_payload(
+        Invalidation(project_id, sorted(int(n) for n in node_ids), version)
+    )
+    connection.execute(sql_select([func.pg_notify(CHANNEL, payload)]))
+
+
+class InvalidationListener:
+    """
+    Receives invalidations in a background thread and dispatches them to subscribers.
+
+    The thread is started by the first request of every process
+    (gunicorn forks its workers after the app is created).
+
+    Configuration:
+        INVALIDATION_LISTENER: Start the listener.
+
+    Attributes:
+        ready: Set while the listener is connected.
+        stats: Counter of received notifications and reconnects of this process.
+    """
+
+    #: Seconds between two reconnection attempts
+    reconnect_delay = 5.0
+
+    #: Seconds between checks for new notifications
+    poll_interval = 5.0
+
+    def __init__(self, app=None):
+        self.database_uri = None
+        self.ready = threading.Event()
+        self.stats = collections.Counter()
+
+        self._subscribers = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
+
+        if app.config.get("INVALIDATION_LISTENER", False):
+            app.before_request(self.start)
+
+    def subscribe(self, callback):
+        """
+        Call callback(invalidation) for every received notification.
+
+        An Invalidation(None, None, None) is dispatched after a reconnect,
+        as notifications might have been missed.
+        """
+        self._subscribers.append(callback)
+        return callback
+
+    def dispatch(self, invalidation):
+        for callback in self._subscribers:
+            try:
+                callback(invalidation)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error in invalidation callback %r", callback)
+
+    def start(self):
+        """
+        Start the listener thread of the current process (if not already running).
+        """
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid == pid:
+                return
+
+            self._pid = pid
+            self.ready.clear()
+
+            thread = threading.Thread(
+                target=self._run, name="InvalidationListener", daemon=True
+            )
+            thread.start()
+
+    def _run(self):
+        engine = sqlalchemy.create_engine(self.database_uri, poolclass=NullPool)
+
+        while True:
+            try:
+                self._listen(engine)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning("Invalidation listener disconnected: %s", exc)
+
+            self.ready.clear()
+            self.stats["reconnects"] += 1
+
+            # Notifications might have been missed in the meantime
+            self.dispatch(Invalidation(None, None, None))
+
+            time.sleep(self.reconnect_delay)
+
+    def _listen(self, engine):
+        raw_connection = engine.raw_connection()
+
+        try:
+            connection = raw_connection.connection
+            connection.autocommit = True
+
+            with connection.cursor() as cursor:
+                cursor.execute("LISTEN {}".format(CHANNEL))
+
+            self.ready.set()
+
+            while True:
+                readable, _, _ = select.select(
+                    [connection], [], [], self.poll_interval
+                )
+                if not readable:
+                    continue
+
+                connection.poll()
+
+                while connection.notifies:
+                    notification = connection.notifies.pop(0)
+                    self.stats["notifications"] += 1
+                    self.dispatch(decode_payload(notification.payload))
+        finally:
+            raw_connection.close()
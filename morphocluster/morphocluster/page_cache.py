@@ -0,0 +1,231 @@
+"""
+Two-tier cache for paginated results.
+
+A small in-process LRU is kept in front of Redis,
+so that repeated requests to the same worker do not even need a Redis round-trip.
+"""
+
+import bz2
+import collections
+import lzma
+import threading
+import warnings
+import zlib
+
+from redis.exceptions import RedisError
+
+#: Compression codecs: name -> (compress, decompress)
+CODECS = {
+    "none": (bytes, bytes),
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def _encode(page, codec):
+    # Every page carries the name of its codec,
+    # so that a change of PAGE_CACHE_CODEC does not invalidate existing entries.
+    compress, _ = CODECS[codec]
+    return codec.encode() + b":" + compress(page.encode())
+
+
+def _decode(value):
+    codec, sep, data = value.partition(b":")
+    codec = codec.decode(errors="replace")
+
+    if sep and codec in CODECS:
+        _, decompress = CODECS[codec]
+        return decompress(data).decode()
+
+    # Entries written before the codec prefix was introduced: zlib or uncompressed
+    try:
+        return zlib.decompress(value).decode()
+    except zlib.error:
+        return value.decode()
+
+
+class PageCache:
+    """
+    Cache for lists of serialized pages.
+
+    Parameters:
+        redis: FlaskRedis instance of the shared tier.
+
+    Configuration:
+        PAGE_CACHE_TTL: Expiry of entries in Redis (seconds, 0 = never).
+        PAGE_CACHE_LOCAL_SIZE: Maximum number of pages in the in-process tier.
+        PAGE_CACHE_CODEC: Compression codec of new entries (see CODECS).
+
+    Attributes:
+        stats: Counter of local_hits, redis_hits and misses of this process.
+    """
+
+    def __init__(self, redis, app=None):
+        self.redis = redis
+        self.ttl = 3600
+        self.local_size = 1000
+        self.codec = "zlib"
+
+        self.stats = collections.Counter()
+
+        self._local = collections.OrderedDict()
+        self._local_n_pages = 0
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("PAGE_CACHE_TTL", self.ttl)
+        self.local_size = app.config.get("PAGE_CACHE_LOCAL_SIZE", self.local_size)
+        self.codec = app.config.get("PAGE_CACHE_CODEC", self.codec)
+
+        if self.codec not in CODECS:
+            raise ValueError(
+                "Unknown PAGE_CACHE_CODEC: {}. Choose one of {}.".format(
+                    self.codec, ", ".join(CODECS)
+                )
+            )
+
+    def _get_local(self, key):
+        with self._lock:
+            pages = self._local.get(key)
+            if pages is not None:
+                self._local.move_to_end(key)
+            return pages
+
+    def _set_local(self, key, pages):
+        with self._lock:
+            old = self._local.pop(key, None)
+            if old is not None:
+                self._local_n_pages -= len(old)
+
+            if len(pages) > self.local_size:
+                return
+
+            self._local[key] = pages
+            self._local_n_pages += len(pages)
+
+            while self._local_n_pages > self.local_size:
+                _, evicted = self._local.popitem(last=False)
+                self._local_n_pages -= len(evicted)
+
+    def get_page(self, key, page):
+        """
+        Get a single page.
+
+        Returns:
+            (page, n_pages) or None if key is unknown.
+            page is "[]" if it is out of range.
+        """
+
+        pages = self._get_local(key)
+        if pages is not None:
+            self.stats["local_hits"] += 1
+        else:
+            try:
+                pipeline = self.redis.pipeline()
+                pipeline.lindex(key, page)
+                pipeline.llen(key)
+                value, n_pages = pipeline.execute()
+            except RedisError as exc:
+                warnings.warn("RedisError: {}".format(exc))
+                n_pages = 0
+
+            if not n_pages:
+                self.stats["misses"] += 1
+                return None
+
+            self.stats["redis_hits"] += 1
+
+            if n_pages > self.local_size:
+                return (_decode(value) if value is not None else "[]"), n_pages
+
+            pages = self.get(key, count=False)
+            if pages is None:
+                # Expired in the meantime
+                return (_decode(value) if value is not None else "[]"), n_pages
+
+        if 0 <= page < len(pages):
+            return pages[page], len(pages)
+
+        return "[]", len(pages)
+
+    def get(self, key, count=True):
+        """
+        Get all pages.
+
+        Returns:
+            List of pages or None if key is unknown.
+        """
+
+        pages = self._get_local(key)
+        if pages is not None:
+            if count:
+                self.stats["local_hits"] += 1
+            return pages
+
+        try:
+            values = self.redis.lrange(key, 0, -1)
+        except RedisError as exc:
+            warnings.warn("RedisError: {}".format(exc))
+            values = []
+
+        if not values:
+            if count:
+                self.stats["misses"] += 1
+            return None
+
+        if count:
+            self.stats["redis_hits"] += 1
+
+        pages = [_decode(v) for v in values]
+        self._set_local(key, pages)
+
+        return pages
+
+    def set(self, key, pages, ttl=None):
+        """
+        Store a list of pages (replacing a previous entry).
+
+        Parameters:
+            ttl: Expiry in Redis (seconds). (Default: PAGE_CACHE_TTL)
+        """
+
+        pages = list(pages)
+
+        if ttl is None:
+            ttl = self.ttl
+
+        self._set_local(key, pages)
+
+        if not pages:
+            return
+
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.delete(key)
+            pipeline.rpush(key, *(_encode(p, self.codec) for p in pages))
+            if ttl:
+                pipeline.expire(key, ttl)
+            pipeline.execute()
+        except RedisError as exc:
+            warnings.warn("RedisError: {}".format(exc))
+
+    def get_stats(self):
+        """
+        Hit and miss counters of this process.
+        """
+        stats = dict(local_hits=0, redis_hits=0, misses=0)
+        stats.update(self.stats)
+
+        n_requests = sum(stats.values())
+        stats["hit_ratio"] = (
+            (stats["local_hits"] + stats["redis_hits"]) / n_requests
+            if n_requests
+            else None
+        )
+        stats["local_n_pages"] = self._local_n_pages
+
+        return stats
@@ -0,0 +1,183 @@
+"""
+Approximate nearest neighbour search over object vectors.
+"""
+
+import functools
+import os
+import shutil
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+# offsets is written last and marks a complete index (see load_index)
+_FIELDS = ("centroids", "object_ids", "vectors", "offsets")
+
+
+def _min_distances(X, Q):
+    """
+    Euclidean distance of every row in X to its closest row in Q.
+
+    Parameters:
+        X: array of shape = [n_samples, n_features]
+        Q: array of shape = [n_queries, n_features]
+
+    Returns: array of shape = [n_samples]
+    """
+    # ||x - q||² = ||x||² - 2 x·q + ||q||²
+    sq_dist = (
+        np.einsum("ij,ij->i", X, X)[:, np.newaxis]
+        - 2 * X @ Q.T
+        + np.einsum("ij,ij->i", Q, Q)[np.newaxis, :]
+    )
+    return np.sqrt(np.maximum(sq_dist.min(axis=1), 0))
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search.
+
+    The vectors are partitioned into cells by k-means. A search only computes
+    exact distances for the vectors in the cells whose centroids are closest to the queries.
+
+    Attributes:
+        centroids: array of shape = [n_lists, n_features]
+        offsets: array of shape = [n_lists + 1]. The vectors of cell i are vectors[offsets[i]:offsets[i+1]].
+        object_ids: array of shape = [n_samples]
+        vectors: float32 array of shape = [n_samples, n_features]
+    """
+
+    def __init__(self, centroids, offsets, object_ids, vectors):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.object_ids = object_ids
+        self.vectors = vectors
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, object_ids, vectors, n_lists=None, random_state=None):
+        """
+        Build an index for vectors.
+
+        Parameters:
+            object_ids: array of shape = [n_samples]
+            vectors: array of shape = [n_samples, n_features]
+            n_lists: Number of cells. (Default: sqrt(n_samples))
+        """
+        object_ids = np.asarray(object_ids, dtype=str)
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if vectors.shape[0] == 0:
+            raise ValueError("vectors contains no samples.")
+
+        if n_lists is None:
+            n_lists = int(np.sqrt(vectors.shape[0]))
+        n_lists = max(1, min(n_lists, vectors.shape[0]))
+
+        clusterer = MiniBatchKMeans(
+            n_lists, n_init=1, batch_size=4096, random_state=random_state
+        )
+        labels = clusterer.fit_predict(vectors)
+
+        order = np.argsort(labels, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+
+        return cls(
+            clusterer.cluster_centers_.astype(np.float32),
+            offsets,
+            object_ids[order],
+            vectors[order],
+        )
+
+    def save(self, path):
+        """
+        Save the index to a directory (one .npy file per array).
+
+        The index is written next to path and then moved into place,
+        so that workers that have the previous index mapped keep a valid mapping.
+        """
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        for field in _FIELDS:
+            np.save(os.path.join(tmp_path, field + ".npy"), getattr(self, field))
+
+        old_path = path + ".old"
+        if os.path.exists(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load an index from a directory.
+
+        By default, the arrays are memory-mapped read-only.
+        """
+        return cls(
+            **{
+                field: np.load(os.path.join(path, field + ".npy"), mmap_mode=mmap_mode)
+                for field in _FIELDS
+            }
+        )
+
+    def iter_candidates(self, queries, n_probe=8, max_cells=None):
+        """
+        Iterate over the vectors cell by cell, starting with the cells closest to any query.
+
+        Parameters:
+            queries: array of shape = [n_queries, n_features]
+            n_probe: Number of cells per step.
+            max_cells: Stop after this many cells. (Default: All cells)
+
+        Yields:
+            (object_ids, distances) of the vectors in the next n_probe cells,
+            where distances are the distances to the closest query.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+
+        order = np.argsort(_min_distances(self.centroids, queries))
+
+        if max_cells is not None:
+            order = order[:max_cells]
+
+        for i in range(0, len(order), n_probe):
+            cells = order[i : i + n_probe]
+            rows = np.concatenate(
+                [
+                    np.arange(self.offsets[c], self.offsets[c + 1], dtype=np.int64)
+                    for c in cells
+                ]
+            )
+
+            if len(rows) == 0:
+                continue
+
+            yield self.object_ids[rows], _min_distances(self.vectors[rows], queries)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_cached(path, mtime):
+    # mtime is part of the cache key so that a rebuilt index is reloaded
+    return IVFIndex.load(path)
+
+
+def load_index(path):
+    """
+    Load an index and keep it in memory until it is rebuilt.
+
+    Returns:
+        IVFIndex or None if no index exists at path.
+    """
+    try:
+        mtime = os.path.getmtime(os.path.join(path, "offsets.npy"))
+    except FileNotFoundError:
+        return None
+
+    return _load_cached(path, mtime)
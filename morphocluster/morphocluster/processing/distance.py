@@ -0,0 +1,65 @@
+"""
+Exact distance calculations in NumPy.
+"""
+
+import numpy as np
+
+
+def top_k_min_distances(X, P, k, rows=None, normalized=False, chunksize=65536):
+    """
+    Find the k rows of X that are closest to any row of P (euclidean distance).
+
+    The squared distances are calculated in float32 with one matrix multiplication
+    per chunk: ||x - p||² = ||x||² - 2 x·pᵀ + ||p||²
+    The memory usage is bounded by chunksize and k, regardless of the size of X.
+
+    Parameters:
+        X: array of shape = [n_samples, n_features] (may be a memory map)
+        P: array of shape = [n_queries, n_features]
+        k: Number of results.
+        rows: Optional indices into X. Only these rows are considered.
+        normalized: The rows of X have unit length (||x||² = 1).
+        chunksize: Number of rows per matrix multiplication.
+
+    Returns:
+        (indices, distances) sorted by distance.
+        indices refer to rows (if given) or to X.
+    """
+    P = np.asarray(P, dtype=np.float32)
+    p_sq = np.einsum("ij,ij->i", P, P)
+
+    n = len(rows) if rows is not None else X.shape[0]
+    k = min(k, n)
+
+    best_indices = np.empty(0, dtype=np.int64)
+    best_sq_dist = np.empty(0, dtype=np.float32)
+
+    if k <= 0:
+        return best_indices, best_sq_dist
+
+    for start in range(0, n, chunksize):
+        stop = min(start + chunksize, n)
+
+        chunk = X[rows[start:stop]] if rows is not None else X[start:stop]
+        chunk = np.asarray(chunk, dtype=np.float32)
+
+        sq_dist = p_sq[np.newaxis, :] - 2 * (chunk @ P.T)
+        if normalized:
+            sq_dist += 1
+        else:
+            sq_dist += np.einsum("ij,ij->i", chunk, chunk)[:, np.newaxis]
+
+        # Merge with the best candidates so far
+        sq_dist = np.concatenate((best_sq_dist, sq_dist.min(axis=1)))
+        indices = np.concatenate((best_indices, np.arange(start, stop)))
+
+        if len(sq_dist) > k:
+            selection = np.argpartition(sq_dist, k - 1)[:k]
+            sq_dist = sq_dist[selection]
+            indices = indices[selection]
+
+        best_sq_dist, best_indices = sq_dist, indices
+
+    order = np.argsort(best_sq_dist, kind="stable")
+
+    return best_indices[order], np.sqrt(np.maximum(best_sq_dist[order], 0))
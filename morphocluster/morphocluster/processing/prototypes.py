@@ -2,13 +2,17 @@ import numpy as np
 from numpy.lib.arraysetops import unique
 from scipy.spatial.distance import cdist
 from sklearn.base import ClassifierMixin
-from sklearn.cluster import AgglomerativeClustering
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
 from sklearn.exceptions import NotFittedError
 from sklearn.preprocessing import LabelEncoder
 from sklearn.utils.extmath import softmax
 from sklearn.utils.validation import check_is_fitted
 
 
+#: Minimum number of samples per prototype (see adaptive_k)
+MIN_SUPPORT = 8
+
+
 def _check_is_clusterer(clusterer):
     attributes = ("fit_predict", "n_clusters")
     if not all(hasattr(clusterer, attr) for attr in attributes):
@@ -235,3 +239,88 @@ def merge_prototypes(children, k, metric="euclidean"):
     result.support_ = new_support
 
     return result
+
+
+def adaptive_k(n_samples, k, min_support=MIN_SUPPORT):
+    """
+    Scale down the number of prototypes for small nodes.
+
+    Every prototype should represent at least min_support samples.
+
+    Parameters:
+        n_samples: int
+            Number of samples that are represented by the prototypes.
+        k: int
+            Maximum number of prototypes.
+
+    Returns: int in the range [1, k]
+    """
+    return int(max(1, min(k, n_samples // min_support)))
+
+
+def _warm_start_centers(X, k, init, random_state):
+    """
+    Choose k initial centers from the previous prototypes (largest support first)
+    and fill up with random samples of X.
+    """
+    order = np.argsort(-init.support_, kind="stable")[:k]
+    centers = init.prototypes_[order].astype(np.float32)
+
+    if centers.shape[0] < k:
+        fill = random_state.choice(X.shape[0], k - centers.shape[0], replace=False)
+        centers = np.concatenate((centers, X[fill]))
+
+    return centers
+
+
+def fit_prototypes(X, k, init=None, max_iter=20, batch_size=256, random_state=None):
+    """
+    Fit at most k prototypes to X using float32 mini-batch k-means.
+
+    If init (a fitted Prototypes object, e.g. the previous prototypes of a node)
+    is given, the centers are warm-started from it, so that a small change of X
+    only needs a few updates instead of a full fit.
+
+    Parameters:
+        X: array of shape = [n_samples, n_features]
+        k: int
+            Maximum number of prototypes
+        init: Prototypes or None
+            Previous prototypes
+        max_iter: int
+            Iteration budget (passes over X)
+        batch_size: int
+            Mini-batch size
+
+    Returns: Prototypes object
+    """
+    X = np.asarray(X, dtype=np.float32)
+    random_state = np.random.RandomState(random_state)
+
+    k = min(k, X.shape[0])
+
+    if (
+        init is not None
+        and getattr(init, "prototypes_", None) is not None
+        and init.prototypes_.shape[1:] == X.shape[1:]
+    ):
+        centers = _warm_start_centers(X, k, init, random_state)
+        # The warm-started centers are already close to the optimum
+        max_iter = max(1, max_iter // 4)
+    else:
+        centers = "k-means++"
+
+    clusterer = MiniBatchKMeans(
+        k,
+        init=centers,
+        n_init=1,
+        max_iter=max_iter,
+        batch_size=batch_size,
+        max_no_improvement=3,
+        random_state=random_state,
+    )
+
+    prototypes = Prototypes(clusterer)
+    prototypes.fit(X)
+
+    return prototypes
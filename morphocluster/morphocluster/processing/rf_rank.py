@@ -6,6 +6,26 @@ from sklearn.ensemble import RandomForestClassifier
 import numpy as np
 
 
+def _fit_predict(classifier, candidates, valid, rejected):
+    X = np.concatenate((rejected, valid))
+    y = np.ones(X.shape[0])
+    y[: rejected.shape[0]] = -1
+
+    classifier.fit(X, y)
+
+    # Get index of positive class
+    positive_index = np.nonzero(classifier.classes_ == 1)[0][0]
+
+    return classifier.predict_proba(candidates)[:, positive_index]
+
+
+def _subsample(X, max_samples, random_state):
+    if X.shape[0] <= max_samples:
+        return X
+
+    return X[random_state.choice(X.shape[0], max_samples, replace=False)]
+
+
 def rf_rank(candidates, valid, rejected, **kwargs):
     """
     Rank recommendations using random forests.
@@ -27,16 +47,62 @@ def rf_rank(candidates, valid, rejected, **kwargs):
 
     classifier = RandomForestClassifier(**kwargs)
 
-    X = np.concatenate((rejected, valid))
-    y = np.ones(X.shape[0])
-    y[: rejected.shape[0]] = -1
+    proba = _fit_predict(classifier, candidates, valid, rejected)
 
-    classifier.fit(X, y)
+    order = np.argsort(proba)[::-1]
+    return order
 
-    # Get index of positive class
-    positive_index = np.nonzero(classifier.classes_ == 1)[0][0]
 
-    proba = classifier.predict_proba(candidates)[:, positive_index]
+def rf_rank_incremental(
+    candidates,
+    valid,
+    rejected,
+    classifier=None,
+    n_estimators=8,
+    max_samples=1000,
+    random_state=None,
+    **kwargs
+):
+    """
+    Rank recommendations using a random forest that grows with every call.
 
-    order = np.argsort(proba)[::-1]
-    return order
+    Every call adds n_estimators trees to a warm-started forest,
+    so that the trees of earlier calls keep the feedback of earlier pages
+    while the cost of a single call stays bounded.
+
+    Parameters:
+        candidates, valid, rejected: See rf_rank.
+        classifier: Forest returned by a previous call (or None).
+        n_estimators: Number of trees added in this call.
+        max_samples: Maximum number of valid and rejected vectors (each) used for training.
+        random_state: Seed for the subsampling and the forest.
+
+        kwargs: Passed to RandomForestClassifier.
+
+    Returns:
+        (order, classifier)
+    """
+
+    assert candidates.shape[0] > 0
+    assert valid.shape[0] > 0
+    assert rejected.shape[0] > 0
+
+    rng = np.random.RandomState(random_state)
+    valid = _subsample(valid, max_samples, rng)
+    rejected = _subsample(rejected, max_samples, rng)
+
+    if classifier is None:
+        classifier = RandomForestClassifier(
+            n_estimators=n_estimators,
+            warm_start=True,
+            random_state=random_state,
+            **kwargs
+        )
+    else:
+        classifier.n_estimators += n_estimators
+
+    proba = _fit_predict(classifier, candidates, valid, rejected)
+
+    # Stable, so that ties keep the original order of the candidates
+    order = np.argsort(-proba, kind="stable")
+    return order, classifier
@@ -0,0 +1,173 @@
+"""
+Bulk updates using PostgreSQL COPY.
+"""
+
+import io
+import itertools
+import uuid
+
+import numpy as np
+from sqlalchemy.sql import text
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.types import TypeDecorator, UserDefinedType
+
+
+def _bind_processor(type_, dialect):
+    """
+    Return a function that converts a Python value to the value that is sent to the database.
+
+    The DBAPI-specific processing (e.g. wrapping bytes in psycopg2.Binary) is skipped
+    as the value is formatted for COPY instead.
+    """
+    if isinstance(type_, TypeDecorator):
+        return lambda value: type_.process_bind_param(value, dialect)
+
+    if isinstance(type_, UserDefinedType):
+        return type_.bind_processor(dialect)
+
+    return None
+
+
+def _array_element(value):
+    if value is None:
+        return "NULL"
+
+    value = _copy_text(value)
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _copy_text(value):
+    """
+    Format a value in the PostgreSQL text representation.
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()
+
+    if isinstance(value, (bool, np.bool_)):
+        return "t" if value else "f"
+
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return "{" + ",".join(_array_element(v) for v in value) + "}"
+
+    return str(value)
+
+
+def _csv_field(value):
+    # Quoted values never match the NULL string, so every value can be represented.
+    if value is None:
+        return "\\N"
+
+    return '"' + value.replace('"', '""') + '"'
+
+
+def bulk_update(connection, table, key, rows, columns=None, chunksize=10000):
+    """
+    Update many rows of a table at once.
+
+    The rows are streamed into a temporary table using COPY
+    and applied with a single UPDATE ... FROM.
+    Must be called inside of a transaction.
+
+    Parameters:
+        connection: sqlalchemy.engine.Connection
+        table: sqlalchemy.Table
+        key: Column name (or list of column names) identifying a row.
+        rows: Iterable of mappings containing the key and the updated columns.
+        columns: Names of the updated columns. (Default: All columns of the first row except the key.)
+        chunksize: Number of rows per COPY.
+
+    Returns:
+        Number of updated rows.
+    """
+
+    if isinstance(key, str):
+        key = [key]
+
+    rows = iter(rows)
+    first = next(rows, None)
+
+    if first is None:
+        return 0
+
+    rows = itertools.chain([first], rows)
+
+    if columns is None:
+        columns = [c for c in first.keys() if c not in key]
+
+    dialect = connection.dialect
+
+    if dialect.name != "postgresql":
+        # Fallback: executemany
+        stmt = table.update().values({c: bindparam(c) for c in columns})
+        for k in key:
+            stmt = stmt.where(table.c[k] == bindparam("_" + k))
+
+        n_updated = 0
+        while True:
+            chunk = [
+                {**{c: r[c] for c in columns}, **{"_" + k: r[k] for k in key}}
+                for r in itertools.islice(rows, chunksize)
+            ]
+            if not chunk:
+                return n_updated
+            n_updated += connection.execute(stmt, chunk).rowcount
+
+    quote = dialect.identifier_preparer.quote
+    all_columns = key + columns
+    processors = [_bind_processor(table.c[c].type, dialect) for c in all_columns]
+
+    tmp_name = quote("_bulk_{}_{}".format(table.name, uuid.uuid4().hex[:8]))
+    table_name = dialect.identifier_preparer.format_table(table)
+    column_list = ", ".join(quote(c) for c in all_columns)
+
+    # The temporary table has the same column types as the target table
+    connection.execute(
+        text(
+            "CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA".format(
+                tmp_name, column_list, table_name
+            )
+        )
+    )
+
+    cursor = connection.connection.cursor()
+    try:
+        copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            tmp_name, column_list
+        )
+
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if not chunk:
+                break
+
+            buffer = io.StringIO()
+            for row in chunk:
+                values = (row[c] for c in all_columns)
+                fields = (
+                    _csv_field(_copy_text(p(v) if p is not None else v))
+                    for p, v in zip(processors, values)
+                )
+                buffer.write(",".join(fields))
+                buffer.write("\n")
+            buffer.seek(0)
+
+            cursor.copy_expert(copy_sql, buffer)
+    finally:
+        cursor.close()
+
+    stmt = "UPDATE {table} SET {values} FROM {tmp} WHERE {condition}".format(
+        table=table_name,
+        values=", ".join("{0} = {1}.{0}".format(quote(c), tmp_name) for c in columns),
+        tmp=tmp_name,
+        condition=" AND ".join(
+            "{0}.{2} = {1}.{2}".format(table_name, tmp_name, quote(k)) for k in key
+        ),
+    )
+    result = connection.execute(text(stmt))
+
+    connection.execute(text("DROP TABLE {}".format(tmp_name)))
+
+    return result.rowcount
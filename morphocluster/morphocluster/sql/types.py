@@ -1,4 +1,92 @@
-from sqlalchemy.types import TypeEngine, UserDefinedType, Float
+import struct
+
+import numpy as np
+from sqlalchemy.dialects.postgresql import ARRAY, REAL
+from sqlalchemy.sql.expression import cast, literal
+from sqlalchemy.sql.functions import func
+from sqlalchemy.types import (
+    Float,
+    LargeBinary,
+    TypeDecorator,
+    TypeEngine,
+    UserDefinedType,
+)
+
+#: Header of binary arrays: magic, format version, dtype char, ndim, shape (2x uint32)
+_ARRAY_HEADER = struct.Struct("<2sBcB3xII")
+_ARRAY_MAGIC = b"MC"
+_ARRAY_VERSION = 1
+
+
+def encode_array(value, dtype=np.float32):
+    """
+    Encode an array with up to two dimensions as header + raw little-endian data.
+    """
+    value = np.asarray(value, dtype=np.dtype(dtype).newbyteorder("<"))
+
+    if value.ndim > 2:
+        raise ValueError("Only arrays with up to two dimensions are supported.")
+
+    shape = value.shape + (0,) * (2 - value.ndim)
+
+    header = _ARRAY_HEADER.pack(
+        _ARRAY_MAGIC,
+        _ARRAY_VERSION,
+        value.dtype.char.encode("ascii"),
+        value.ndim,
+        *shape
+    )
+
+    return header + value.tobytes()
+
+
+def decode_array(buffer, offset=0):
+    """
+    Decode an array encoded by encode_array.
+
+    The result is a read-only view of buffer (no copy).
+
+    Returns:
+        (array, offset of the first byte after the array)
+    """
+    magic, version, char, ndim, *shape = _ARRAY_HEADER.unpack_from(buffer, offset)
+
+    if magic != _ARRAY_MAGIC:
+        raise ValueError("Not a binary array.")
+
+    if version != _ARRAY_VERSION:
+        raise ValueError("Unsupported binary array version: {}".format(version))
+
+    dtype = np.dtype(char.decode("ascii")).newbyteorder("<")
+    shape = shape[:ndim]
+    count = int(np.prod(shape))
+    offset += _ARRAY_HEADER.size
+
+    value = np.frombuffer(buffer, dtype, count, offset).reshape(shape)
+
+    return value, offset + count * dtype.itemsize
+
+
+def encode_prototypes(prototypes):
+    """
+    Encode a fitted Prototypes object as float32 prototypes followed by the support.
+    """
+    return encode_array(prototypes.prototypes_, np.float32) + encode_array(
+        prototypes.support_, np.float64
+    )
+
+
+def decode_prototypes(buffer):
+    """
+    Decode a Prototypes object encoded by encode_prototypes.
+    """
+    from morphocluster.processing.prototypes import Prototypes
+
+    prototypes = Prototypes(None)
+    prototypes.prototypes_, offset = decode_array(buffer)
+    prototypes.support_, _ = decode_array(buffer, offset)
+
+    return prototypes
 
 
 class Point(UserDefinedType):
@@ -68,3 +156,153 @@ class Point(UserDefinedType):
     
     # Statements using this type are safe to cache.
     cache_ok = True
+
+
+#: SQL function for the euclidean distance of two FloatArray values
+VECTOR_DIST_FUNCTION = """
+CREATE OR REPLACE FUNCTION vector_dist(a real[], b real[]) RETURNS double precision AS $$
+    SELECT sqrt(sum(((x - y)::double precision) ^ 2)) FROM unnest(a, b) AS t(x, y)
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+"""
+
+
+#: Header of the binary representation of a real[] (array_send): ndim, has_nulls, element oid
+_PG_ARRAY_HEADER = struct.Struct(">iiI")
+_PG_ARRAY_DIM = struct.Struct(">ii")
+_PG_FLOAT4_OID = 700
+
+
+def decode_pg_float_array(buffer):
+    """
+    Decode the binary representation of a one-dimensional real[] (see array_send).
+
+    Every element is preceded by its length, so the values are read
+    as a structured array and copied to a float32 array.
+    """
+    ndim, has_nulls, oid = _PG_ARRAY_HEADER.unpack_from(buffer)
+
+    if ndim == 0:
+        return np.empty(0, dtype=np.float32)
+
+    if ndim != 1 or has_nulls or oid != _PG_FLOAT4_OID:
+        raise ValueError("Only one-dimensional real[] without NULLs is supported.")
+
+    size, _ = _PG_ARRAY_DIM.unpack_from(buffer, _PG_ARRAY_HEADER.size)
+
+    elements = np.frombuffer(
+        buffer,
+        dtype=[("length", ">i4"), ("value", ">f4")],
+        count=size,
+        offset=_PG_ARRAY_HEADER.size + _PG_ARRAY_DIM.size,
+    )
+
+    return elements["value"].astype(np.float32)
+
+
+class FloatArray(UserDefinedType):
+    """
+    Represent a point as a float32 array (real[]).
+
+    Unlike Point, the number of dimensions is not limited.
+    Values are read in the binary format of array_send
+    and decoded directly with NumPy.
+
+    The vector_dist function (see VECTOR_DIST_FUNCTION) is only meant for ad-hoc queries,
+    as it is much slower than the <-> operator of CUBE.
+    Tree.recommend_objects calculates the distances of real[] vectors in-process.
+    """
+
+    def get_col_spec(self, **kw):
+        return "REAL[]"
+
+    def bind_expression(self, bindvalue):
+        return cast(bindvalue, ARRAY(REAL))
+
+    def column_expression(self, col):
+        return func.array_send(col, type_=self)
+
+    def bind_processor(self, dialect):
+        def process(value):
+            # NULL
+            if value is None:
+                return None
+
+            return [float(v) for v in value]
+
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            # NULL
+            if value is None:
+                return None
+
+            if isinstance(value, (bytes, memoryview)):
+                return decode_pg_float_array(value)
+
+            return np.asarray(value, dtype=np.float32)
+
+        return process
+
+    class Comparator(TypeEngine.Comparator):
+        def dist_euclidean(self, other):
+            return func.vector_dist(
+                self.expr, literal(other, type_=self.type), type_=Float
+            )
+
+    comparator_factory = Comparator
+
+    # Statements using this type are safe to cache.
+    cache_ok = True
+
+
+class BinaryArray(TypeDecorator):
+    """
+    Store a numpy array in a compact binary format (see encode_array).
+
+    Parameters:
+        dtype: Data type of the stored values.
+    """
+
+    impl = LargeBinary
+
+    cache_ok = True
+
+    def __init__(self, dtype="float32"):
+        self.dtype = dtype
+
+        super().__init__()
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return encode_array(value, self.dtype)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        return decode_array(value)[0]
+
+
+class BinaryPrototypes(TypeDecorator):
+    """
+    Store a Prototypes object in a compact binary format (see encode_prototypes).
+    """
+
+    impl = LargeBinary
+
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return encode_prototypes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        return decode_prototypes(value)
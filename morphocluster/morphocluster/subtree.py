@@ -0,0 +1,208 @@
+"""
+Compact in-memory representation of a (sub)tree for bottom-up aggregation.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _concat_ranges(starts, stops):
+    """
+    Concatenate the ranges [starts[i], stops[i]) into one integer array.
+    """
+    lengths = stops - starts
+    n_total = lengths.sum()
+
+    if n_total == 0:
+        return np.empty(0, dtype=np.intp)
+
+    # Offset of each range in the result
+    offsets = np.cumsum(lengths) - lengths
+
+    return np.repeat(starts - offsets, lengths) + np.arange(n_total)
+
+
+class Subtree:
+    """
+    A subtree with nodes stored in rows.
+
+    Node ids are mapped to row positions and the children of each row are
+    stored in CSR format: The children of row i are
+    ``children[offsets[i]:offsets[i + 1]]``.
+
+    Nodes whose parent is not part of the subtree are roots.
+
+    Parameters:
+        node_ids: Sequence of node ids.
+        parent_ids: Sequence of parent ids (same length as node_ids).
+
+    Attributes:
+        node_ids: Array of node ids (one per row).
+        parent_rows: Row of the parent of each row (-1 for roots).
+        offsets: Array of length n_nodes + 1.
+        children: Rows of the children, grouped by parent row.
+        levels: List of arrays of rows, one per level, starting with the roots.
+    """
+
+    def __init__(self, node_ids, parent_ids):
+        self.node_ids = np.asarray(node_ids)
+        self._index = pd.Index(self.node_ids)
+
+        if not self._index.is_unique:
+            raise ValueError("node_ids are not unique")
+
+        n_nodes = len(self.node_ids)
+
+        # Parents outside of the subtree (or NULL) are mapped to -1
+        self.parent_rows = self._index.get_indexer(pd.Index(parent_ids))
+
+        # Group children by parent row (roots come first and are dropped)
+        order = np.argsort(self.parent_rows, kind="stable")
+        n_roots = np.count_nonzero(self.parent_rows < 0)
+        self.children = order[n_roots:]
+
+        n_children = np.bincount(self.parent_rows[order[n_roots:]], minlength=n_nodes)
+        self.offsets = np.zeros(n_nodes + 1, dtype=np.intp)
+        np.cumsum(n_children, out=self.offsets[1:])
+
+        # Breadth-first traversal from the roots
+        self.levels = []
+        level = order[:n_roots]
+        while len(level):
+            self.levels.append(level)
+            level = self.children[
+                _concat_ranges(self.offsets[level], self.offsets[level + 1])
+            ]
+
+        if sum(len(l) for l in self.levels) != n_nodes:
+            raise ValueError("Subtree contains a cycle")
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def n_children(self):
+        """Number of children of each row."""
+        return np.diff(self.offsets)
+
+    def get_rows(self, node_ids):
+        """
+        Map node ids to rows.
+
+        Raises:
+            KeyError if a node is not part of the subtree.
+        """
+        rows = self._index.get_indexer(pd.Index(node_ids))
+
+        if (rows < 0).any():
+            raise KeyError(
+                "Unknown nodes: {}".format(list(np.asarray(node_ids)[rows < 0]))
+            )
+
+        return rows
+
+    def get_row(self, node_id):
+        """Map a single node id to its row."""
+        return self._index.get_loc(node_id)
+
+    def child_rows(self, row):
+        """Rows of the children of a single row."""
+        return self.children[self.offsets[row] : self.offsets[row + 1]]
+
+    def sum_children(self, values, rows=None):
+        """
+        Sum the values of the children of each row.
+
+        Parameters:
+            values: Array with one entry per row.
+            rows: Rows for which the sums are calculated (default: all).
+
+        Returns:
+            Array of child sums (one per requested row).
+        """
+        values = np.asarray(values)
+
+        if rows is None:
+            starts, stops = self.offsets[:-1], self.offsets[1:]
+        else:
+            rows = np.asarray(rows)
+            starts, stops = self.offsets[rows], self.offsets[rows + 1]
+
+        child_rows = _concat_ranges(starts, stops)
+
+        # Segment of each child in the result
+        segments = np.repeat(np.arange(len(starts)), stops - starts)
+
+        result = np.zeros((len(starts),) + values.shape[1:], dtype=values.dtype)
+        np.add.at(result, segments, values[self.children[child_rows]])
+
+        return result
+
+    def accumulate(self, values, combine=np.add):
+        """
+        Aggregate values bottom-up.
+
+        For each row, ``result[i] = combine(values[i], sum(result[children of i]))``.
+        The default computes deep sums.
+
+        Parameters:
+            values: Array with one entry per row.
+            combine: Binary ufunc (e.g. np.add or np.maximum).
+
+        Returns:
+            Array of deep values.
+        """
+        values = np.asarray(values)
+        result = values.copy()
+        child_sums = np.zeros_like(values)
+
+        for level in reversed(self.levels):
+            result[level] = combine(values[level], child_sums[level])
+
+            parents = self.parent_rows[level]
+            mask = parents >= 0
+            np.add.at(child_sums, parents[mask], result[level[mask]])
+
+        return result
+
+
+if __name__ in ("builtins", "__main__"):
+    from timer_cm import Timer
+
+    # Benchmark on a synthetic tree with 200k nodes
+    n_nodes = 200000
+    n_naive = 5000
+
+    rng = np.random.default_rng(0)
+
+    # Random recursive tree: Each node is attached to an earlier node
+    node_ids = np.arange(n_nodes) + 1000
+    parent_ids = np.empty(n_nodes, dtype=np.int64)
+    parent_ids[0] = -1
+    parent_ids[1:] = node_ids[
+        (rng.random(n_nodes - 1) * np.arange(1, n_nodes)).astype(int)
+    ]
+
+    n_objects = rng.integers(0, 100, n_nodes)
+
+    with Timer("Subtree ({:d} nodes)".format(n_nodes)) as t:
+        with t.child("__init__"):
+            subtree = Subtree(node_ids, parent_ids)
+
+        with t.child("accumulate"):
+            n_objects_deep = subtree.accumulate(n_objects)
+
+        with t.child("sum_children"):
+            subtree.sum_children(n_objects_deep)
+
+    assert n_objects_deep[subtree.get_row(node_ids[0])] == n_objects.sum()
+    print("Depth:", len(subtree.levels))
+
+    # Per-node masking (previous implementation) on the first nodes only
+    df = pd.DataFrame(
+        {"parent_id": parent_ids[:n_naive], "n_objects": n_objects[:n_naive]},
+        index=node_ids[:n_naive],
+    )
+    with Timer("Masking ({:d} nodes)".format(n_naive)):
+        for nid in df.index:
+            df.loc[df["parent_id"] == nid, "n_objects"].sum()
@@ -0,0 +1,227 @@
+"""
+In-memory snapshot of the shape of a project tree.
+
+Navigation asks the same structural questions over and over
+(ancestors, descendants, the deepest unapproved node, ...).
+A snapshot answers them without SQL and is rebuilt when the project version changes.
+"""
+
+import threading
+
+import numpy as np
+
+from morphocluster.subtree import Subtree, _concat_ranges
+
+
+class Topology(Subtree):
+    """
+    Snapshot of the shape of a project tree.
+
+    In addition to the parent array and the children in CSR format (see Subtree),
+    the rows are numbered in pre-order (Euler tour),
+    so that the subtree of a row is a contiguous interval.
+
+    Parameters:
+        node_ids, parent_ids: See Subtree.
+        approved, starred: Flags of the nodes (one per row).
+        version: Project version of the snapshot.
+
+    Attributes:
+        depth: Depth of each row (0 for roots).
+        tin: Pre-order position of each row.
+        tout: End of the subtree interval of each row: The subtree of row i
+            consists of the rows preorder[tin[i]:tout[i]].
+        preorder: Rows in pre-order.
+    """
+
+    def __init__(self, node_ids, parent_ids, approved, starred, version=None):
+        super().__init__(node_ids, parent_ids)
+
+        self.approved = np.asarray(approved, dtype=bool)
+        self.starred = np.asarray(starred, dtype=bool)
+        self.version = version
+
+        n_nodes = len(self.node_ids)
+
+        self.depth = np.empty(n_nodes, dtype=np.intp)
+        for depth, level in enumerate(self.levels):
+            self.depth[level] = depth
+
+        size = self.accumulate(np.ones(n_nodes, dtype=np.intp))
+
+        # Pre-order positions, top-down:
+        # A child starts after its parent and the subtrees of its previous siblings.
+        self.tin = np.empty(n_nodes, dtype=np.intp)
+
+        if self.levels:
+            roots = self.levels[0]
+            self.tin[roots] = np.cumsum(size[roots]) - size[roots]
+
+        for level in self.levels[:-1]:
+            n_children = self.offsets[level + 1] - self.offsets[level]
+            child_rows = self.children[
+                _concat_ranges(self.offsets[level], self.offsets[level + 1])
+            ]
+
+            if not len(child_rows):
+                continue
+
+            # Size of the previous siblings (exclusive sum within each segment)
+            preceding = np.cumsum(size[child_rows]) - size[child_rows]
+            segment_starts = np.cumsum(n_children) - n_children
+            nonempty = n_children > 0
+            preceding -= np.repeat(preceding[segment_starts[nonempty]], n_children[nonempty])
+
+            self.tin[child_rows] = np.repeat(self.tin[level] + 1, n_children) + preceding
+
+        self.tout = self.tin + size
+
+        self.preorder = np.empty(n_nodes, dtype=np.intp)
+        self.preorder[self.tin] = np.arange(n_nodes)
+
+    def path_ids(self, node_id):
+        """
+        Node ids from the root to node_id.
+        """
+        row = self.get_row(node_id)
+
+        path = []
+        while row >= 0:
+            path.append(row)
+            row = self.parent_rows[row]
+
+        return self.node_ids[path[::-1]].tolist()
+
+    def subtree_rows(self, row):
+        """
+        Rows of the subtree of row (in pre-order, starting with row).
+        """
+        return self.preorder[self.tin[row] : self.tout[row]]
+
+    def n_descendants(self, node_id):
+        """
+        Number of nodes in the subtree of node_id (including node_id).
+        """
+        row = self.get_row(node_id)
+        return int(self.tout[row] - self.tin[row])
+
+    def is_descendant(self, node_id, ancestor_id):
+        """
+        Is node_id in the subtree of ancestor_id? (O(1))
+        """
+        row, ancestor = self.get_row(node_id), self.get_row(ancestor_id)
+        return bool(self.tin[ancestor] <= self.tin[row] < self.tout[ancestor])
+
+    def _reachable(self, row, blocked):
+        """
+        Rows of the subtree of row that are not separated from row by a blocked node
+        (blocked nodes themselves are excluded, row itself is always included).
+
+        Returns:
+            (rows, mask) where rows is the subtree in pre-order.
+        """
+        start = self.tin[row]
+        rows = self.subtree_rows(row)
+
+        # Every blocked descendant covers its whole subtree interval
+        blocked_rows = rows[1:][blocked[rows[1:]]]
+        coverage = np.zeros(len(rows) + 1, dtype=np.intp)
+        np.add.at(coverage, self.tin[blocked_rows] - start, 1)
+        np.add.at(coverage, self.tout[blocked_rows] - start, -1)
+
+        return rows, np.cumsum(coverage[:-1]) == 0
+
+    def deepest(self, node_id, blocked, candidates):
+        """
+        Find the deepest candidate below node_id (or node_id itself)
+        that is not separated from node_id by a blocked node.
+
+        Parameters:
+            blocked, candidates: Boolean arrays with one entry per row.
+
+        Returns:
+            node_id or None. Ties are broken by the pre-order.
+        """
+        rows, mask = self._reachable(self.get_row(node_id), blocked)
+        rows = rows[mask & candidates[rows]]
+
+        if not len(rows):
+            return None
+
+        return int(self.node_ids[rows[np.argmax(self.depth[rows])]])
+
+    def tip(self, node_id):
+        """
+        Deepest node with children below node_id that is only separated
+        from node_id by unapproved and unstarred nodes (see Tree.get_tip).
+        """
+        return self.deepest(
+            node_id, self.approved | self.starred, self.n_children > 0
+        )
+
+    def next_unapproved(self, node_id, leaf=False):
+        """
+        Deepest unapproved node below node_id that is only separated
+        from node_id by unapproved nodes.
+        If there is none, the parent of node_id is tried.
+
+        Parameters:
+            leaf: Only return leaves.
+        """
+        candidates = ~self.approved
+        if leaf:
+            candidates = candidates & (self.n_children == 0)
+
+        row = self.get_row(node_id)
+        while row >= 0:
+            result = self.deepest(self.node_ids[row], self.approved, candidates)
+            if result is not None:
+                return result
+            row = self.parent_rows[row]
+
+        return None
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_topology(project_id, version, load):
+    """
+    Get the snapshot of a project, rebuilding it if the project version changed.
+
+    Every process keeps one snapshot per project.
+
+    Parameters:
+        load: Function that returns (node_ids, parent_ids, approved, starred) of the project.
+    """
+
+    with _cache_lock:
+        topology = _cache.get(project_id)
+
+    if topology is not None and topology.version == version:
+        return topology
+
+    topology = Topology(*load(), version=version)
+
+    # Versions are not ordered: The last loaded snapshot wins.
+    # An outdated snapshot is replaced by the next call.
+    with _cache_lock:
+        _cache[project_id] = topology
+
+    return topology
+
+
+def invalidate(invalidation):
+    """
+    Drop the snapshots of modified projects (subscriber of notify.InvalidationListener).
+
+    This only frees memory early, as get_topology compares the versions anyway.
+    """
+
+    with _cache_lock:
+        if invalidation.project_id is None:
+            _cache.clear()
+            return
+
+        _cache.pop(invalidation.project_id, None)
@@ -3,7 +3,11 @@ Created on 13.03.2018
 
 @author: mschroeder
 """
+import collections
+import concurrent.futures
 import csv
+import functools
+import heapq
 import itertools
 import os
 import warnings
@@ -13,13 +17,17 @@ from typing import Iterable, Mapping, Optional
 import numpy as np
 import pandas as pd
 from etaprogress.progress import ProgressBar
+from flask import current_app, has_app_context
 from genericpath import commonprefix
-from sklearn.cluster import KMeans
+from sqlalchemy import BigInteger, String, any_
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import literal_column
-from sqlalchemy.sql.expression import bindparam, literal, select
+from sqlalchemy.sql.expression import bindparam, cast, literal, select, union_all
 from sqlalchemy.sql.functions import coalesce, func
+from threadpoolctl import threadpool_limits
 from timer_cm import Timer
 from tqdm import tqdm
 
@@ -32,14 +40,72 @@ from morphocluster.models import (
     nodes,
     nodes_objects,
     nodes_rejected_objects,
+    nodes_samples,
+    nodes_version_seq,
     objects,
     projects,
 )
-from morphocluster.processing.prototypes import Prototypes, merge_prototypes
+from morphocluster.notify import notify
+from morphocluster.processing.ann import IVFIndex, load_index
+from morphocluster.processing.distance import top_k_min_distances
+from morphocluster.processing.prototypes import (
+    Prototypes,
+    adaptive_k,
+    fit_prototypes,
+    merge_prototypes,
+)
+from morphocluster.sql.bulk import bulk_update
+from morphocluster.subtree import Subtree
+from morphocluster.topology import get_topology
+from morphocluster.vector_store import VectorStore, load_vector_store
 
-# TODO: Make N_PROTOTYPES configurable
+#: Default maximum number of prototypes per node
+#: (overridden by the N_PROTOTYPES config value and projects.n_prototypes)
 N_PROTOTYPES = 16
 
+#: Size of the persisted object sample of a node (see nodes_samples)
+SAMPLE_SIZE = 1000
+
+
+#: High bits of the advisory lock keys of nodes.
+#: Project locks use the project_id as key, so node keys never collide with them.
+_NODE_LOCK_NAMESPACE = 0x4E4F << 48
+
+
+def _node_lock_key(node_id):
+    """
+    Advisory lock key of a node.
+
+    Every node has its own key, so the top-down lock order of lock_subtree holds.
+    """
+    node_id = int(node_id)
+
+    if not 0 <= node_id < 1 << 48:
+        raise TreeError("Node ID {} out of range for advisory locks.".format(node_id))
+
+    return _NODE_LOCK_NAMESPACE | node_id
+
+
+def _get_config(key, default):
+    """
+    Get a value from the app config or default outside of an app context.
+    """
+    if has_app_context():
+        return current_app.config.get(key, default)
+    return default
+
+
+def _vector_column():
+    """
+    Get the column that stores the object vectors according to VECTOR_STORAGE.
+
+    "cube": objects.vector (CUBE, at most 100 dimensions).
+    "array": objects.vector_array (real[], unlimited).
+    """
+    if _get_config("VECTOR_STORAGE", "cube") == "array":
+        return objects.c.vector_array
+    return objects.c.vector
+
 
 class TreeError(Exception):
     """
@@ -101,24 +167,38 @@ def _rquery_preds(node_id):
     `level`.
 
     `level` is 0 for the supplied `node_id` and decreases for each predecessor.
+
+    The predecessors are read from the materialized path of node_id.
     """
-    # Start with the last child
-    query = (
-        select([nodes, literal(0).label("level")])
-        .where(nodes.c.node_id == node_id)
-        .cte(recursive=True)
+    path = select([nodes.c.path]).where(nodes.c.node_id == node_id).as_scalar()
+
+    level = func.array_position(path, nodes.c.node_id) - func.array_length(path, 1)
+
+    return (
+        select([nodes, level.label("level")])
+        .where(nodes.c.node_id == any_(path))
         .alias("q")
     )
 
-    preds = nodes.alias("p")
 
-    query = query.union_all(
-        select([preds, literal_column("level") - 1]).where(
-            query.c.parent_id == preds.c.node_id
-        )
+def _query_subtree(node_id):
+    """
+    Constructs a selectable for the subtree rooted at node_id
+    with all columns of `nodes` and an additional `level` (like _rquery_subtree).
+
+    The subtree is found using the materialized path (a single lookup in ix_nodes_path).
+    """
+    node_id = cast(node_id, BigInteger)
+
+    level = func.array_length(nodes.c.path, 1) - func.array_position(
+        nodes.c.path, node_id
     )
 
-    return query
+    return (
+        select([nodes, level.label("level")])
+        .where(nodes.c.path.contains(array([node_id])))
+        .alias("q")
+    )
 
 
 def _rquery_subtree(node_id, recurse_cb=None):
@@ -132,6 +212,8 @@ def _rquery_subtree(node_id, recurse_cb=None):
     Parameters:
         recurse_cb: A callback with two parameters (q, s). q is the recursive query, s is the successor.
             The callback must return a clause that can be used in where().
+
+    Without recurse_cb, _query_subtree is faster.
     """
     q = (
         select([nodes, literal(0).label("level")])
@@ -159,6 +241,285 @@ def _compute_flags(mapping: Mapping, names: Iterable[str]):
     }
 
 
+# Fields of a child that are required to calculate the cached values of its parent
+_CHILD_FIELDS = [
+    "node_id",
+    "_centroid",
+    "_vector_sum",
+    "_prototypes",
+    "_type_objects",
+    "_n_objects_deep",
+]
+
+# Fields that are written back to the database after consolidation
+_CONSOLIDATED_FIELDS = [
+    "cache_valid",
+    "_centroid",
+    "_vector_sum",
+    "_prototypes",
+    "_own_prototypes",
+    "_type_objects",
+    "_own_type_objects",
+    "_n_objects_deep",
+    "_n_objects",
+    "_n_children",
+]
+
+
+def _get_vector_sum(node):
+    """
+    Get the sum of the vectors of all objects below a node.
+
+    For nodes that were consolidated before _vector_sum was introduced,
+    the sum is derived from _centroid and _n_objects_deep.
+
+    Returns:
+        The vector sum or None, if it is unknown.
+    """
+    if node["_vector_sum"] is not None:
+        return node["_vector_sum"]
+
+    if node["_centroid"] is not None and pd.notnull(node["_n_objects_deep"]):
+        return node["_centroid"] * node["_n_objects_deep"]
+
+    return None
+
+
+class _CacheDelta:
+    """
+    Change of the additive cached values of a node caused by a relocation.
+    """
+
+    __slots__ = ("n_objects", "n_children", "n_objects_deep", "vector_sum")
+
+    def __init__(self):
+        self.n_objects = 0
+        self.n_children = 0
+        self.n_objects_deep = 0
+        self.vector_sum = 0
+
+
+def _add_transfer_deltas(deltas, dst_path, src_path, n_objects, vector_sum):
+    """
+    Record the transfer of `n_objects` objects with a total of `vector_sum`
+    from the last node of `src_path` to the last node of `dst_path`.
+
+    Both paths start at the common ancestor (see _paths_from_common_ancestor)
+    whose deep values are unaffected.
+
+    Parameters:
+        deltas: defaultdict(_CacheDelta)
+    """
+
+    for node_id in dst_path[1:]:
+        deltas[node_id].n_objects_deep += n_objects
+        deltas[node_id].vector_sum = deltas[node_id].vector_sum + vector_sum
+
+    for node_id in src_path[1:]:
+        deltas[node_id].n_objects_deep -= n_objects
+        deltas[node_id].vector_sum = deltas[node_id].vector_sum - vector_sum
+
+
+def _calc_type_objects(children, object_ids):
+    """
+    Calculate nine type objects for a node as
+        a) a sample of nine type objects from its children, or
+        b) nine of its own objects, if the node is a leaf.
+    """
+    if len(children) > 0:
+        # Randomly subsample children
+        subsample = np.random.choice(children, min(len(children), 9), replace=False)
+        result = list(
+            itertools.islice(_roundrobin([c["_type_objects"] for c in subsample]), 9)
+        )
+
+        if len(result) == 0:
+            print("\n", subsample)
+
+        return result
+    else:
+        return list(object_ids[:9])
+
+
+def _calc_own_type_objects(children, object_ids, object_vectors):
+    """
+    Calculate nine own type objects for a node as
+        a) the nine objects with maximum distance to the children, or
+        b) [], if the node is a leaf.
+    """
+
+    if len(children) > 0 and len(object_ids) > 0:
+        try:
+            classifier = Classifier(children.vectors)
+            distances = classifier.distances(object_vectors)
+            max_dist = np.max(distances, axis=0)
+            max_dist_idx = np.argsort(max_dist)[::-1]
+
+            assert len(max_dist_idx) == len(object_ids), "{} != {}".format(
+                len(max_dist_idx), len(object_ids)
+            )
+
+            return [object_ids[i] for i in max_dist_idx[:9]]
+
+        except:
+            print("child_vectors", children.vectors.shape)
+            print("object_vectors", object_vectors.shape)
+            raise
+
+    else:
+        return []
+
+
+def _init_consolidation_worker():
+    """
+    Restrict native thread pools (BLAS, OpenMP) of a consolidation worker process
+    to a single thread so that parallel workers do not oversubscribe the CPU.
+    """
+    threadpool_limits(1)
+
+
+def _consolidate_values(
+    node_id,
+    n_objects,
+    children,
+    object_ids,
+    object_vectors,
+    n_prototypes,
+    init_prototypes=None,
+):
+    """
+    Calculate the cached values of a single node.
+
+    The result only depends on the arguments, so that nodes can be processed
+    in worker processes.
+
+    Parameters:
+        node_id: ID of the node (only used for diagnostic messages).
+        n_objects: Number of objects directly below the node.
+        children: List of dicts of children with valid cached values (see _CHILD_FIELDS).
+        object_ids: IDs of (a sample of) the objects directly below the node.
+        object_vectors: Array of shape = [len(object_ids), n_features].
+        n_prototypes: Maximum number of prototypes.
+            The actual number is scaled down for small nodes (see adaptive_k).
+        init_prototypes: Previous prototypes of the objects of the node
+            (_own_prototypes) to warm-start the fit.
+
+    Returns:
+        dict of _own_type_objects, _type_objects, _vector_sum, _centroid,
+        _prototypes and _own_prototypes.
+    """
+
+    # Build collection of children. (Set centroid of children without a vector to zero to allow alignment with cardinalities.)
+    children = MemberCollection(children, "zero")
+
+    result = {}
+
+    # _own_type_objects, _type_objects
+    # TODO: Replace _own_type_objects with "_atypical_objects"
+    result["_own_type_objects"] = _calc_own_type_objects(
+        children, object_ids, object_vectors
+    )
+    result["_type_objects"] = _calc_type_objects(children, object_ids)
+
+    if len(children) > 0 and len(result["_type_objects"]) == 0:
+        print("\nNode {} has no type objects although it has children!".format(node_id))
+
+    # _vector_sum, _centroid
+    _vector_sum = []
+    _centroid_support = 0
+
+    if len(object_ids) > 0:
+        # Sum of all own objects, extrapolated from the sample
+        _vector_sum.append(np.mean(object_vectors, axis=0) * n_objects)
+        _centroid_support += n_objects
+
+    if len(children) > 0:
+        # Sum of the children (Children without a vector count as zero.)
+        _vector_sum.extend(
+            v for v in (_get_vector_sum(c) for c in children) if v is not None
+        )
+        _centroid_support += children.cardinalities.sum()
+
+    if len(_vector_sum) > 0 and _centroid_support > 0:
+        result["_vector_sum"] = np.sum(_vector_sum, axis=0)
+        result["_centroid"] = result["_vector_sum"] / _centroid_support
+    else:
+        result["_vector_sum"] = None
+        result["_centroid"] = None
+        print("\nNode {} has no centroid!".format(node_id))
+
+    # _prototypes
+    _prototypes = []
+    n_objects_deep = n_objects + (
+        children.cardinalities.sum() if len(children) > 0 else 0
+    )
+
+    if len(object_ids) > 0:
+        # The merged prototypes of inner nodes are dominated by the children,
+        # so only the prototypes of the own objects are used as a warm start.
+        result["_own_prototypes"] = fit_prototypes(
+            object_vectors,
+            adaptive_k(n_objects, n_prototypes),
+            init=init_prototypes,
+        )
+        _prototypes.append(result["_own_prototypes"])
+    else:
+        result["_own_prototypes"] = None
+    if len(children) > 0:
+        _prototypes.extend(
+            c["_prototypes"] for c in children if c["_prototypes"] is not None
+        )
+
+    if len(_prototypes) > 0:
+        try:
+            result["_prototypes"] = merge_prototypes(
+                _prototypes, adaptive_k(n_objects_deep, n_prototypes)
+            )
+        except:
+            for prots in _prototypes:
+                print(prots.prototypes_)
+            raise
+    else:
+        result["_prototypes"] = None
+        print("\nNode {} has no prototypes!".format(node_id))
+
+    return result
+
+
+class _ObjectSamples:
+    """
+    Samples of objects for a number of nodes.
+
+    The vectors of all samples are stored in one array where the objects of
+    each node occupy a contiguous block.
+
+    Parameters:
+        node_ids: Array of node IDs, one per object, sorted by node.
+        object_ids: Array of object IDs.
+        vectors: Array of shape = [len(object_ids), n_features].
+    """
+
+    def __init__(self, node_ids, object_ids, vectors):
+        self.object_ids = object_ids
+        self.vectors = vectors
+
+        unique_node_ids, starts = np.unique(node_ids, return_index=True)
+        stops = np.append(starts[1:], len(node_ids))
+        self._blocks = {
+            int(n): (int(start), int(stop))
+            for n, start, stop in zip(unique_node_ids, starts, stops)
+        }
+
+    def __getitem__(self, node_id):
+        """Return object_ids and vectors of the sample of a node."""
+        try:
+            start, stop = self._blocks[node_id]
+        except KeyError:
+            return self.object_ids[:0], self.vectors[:0]
+
+        return self.object_ids[start:stop], self.vectors[start:stop]
+
+
 class Tree(object):
     """
     A tree as represented by the database.
@@ -309,11 +670,20 @@ class Tree(object):
             return 0
         return result + 1
 
-    def lock_project(self, project_id):
+    def lock_project(self, project_id, shared=False):
         """
         Acquire advisory transaction lock for a project.
+
+        Parameters:
+            shared (bool): Acquire a shared (intent) lock (see lock_subtree).
+                An exclusive lock waits for all running modifications of the project.
         """
-        return self.connection.execute(select([func.pg_advisory_xact_lock(project_id)]))
+        if shared:
+            lock = func.pg_advisory_xact_lock_shared(project_id)
+        else:
+            lock = func.pg_advisory_xact_lock(project_id)
+
+        return self.connection.execute(select([lock]))
 
     def lock_project_for_node(self, node_id):
         """
@@ -324,6 +694,91 @@ class Tree(object):
         )
         return self.lock_project(project_id)
 
+    def lock_subtree(self, node_ids):
+        """
+        Acquire advisory transaction locks for the smallest subtree that contains the provided nodes.
+
+        The root of the subtree (the common ancestor of the nodes) is locked exclusively.
+        The project and the ancestors of the root are locked in shared mode (intent locks), top-down.
+        Modifications of disjoint subtrees therefore proceed in parallel,
+        while a modification waits for running modifications above or below the root of its subtree
+        and for exclusive project locks (see lock_project).
+
+        Returns:
+            node_id of the root of the locked subtree.
+        """
+
+        node_ids = set(int(n) for n in node_ids)
+
+        if not node_ids:
+            return None
+
+        while True:
+            path = self._get_common_path(node_ids)
+
+            # Locks taken after a savepoint are released when it is rolled back
+            savepoint = self.connection.begin_nested()
+
+            try:
+                self._lock_path(path)
+
+                # The nodes might have been moved by the modification we were waiting for.
+                if self._get_common_path(node_ids) == path:
+                    savepoint.commit()
+                    return path[-1]
+            except:
+                savepoint.rollback()
+                raise
+
+            # Release the locks and start over, so that all locks are taken top-down
+            savepoint.rollback()
+
+    def _get_common_path(self, node_ids):
+        """
+        Get the path of the common ancestor of the nodes.
+        """
+
+        paths = self.get_paths(node_ids)
+
+        unknown = node_ids - set(paths)
+        if unknown:
+            raise TreeError("Nodes {} are unknown.".format(sorted(unknown)))
+
+        path = tuple(commonprefix(list(paths.values())))
+
+        if not path:
+            raise TreeError("Nodes {} have no common ancestor.".format(sorted(node_ids)))
+
+        return path
+
+    def _lock_path(self, path):
+        """
+        Lock the last node of path exclusively and the project and all other nodes in shared mode.
+        """
+
+        project_id = self.connection.execute(
+            select([nodes.c.project_id]).where(nodes.c.node_id == path[-1])
+        ).scalar()
+
+        self.lock_project(project_id, shared=True)
+
+        node_keys = [_node_lock_key(n) for n in path]
+
+        stmt = text(
+            """
+        SELECT  pg_advisory_xact_lock_shared(k)
+        FROM    (
+            SELECT  k
+            FROM    unnest(CAST(:node_keys AS BIGINT[])) WITH ORDINALITY AS t(k, i)
+            ORDER BY i
+        ) AS ordered_keys
+        """
+        )
+        self.connection.execute(stmt, node_keys=node_keys[:-1])
+
+        stmt = text("SELECT pg_advisory_xact_lock(CAST(:node_key AS BIGINT))")
+        self.connection.execute(stmt, node_key=node_keys[-1])
+
     def __load_project_old(self, name, path, root_first=True):
         tree_fn = os.path.join(path, "tree.csv")
         objids_fn = os.path.join(path, "objids.csv")
@@ -405,7 +860,7 @@ class Tree(object):
 
     def connect_supertree(self, root_id):
         with self.connection.begin():
-            successors = _rquery_subtree(root_id)
+            successors = _query_subtree(root_id)
 
             supersuccessor_ids = select([successors.c.node_id]).where(
                 successors.c.starred == True
@@ -443,21 +898,14 @@ class Tree(object):
             print()
 
     def get_objects_recursive(self, node_id):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(nodes.c.node_id == node_id).cte(recursive=True)
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
-
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id)
-        )
+        # Select all descendants
+        subtree = _query_subtree(node_id)
 
-        # For each node in rquery, get associated objects
+        # For each node in the subtree, get associated objects
         obj_query = (
             select([objects])
             .distinct()
-            .select_from(rquery.join(nodes_objects).join(objects))
+            .select_from(subtree.join(nodes_objects).join(objects))
         )
 
         result = self.connection.execute(obj_query)
@@ -483,68 +931,42 @@ class Tree(object):
                 subtree = pd.read_sql_query(
                     subtree, self.connection, index_col="node_id") """
 
-            subtree["n_approved_objects"] = (
-                subtree["approved"] * subtree["_n_objects_deep"]
-            )
-            subtree["n_filled_objects"] = subtree["filled"] * subtree["_n_objects_deep"]
-            subtree["n_named_objects"] = (
-                pd.notna(subtree["name"]) * subtree["_n_objects_deep"]
-            )
-            subtree["n_approved_nodes"] = subtree["approved"].astype(int)
-            subtree["n_filled_nodes"] = subtree["filled"].astype(int)
-            subtree["n_nodes"] = 1
-
-            fields = [
-                "_n_objects",
-                "_n_objects_deep",
-                "n_filled_objects",
-                "n_approved_objects",
-                "n_named_objects",
-                "n_approved_nodes",
-                "n_filled_nodes",
-                "n_nodes",
-            ]
+            index = Subtree(subtree.index, subtree["parent_id"])
+
+            approved = subtree["approved"].to_numpy(dtype=bool)
+            filled = subtree["filled"].to_numpy(dtype=bool)
+            n_objects_deep = subtree["_n_objects_deep"].to_numpy(dtype=np.int64)
+
+            values = {
+                "_n_objects": subtree["_n_objects"].to_numpy(dtype=np.int64),
+                "_n_objects_deep": n_objects_deep,
+                "n_filled_objects": filled * n_objects_deep,
+                "n_approved_objects": approved * n_objects_deep,
+                "n_named_objects": pd.notna(subtree["name"]).to_numpy()
+                * n_objects_deep,
+                "n_approved_nodes": approved.astype(np.int64),
+                "n_filled_nodes": filled.astype(np.int64),
+                "n_nodes": np.ones(len(subtree), dtype=np.int64),
+            }
 
             # Leaves
-            leaves_mask = subtree["_n_children"] == 0
-            leaves_result = subtree.loc[leaves_mask, fields].sum(axis=0).to_dict()
+            leaves_mask = subtree["_n_children"].to_numpy() == 0
             leaves_result = {
-                "leaves_{}".format(k.lstrip("_")): v for k, v in leaves_result.items()
+                "leaves_{}".format(k.lstrip("_")): int(v[leaves_mask].sum())
+                for k, v in values.items()
             }
 
-            # Compute deep values for root
-            # subtree is ordered deep-first
+            # Compute deep values bottom-up
             with t.child("deep stats"):
-                for nid in subtree.index:
-                    child_selector = subtree["parent_id"] == nid
-
-                    subtree.at[nid, "n_approved_objects"] = max(
-                        subtree.at[nid, "n_approved_objects"],
-                        subtree.loc[child_selector, "n_approved_objects"].sum(),
-                    )
-
-                    subtree.at[nid, "n_named_objects"] = max(
-                        subtree.at[nid, "n_named_objects"],
-                        subtree.loc[child_selector, "n_named_objects"].sum(),
-                    )
-
-                    subtree.at[nid, "n_approved_nodes"] = (
-                        subtree.at[nid, "n_approved_nodes"]
-                        + subtree.loc[child_selector, "n_approved_nodes"].sum()
-                    )
-
-                    subtree.at[nid, "n_filled_nodes"] = (
-                        subtree.at[nid, "n_filled_nodes"]
-                        + subtree.loc[child_selector, "n_filled_nodes"].sum()
-                    )
+                # Objects below approved / named nodes are only counted once
+                for k in ("n_approved_objects", "n_named_objects"):
+                    values[k] = index.accumulate(values[k], np.maximum)
 
-                    subtree.at[nid, "n_nodes"] = (
-                        subtree.at[nid, "n_nodes"]
-                        + subtree.loc[child_selector, "n_nodes"].sum()
-                    )
+                for k in ("n_approved_nodes", "n_filled_nodes", "n_nodes"):
+                    values[k] = index.accumulate(values[k])
 
-            deep_result = subtree.loc[node_id, fields].to_dict()
-            deep_result = {k.lstrip("_"): v for k, v in deep_result.items()}
+            row = index.get_row(node_id)
+            deep_result = {k.lstrip("_"): int(v[row]) for k, v in values.items()}
 
             return dict(**leaves_result, **deep_result)
 
@@ -553,8 +975,8 @@ class Tree(object):
         Generate a processing.Tree from the tree below root_id.
         """
         with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(root_id)
+            # Acquire subtree lock
+            self.lock_subtree([root_id])
 
             # Get complete subtree with up to date cached values
             print("Consolidating cached values...")
@@ -575,7 +997,7 @@ class Tree(object):
 
             print("Getting objects...")
             # Get subtree below root
-            subtree = _rquery_subtree(root_id)
+            subtree = _query_subtree(root_id)
 
             # Get object IDs for all nodes
             node_objects = (
@@ -675,9 +1097,27 @@ class Tree(object):
         """
         )
 
-        result = self.connection.execute(stmt, project_id=project_id).fetchone()
+        result = dict(self.connection.execute(stmt, project_id=project_id).fetchone())
+        result["version"] = self.get_project_version(project_id)
+
+        return result
+
+    def get_n_prototypes(self, project_id):
+        """
+        Get the maximum number of prototypes per node of a project.
+
+        Falls back to the N_PROTOTYPES config value if the project does not define it.
+        """
+
+        stmt = select([projects.c.n_prototypes]).where(
+            projects.c.project_id == project_id
+        )
+        n_prototypes = self.connection.execute(stmt).scalar()
+
+        if n_prototypes is not None:
+            return n_prototypes
 
-        return dict(result)
+        return _get_config("N_PROTOTYPES", N_PROTOTYPES)
 
     def get_path_ids(self, node_id):
         """
@@ -686,6 +1126,19 @@ class Tree(object):
         Returns:
             List of `node_id`s.
         """
+        stmt = select([nodes.c.path]).where(nodes.c.node_id == node_id)
+        path = self.connection.execute(stmt).scalar()
+
+        if path is None:
+            # The node does not exist or its path is not maintained
+            return self._get_path_ids_recursive(node_id)
+
+        return list(path)
+
+    def _get_path_ids_recursive(self, node_id):
+        """
+        Get the path of the node by walking up the tree (without the materialized path).
+        """
         stmt = text(
             """
             WITH RECURSIVE q AS
@@ -708,6 +1161,67 @@ class Tree(object):
         rows = self.connection.execute(stmt, node_id=node_id).fetchall()
         return [r for (r,) in rows]
 
+    def get_paths(self, node_ids):
+        """
+        Get the paths of multiple nodes at once.
+
+        Returns:
+            Dict of node_id -> list of `node_id`s (see get_path_ids).
+        """
+
+        node_ids = [int(n) for n in node_ids]
+
+        if not node_ids:
+            return {}
+
+        stmt = select([nodes.c.node_id, nodes.c.path]).where(
+            nodes.c.node_id == any_(bindparam("node_ids", type_=ARRAY(BigInteger)))
+        )
+        paths = dict(self.connection.execute(stmt, node_ids=node_ids).fetchall())
+
+        if all(p is not None for p in paths.values()):
+            return {n: list(p) for n, p in paths.items()}
+
+        return self._get_paths_recursive(node_ids)
+
+    def _get_paths_recursive(self, node_ids):
+        """
+        Get the paths of multiple nodes by walking up the tree (without the materialized path).
+
+        The ancestors of all nodes are collected in a single query
+        (shared ancestors only once) and the paths are assembled in memory.
+        """
+        stmt = text(
+            """
+            WITH RECURSIVE q AS
+            (
+                SELECT  n.node_id, n.parent_id
+                FROM    nodes AS n
+                WHERE   n.node_id = ANY(:node_ids)
+                UNION
+                SELECT  p.node_id, p.parent_id
+                FROM    q
+                JOIN    nodes AS p
+                ON      p.node_id = q.parent_id
+            )
+            SELECT  node_id, parent_id
+            FROM    q
+        """
+        )
+        parents = dict(self.connection.execute(stmt, node_ids=node_ids).fetchall())
+
+        paths = {}
+
+        def _path(node_id):
+            path = paths.get(node_id)
+            if path is None:
+                parent_id = parents[node_id]
+                path = [node_id] if parent_id is None else _path(parent_id) + [node_id]
+                paths[node_id] = path
+            return path
+
+        return {n: _path(n) for n in node_ids if n in parents}
+
     def create_project(self, name):
         """
         Create a project with a name and return its id.
@@ -771,6 +1285,24 @@ class Tree(object):
 
         node_id = result.inserted_primary_key[0]
 
+        # Materialized path: The path of the parent + node_id
+        parents = nodes.alias("parents")
+        parent_path = (
+            select([parents.c.path])
+            .where(parents.c.node_id == nodes.c.parent_id)
+            .as_scalar()
+        )
+        stmt = (
+            nodes.update()
+            .values(
+                path=func.array_append(
+                    coalesce(parent_path, cast([], ARRAY(BigInteger))), nodes.c.node_id
+                )
+            )
+            .where(nodes.c.node_id == node_id)
+        )
+        self.connection.execute(stmt)
+
         # Insert objects
         if object_ids is not None:
             object_ids = iter(object_ids)
@@ -789,69 +1321,23 @@ class Tree(object):
 
                 if callable(progress_cb):
                     progress_cb(len(data))
-        return node_id
-
-    def _calc_type_objects(self, children, objects_):
-        """
-        Calculate nine type objects for a node as
-            a) a sample of nine type objects from its children, or
-            b) nine of its own objects, if the node is a leaf.
-        """
-        if len(children) > 0:
-            # Randomly subsample children
-            subsample = np.random.choice(children, min(len(children), 9), replace=False)
-            result = list(
-                itertools.islice(
-                    _roundrobin([c["_type_objects"] for c in subsample]), 9
-                )
-            )
 
-            if len(result) == 0:
-                print("\n", subsample)
+        # The new node changes the members of its parent and the project
+        self.bump_versions([node_id])
 
-            return result
-        else:
-            return [o["object_id"] for o in objects_[:9]]
+        return node_id
 
-    def _calc_own_type_objects(self, children, objects_):
+    def _calc_n_objects_deep(self, node, children):
         """
-        Calculate nine own type objects_ for a node as
-            a) the nine objects_ with maximum distance to the children, or
-            b) [], if the node is a leaf.
+        Recursively calculate the number of objects.
         """
 
-        if len(children) > 0 and len(objects_) > 0:
-            try:
-                classifier = Classifier(children.vectors)
-                distances = classifier.distances(objects_.vectors)
-                max_dist = np.max(distances, axis=0)
-                max_dist_idx = np.argsort(max_dist)[::-1]
-
-                assert len(max_dist_idx) == len(objects_), "{} != {}".format(
-                    len(max_dist_idx), len(objects_)
-                )
+        child_ns = [c["_n_objects_deep"] for c in children]
 
-                return [objects_[i]["object_id"] for i in max_dist_idx[:9]]
+        if any(n is None for n in child_ns):
+            return None
 
-            except:
-                print("child_vectors", children.vectors.shape)
-                print("object_vectors", objects_.vectors.shape)
-                raise
-
-        else:
-            return []
-
-    def _calc_n_objects_deep(self, node, children):
-        """
-        Recursively calculate the number of objects.
-        """
-
-        child_ns = [c["_n_objects_deep"] for c in children]
-
-        if any(n is None for n in child_ns):
-            return None
-
-        return int(node["_n_objects"] + sum(child_ns))
+        return int(node["_n_objects"] + sum(child_ns))
 
     def _query_n_objects_deep(self, node):
         # Recursively select all descendants
@@ -886,29 +1372,36 @@ class Tree(object):
         return int(result)
 
     def node_n_descendants(self, node_id):
-        # Recursively select all descendants
-        rquery = select([nodes]).where(nodes.c.node_id == node_id).cte(recursive=True)
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
+        topology = self._get_topology(node_id)
+        if topology is not None:
+            return topology.n_descendants(node_id)
 
-        rquery = rquery.union_all(
-            select([descendants]).where(descendants.c.parent_id == parents.c.node_id)
-        )
+        # Select all descendants
+        subtree = _query_subtree(node_id)
 
         # Count results
-        stmt = select([func.count()]).select_from(rquery)
+        stmt = select([func.count()]).select_from(subtree)
 
         result = self.connection.scalar(stmt) or 0
 
         return result
 
-    def get_node(self, node_id, require_valid=True):
+    def get_node(self, node_id, require_valid=True, allow_stale=False):
+        """
+        Parameters:
+            node_id: node_id of the node.
+            require_valid (bool): Are valid cache values required?
+            allow_stale (bool): Return the last cached values of an invalid node
+                immediately, without taking the project lock, and revalidate it
+                asynchronously (see _revalidate).
+                (The result then contains a `stale` flag.)
+                Nodes that have never been consolidated are returned without values.
+        """
         assert isinstance(node_id, Integral), "node_id is not integral: {!r}".format(
             node_id
         )
 
-        if require_valid:
+        if require_valid and not allow_stale:
             # TODO: Directly use values instead of reading again from DB
             self.consolidate_node(node_id)
 
@@ -919,10 +1412,24 @@ class Tree(object):
         if result is None:
             raise TreeError("Node {} is unknown.".format(node_id))
 
-        return dict(result)
+        result = dict(result)
+
+        if allow_stale:
+            if require_valid and not result["cache_valid"]:
+                self._revalidate([node_id])
+
+            result["stale"] = not result["cache_valid"]
+
+        return result
 
     def get_children(
-        self, node_id, require_valid=True, order_by=None, include=None, supertree=False
+        self,
+        node_id,
+        require_valid=True,
+        order_by=None,
+        include=None,
+        supertree=False,
+        allow_stale=False,
     ):
         """
         Parameters:
@@ -932,6 +1439,7 @@ class Tree(object):
                 None: return all chilren.
                 "starred": Return only starred children.
                 "unstarred": Return only unstarred children.
+            allow_stale (bool): See get_node.
 
         Returns:
             A list children of node_id: [{"node_id": ..., }, ...]
@@ -942,7 +1450,7 @@ class Tree(object):
             node_id
         )
 
-        if require_valid:
+        if require_valid and not allow_stale:
             self.consolidate_node(node_id, depth="children")
 
         stmt = select([nodes])
@@ -958,9 +1466,20 @@ class Tree(object):
         if order_by is not None:
             stmt = stmt.order_by(text(order_by))
 
-        result = self.connection.execute(stmt, node_id=node_id).fetchall()
+        result = [
+            dict(r) for r in self.connection.execute(stmt, node_id=node_id).fetchall()
+        ]
 
-        return [dict(r) for r in result]
+        if allow_stale:
+            invalid = [r for r in result if not r["cache_valid"]]
+
+            if require_valid and invalid:
+                self._revalidate([r["node_id"] for r in invalid])
+
+            for r in result:
+                r["stale"] = not r["cache_valid"]
+
+        return result
 
     def merge_node_into(self, node_id, dest_node_id):
         """
@@ -972,42 +1491,92 @@ class Tree(object):
         """
 
         with self.connection.begin():
+            # Acquire lock for the subtree that contains n and d
+            self.lock_subtree([node_id, dest_node_id])
+
+            node = self.connection.execute(
+                select([nodes]).where(nodes.c.node_id == node_id).with_for_update()
+            ).fetchone()
+
+            if node is None:
+                raise TreeError("Node {} is unknown.".format(node_id))
+
             # Change node for objects
             stmt = (
                 nodes_objects.update()
                 .values(node_id=dest_node_id)
                 .where(nodes_objects.c.node_id == node_id)
+                .returning(nodes_objects.c.object_id)
             )
-            self.connection.execute(stmt)
+            moved_object_ids = [r for (r,) in self.connection.execute(stmt)]
+
+            # Update the persisted sample of d (The sample of n is deleted with n.)
+            self._add_to_sample(dest_node_id, moved_object_ids)
+            self._bump_objects_versions([dest_node_id])
 
             # Change parent for children
             stmt = (
                 nodes.update()
                 .values(parent_id=dest_node_id)
                 .where(nodes.c.parent_id == node_id)
+                .returning(nodes.c.node_id)
             )
-            self.connection.execute(stmt)
+            child_ids = [r for (r,) in self.connection.execute(stmt)]
+
+            self._move_paths(child_ids, self.get_path_ids(dest_node_id))
 
             # Delete node
             stmt = nodes.delete(nodes.c.node_id == node_id)
             self.connection.execute(stmt)
 
-            # Invalidate dest node
-            stmt = (
-                nodes.update()
-                .values(cache_valid=False)
-                .where(nodes.c.node_id == dest_node_id)
-            )
-            self.connection.execute(stmt)
+            # Update the cached values of d and the nodes between n and d
+            deltas = collections.defaultdict(_CacheDelta)
+            nodes_to_invalidate = {dest_node_id}
+
+            if pd.notnull(node["_n_objects"]):
+                deltas[dest_node_id].n_objects += node["_n_objects"]
+            if pd.notnull(node["_n_children"]):
+                deltas[dest_node_id].n_children += node["_n_children"]
+
+            if node["parent_id"] is not None:
+                deltas[node["parent_id"]].n_children -= 1
+
+                # Transfer the content of n from its parent to d
+                dst_path, src_path = _paths_from_common_ancestor(
+                    [
+                        self.get_path_ids(dest_node_id),
+                        self.get_path_ids(node["parent_id"]),
+                    ]
+                )
+                nodes_to_invalidate.update(dst_path + src_path)
+
+                vector_sum = _get_vector_sum(node)
+                if vector_sum is not None:
+                    _add_transfer_deltas(
+                        deltas, dst_path, src_path, node["_n_objects_deep"], vector_sum
+                    )
+
+            self._apply_cache_deltas(deltas)
+
+            # Invalidate dest node and the paths
+            self.invalidate_nodes(nodes_to_invalidate)
 
             # TODO: Unapprove
 
     def get_objects(self, node_id, offset=None, limit=None, order_by=None):
         """
         Get objects directly below a node.
+
+        Vectors are served from the vector store if available (see build_vector_store).
         """
+        store = self._get_vector_store()
+
+        columns = [c for c in objects.c if c.name not in ("vector", "vector_array")]
+        if store is None:
+            columns.append(_vector_column().label("vector"))
+
         stmt = (
-            select([objects])
+            select(columns)
             .select_from(objects.join(nodes_objects))
             .where(nodes_objects.c.node_id == node_id)
         )
@@ -1019,9 +1588,92 @@ class Tree(object):
         if limit is not None:
             stmt = stmt.limit(limit)
 
-        result = self.connection.execute(stmt, node_id=node_id).fetchall()
+        result = [
+            dict(r) for r in self.connection.execute(stmt, node_id=node_id).fetchall()
+        ]
 
-        return [dict(r) for r in result]
+        if store is not None:
+            vectors = self.get_vectors([r["object_id"] for r in result], store)
+            for r, v in zip(result, vectors):
+                r["vector"] = v
+
+        return result
+
+    def _get_vector_store(self):
+        return load_vector_store(_get_config("VECTOR_STORE_DIR", None))
+
+    def get_vectors(self, object_ids, store=None):
+        """
+        Get the vectors of objects from the vector store.
+
+        Objects that are missing in the store (or all objects, if there is no store)
+        are queried from the database.
+
+        Returns:
+            List of vectors (None for objects without a vector).
+        """
+
+        if store is None:
+            store = self._get_vector_store()
+
+        vectors = [None] * len(object_ids)
+
+        if store is not None:
+            rows = store.lookup(object_ids)
+            found = np.flatnonzero(rows >= 0)
+            for i, v in zip(found, store.vectors[rows[found]]):
+                vectors[i] = v
+            missing = np.flatnonzero(rows < 0)
+        else:
+            missing = np.arange(len(object_ids))
+
+        if len(missing):
+            stmt = select([objects.c.object_id, _vector_column()]).where(
+                objects.c.object_id
+                == any_(bindparam("object_ids", type_=ARRAY(String)))
+            )
+            db_vectors = dict(
+                self.connection.execute(
+                    stmt, object_ids=[str(object_ids[i]) for i in missing]
+                ).fetchall()
+            )
+            for i in missing:
+                vectors[i] = db_vectors.get(object_ids[i])
+
+        return vectors
+
+    def build_vector_store(self):
+        """
+        Write all object vectors to the vector store in VECTOR_STORE_DIR.
+
+        Must be called whenever the vectors change (e.g. by flask load-features).
+
+        Returns:
+            Number of stored vectors.
+        """
+
+        path = _get_config("VECTOR_STORE_DIR", None)
+
+        if path is None:
+            raise TreeError("VECTOR_STORE_DIR is not configured.")
+
+        vector = _vector_column()
+        stmt = select([objects.c.object_id, vector.label("vector")]).where(
+            vector.isnot(None)
+        )
+        result = self.connection.execution_options(stream_results=True).execute(stmt)
+
+        object_ids = []
+        vectors = []
+        for r in result:
+            object_ids.append(r["object_id"])
+            vectors.append(r["vector"])
+
+        VectorStore.save(
+            path, object_ids, np.stack(vectors) if vectors else np.empty((0, 0))
+        )
+
+        return len(object_ids)
 
     def get_n_objects(self, node_id):
         stmt = (
@@ -1039,28 +1691,19 @@ class Tree(object):
         """
 
         with self.connection.begin():
-            self.lock_project_for_node(node_id)
+            self.lock_subtree([node_id])
 
-            stmt = text(
-                """
-            WITH RECURSIVE q AS
-            (
-                SELECT  n.*, 1 AS level
-                FROM    nodes AS n
-                WHERE   n.node_id = :node_id
-                UNION ALL
-                SELECT  p.*, level + 1
-                FROM    q
-                JOIN    nodes AS p
-                ON      p.node_id = q.parent_id
-            )
-            UPDATE nodes
-            SET cache_valid = FALSE
-            WHERE node_id IN (SELECT node_id from q);
-            """
+            stmt = (
+                nodes.update()
+                .values(cache_valid=False)
+                .where(nodes.c.node_id.in_(self.get_path_ids(node_id)))
             )
 
-            self.connection.execute(stmt, node_id=node_id)
+            self.connection.execute(stmt)
+
+            self.bump_versions([node_id])
+
+            self._schedule_consolidation([node_id])
 
     def recommend_children(self, node_id, max_n=1000):
         node = self.get_node(node_id)
@@ -1095,110 +1738,851 @@ class Tree(object):
 
         return nodes_[order].tolist()
 
-    def recommend_objects(self, node_id, max_n=1000):
+    def bump_versions(self, node_ids):
+        """
+        Set the version of the provided nodes to the next value of nodes_version_seq.
+
+        Must be called by every modification, so that the versions can be used as cache keys.
+        Only the provided nodes are updated. The modified nodes are locked by the caller
+        (see lock_subtree), so modifications of disjoint subtrees do not wait for each other.
+        The versions of subtrees and projects are aggregated when they are read
+        (see get_subtree_version and get_project_version).
+
+        Emits a notification for the listeners in other workers (see notify.InvalidationListener).
+        """
+
+        node_ids = [int(n) for n in node_ids]
+
+        if not node_ids:
+            return
+
+        version = self.connection.execute(nodes_version_seq.next_value()).scalar()
+
+        stmt = (
+            nodes.update()
+            .values(version=version)
+            .where(nodes.c.node_id.in_(node_ids))
+            .returning(nodes.c.project_id, nodes.c.node_id)
+        )
+
+        project_node_ids = collections.defaultdict(list)
+        for project_id, node_id in self.connection.execute(stmt).fetchall():
+            project_node_ids[project_id].append(node_id)
+
+        # Let the other workers evict their caches (delivered on commit)
+        for project_id, node_ids_ in project_node_ids.items():
+            notify(self.connection, project_id, node_ids_, version)
+
+    def _bump_objects_versions(self, node_ids):
+        """
+        Set the objects_version of the provided nodes to the next value of nodes_version_seq.
+
+        Must be called whenever the objects directly below a node change
+        (see get_recommendation_version).
+        """
+
+        node_ids = [int(n) for n in node_ids]
+
+        if not node_ids:
+            return
+
+        stmt = (
+            nodes.update()
+            .values(objects_version=nodes_version_seq.next_value())
+            .where(nodes.c.node_id.in_(node_ids))
+        )
+        self.connection.execute(stmt)
+
+    def get_node_version(self, node_id):
+        """
+        Get the version of a node (see bump_versions).
+
+        Returns:
+            int or None if the cached values of the node are invalid.
+        """
+
+        stmt = select([nodes.c.version, nodes.c.cache_valid]).where(
+            nodes.c.node_id == node_id
+        )
+        row = self.connection.execute(stmt).fetchone()
+
+        if row is None or not row["cache_valid"]:
+            return None
+
+        return row["version"]
+
+    def _aggregate_versions(self, condition):
+        """
+        Aggregate the versions of the nodes matching condition.
+
+        Every bump assigns a value that is larger than the previous version of the node,
+        so the sum grows with every modification, regardless of the order
+        in which concurrent modifications are committed. The number of nodes covers deletions.
+
+        Returns:
+            str
+        """
+
+        stmt = select([func.count(), coalesce(func.sum(nodes.c.version), 0)]).where(
+            condition
+        )
+        n_nodes, version_sum = self.connection.execute(stmt).fetchone()
+
+        return "{}:{}".format(n_nodes, version_sum)
+
+    def get_subtree_version(self, node_id):
+        """
+        Get the version of a node and all its descendants.
+
+        Returns:
+            str or None if the cached values of the node are invalid.
+        """
+
+        if self.get_node_version(node_id) is None:
+            return None
+
+        return self._aggregate_versions(
+            nodes.c.path.contains(array([cast(node_id, BigInteger)]))
+        )
+
+    def get_project_version(self, project_id):
+        """
+        Get the version of a project (aggregated over all of its nodes, see bump_versions).
+
+        Returns:
+            str
+        """
+
+        return self._aggregate_versions(nodes.c.project_id == project_id)
+
+    def _get_topology(self, node_id):
+        """
+        Get the topology snapshot of the project of a node (see topology.Topology).
+
+        Returns:
+            Topology or None if the node is unknown or the connection is inside of a transaction
+            (uncommitted changes must not end up in the snapshot of other requests).
+        """
+
+        if self.connection.in_transaction():
+            return None
+
+        stmt = select([nodes.c.project_id]).where(nodes.c.node_id == node_id)
+        project_id = self.connection.execute(stmt).scalar()
+
+        if project_id is None:
+            return None
+
+        version = self.get_project_version(project_id)
+
+        def load():
+            stmt = select(
+                [
+                    nodes.c.node_id,
+                    coalesce(nodes.c.parent_id, -1),
+                    nodes.c.approved,
+                    nodes.c.starred,
+                ]
+            ).where(nodes.c.project_id == project_id)
+            rows = self.connection.execute(stmt).fetchall()
+
+            if not rows:
+                return [], [], [], []
+
+            return [np.array(c) for c in zip(*rows)]
+
+        return get_topology(project_id, version, load)
+
+    def get_members_version(self, node_id):
+        """
+        Identify the state of the direct members of a node (children and objects).
+
+        The versions of the children are included, because a modification of a child
+        does not bump the version of the node.
+        The path of the node is included, because it is part of the paths of the children
+        and moving an ancestor does not bump the version of the node.
+
+        Returns:
+            str or None if the cached values of a child are invalid.
+        """
+
+        children_valid = (
+            select([coalesce(func.bool_and(nodes.c.cache_valid), True)])
+            .where(nodes.c.parent_id == node_id)
+            .as_scalar()
+        )
+
+        stmt = select([nodes.c.version, children_valid, nodes.c.path]).where(
+            nodes.c.node_id == node_id
+        )
+        row = self.connection.execute(stmt).fetchone()
+
+        if row is None or not row[1]:
+            return None
+
+        path = row[2] if row[2] is not None else self.get_path_ids(node_id)
+
+        return "{}:{}:{}".format(
+            row[0],
+            self._aggregate_versions(nodes.c.parent_id == node_id),
+            ",".join(str(n) for n in path),
+        )
+
+    def get_recommendation_version(self, node_id):
+        """
+        Identify the state of the inputs of recommend_objects for a node:
+        Its prototypes and rejected objects (covered by the version of the node)
+        and the objects directly below its ancestors.
+
+        Modifications elsewhere in the project do not change the recommendation version.
+
+        Returns:
+            str or None if the node is invalid.
+        """
+
+        stmt = select(
+            [nodes.c.version, nodes.c.cache_valid, nodes.c._prototypes.isnot(None)]
+        ).where(nodes.c.node_id == node_id)
+
+        row = self.connection.execute(stmt).fetchone()
+
+        if row is None or not row[1] or not row[2]:
+            return None
+
+        # The recommended objects are drawn from the ancestors
+        path = self.get_path_ids(node_id)[:-1]
+        stmt = select([nodes.c.node_id, nodes.c.objects_version]).where(
+            nodes.c.node_id.in_(path)
+        )
+        objects_versions = dict(self.connection.execute(stmt).fetchall())
+
+        return ",".join(
+            [str(row[0])]
+            + ["{}:{}".format(n, objects_versions.get(n)) for n in path]
+        )
+
+    def recommend_objects(self, node_id, max_n=1000, backend=None):
         """
         Recommend objects for a node.
 
         Note: Most time is spent querying all objects below a node.
         This can be sped up, if the nodes a relatively small.
 
+        Parameters:
+            backend: "sql": Calculate exact distances in the database.
+                "ann": Search the approximate nearest neighbour index of the project
+                (see build_ann_index). Falls back to "sql" if the project has no index.
+                "knn": Exact nearest neighbour scans using the GiST index on objects.vector.
+                Falls back to "sql" if VECTOR_STORAGE is "array".
+                "sql" and "knn" use "blas" if VECTOR_STORAGE is "array".
+                "blas": Exact distances calculated in-process with NumPy
+                (using the vector store, if available).
+                Default: RECOMMEND_BACKEND config value.
+
         History:
             18/10/29: Query all objects, then sort and truncate.
             pre 18/10/29: Queried number of objects per node is limited by max_n.
                 This leads to suboptimal results, as the closest objects may not
                 lie under these max_n quasi-randomly chosen objects.
         """
-        with Timer("Tree.recommend_objects") as timer:
-            node = self.get_node(node_id)
-            project_id = node["project_id"]
+        with Timer("Tree.recommend_objects") as timer:
+            node = self.get_node(node_id)
+            project_id = node["project_id"]
+
+            # Get the path to the node (without the node itself)
+            path = self.get_path_ids(node_id)[:-1]
+
+            rejected_object_ids = select([nodes_rejected_objects.c.object_id]).where(
+                nodes_rejected_objects.c.node_id == node_id
+            )
+
+            prots: Prototypes = node["_prototypes"]
+            if prots is None:
+                raise TreeError(f"Node {node_id} has no prototypes!")
+
+            if backend is None:
+                backend = _get_config("RECOMMEND_BACKEND", "sql")
+
+            if backend == "ann":
+                index_path = self._get_ann_index_path(project_id)
+                index = load_index(index_path) if index_path is not None else None
+                if index is not None:
+                    with timer.child("_recommend_objects_ann"):
+                        return self._recommend_objects_ann(
+                            index, node_id, project_id, path, prots, max_n
+                        )
+                # No index: Fall back to an exact search
+                backend = "sql"
+            elif backend not in ("sql", "knn", "blas"):
+                raise ValueError("Unknown backend: {}".format(backend))
+
+            if backend == "knn" and _vector_column() is objects.c.vector:
+                # The GiST index only exists for CUBE vectors
+                with timer.child("_recommend_objects_knn"):
+                    return self._recommend_objects_knn(
+                        node_id, project_id, path, prots, max_n
+                    )
+
+            if backend == "blas" or _vector_column() is objects.c.vector_array:
+                # real[] has no C-backed distance operator,
+                # so the distances are calculated in-process.
+                with timer.child("_recommend_objects_blas"):
+                    return self._recommend_objects_blas(
+                        node_id, project_id, path, prots, max_n
+                    )
+
+            distances_expression = [
+                _vector_column().dist_euclidean(p) for p in prots.prototypes_
+            ]
+
+            # Bounded max-heap of the best candidates: (-distance, seq, object_id, path)
+            heap = []
+            seq = itertools.count()
+            n_found = 0
+
+            print("Tree.recommend_objects: Querying candidates...")
+            with timer.child("Query matching objects") as c:
+                # Traverse the parse in reverse
+                for parent_id in path[::-1]:
+                    # Break if we already have enough objects
+                    if n_found >= max_n:
+                        break
+
+                    distance = func.least(*distances_expression).label("distance")
+
+                    # Get the closest objects below parent_id that are not rejected by node_id
+                    stmt = (
+                        select([objects.c.object_id, objects.c.path, distance])
+                        .select_from(objects.join(nodes_objects))
+                        .where(
+                            (nodes_objects.c.node_id == parent_id)
+                            & (nodes_objects.c.project_id == project_id)
+                            & (~objects.c.object_id.in_(rejected_object_ids))
+                        )
+                        .order_by(distance)
+                        .limit(max_n)
+                    )
+
+                    with c.child("execute"):
+                        r = self.connection.execution_options(
+                            stream_results=True
+                        ).execute(stmt)
+
+                    with c.child("fetch"):
+                        for object_id, path_, distance_ in r:
+                            n_found += 1
+                            item = (-distance_, next(seq), object_id, path_)
+                            if len(heap) < max_n:
+                                heapq.heappush(heap, item)
+                            elif item > heap[0]:
+                                heapq.heapreplace(heap, item)
+
+            with timer.child("Result assembly"):
+                return [
+                    {"object_id": object_id, "path": path_, "distance": -neg_distance}
+                    for neg_distance, _, object_id, path_ in sorted(heap, reverse=True)
+                ]
+
+    def _recommend_objects_ann(
+        self, index, node_id, project_id, path, prots, max_n, n_probe=8
+    ):
+        """
+        Recommend objects for a node using an approximate nearest neighbour index.
+
+        The cells of the index closest to the prototypes are searched
+        until enough objects directly below the ancestors (and not rejected by the node)
+        were found or ANN_MAX_PROBE_CELLS cells were searched.
+        Like in the "sql" backend, the objects of the closest ancestors are preferred.
+        Memberships are looked up in the database, so the index stays valid when objects are relocated.
+        """
+
+        max_cells = _get_config("ANN_MAX_PROBE_CELLS", 64)
+
+        rejected_object_ids = select([nodes_rejected_objects.c.object_id]).where(
+            nodes_rejected_objects.c.node_id == node_id
+        )
+
+        # Only members of the ancestors are transferred back
+        members_stmt = select([nodes_objects.c.object_id, nodes_objects.c.node_id]).where(
+            nodes_objects.c.node_id.in_(path)
+            & (nodes_objects.c.project_id == project_id)
+            & (
+                nodes_objects.c.object_id
+                == any_(bindparam("object_ids", type_=ARRAY(String)))
+            )
+            & (~nodes_objects.c.object_id.in_(rejected_object_ids))
+        )
+
+        # Rank of every ancestor (0 = parent)
+        ranks = {parent_id: rank for rank, parent_id in enumerate(path[::-1])}
+
+        candidate_ids = []
+        candidate_distances = []
+        candidate_ranks = []
+        n_candidates = 0
+
+        for object_ids, distances in index.iter_candidates(
+            prots.prototypes_, n_probe, max_cells
+        ):
+            members = dict(
+                self.connection.execute(
+                    members_stmt, object_ids=object_ids.tolist()
+                ).fetchall()
+            )
+            mask = np.fromiter((o in members for o in object_ids), bool)
+
+            candidate_ids.append(object_ids[mask])
+            candidate_distances.append(distances[mask])
+            candidate_ranks.append([ranks[members[o]] for o in object_ids[mask]])
+            n_candidates += mask.sum()
+
+            # Break if we already have enough objects
+            if n_candidates >= max_n:
+                break
+
+        if not n_candidates:
+            return []
+
+        candidate_ids = np.concatenate(candidate_ids)
+        candidate_distances = np.concatenate(candidate_distances)
+        candidate_ranks = np.concatenate(candidate_ranks).astype(int)
+
+        # Use the objects of the closest ancestors that together supply max_n objects
+        n_per_rank = np.cumsum(np.bincount(candidate_ranks, minlength=len(path)))
+        max_rank = min(np.searchsorted(n_per_rank, max_n), len(path) - 1)
+        selection = candidate_ranks <= max_rank
+        candidate_ids = candidate_ids[selection]
+        candidate_distances = candidate_distances[selection]
+
+        order = np.argsort(candidate_distances)[:max_n]
+        candidate_ids = candidate_ids[order].tolist()
+
+        stmt = select([objects.c.object_id, objects.c.path]).where(
+            objects.c.object_id == any_(bindparam("object_ids", type_=ARRAY(String)))
+        )
+        paths = dict(
+            self.connection.execute(stmt, object_ids=candidate_ids).fetchall()
+        )
+
+        return [
+            {"object_id": o, "path": paths[o], "distance": float(d)}
+            for o, d in zip(candidate_ids, candidate_distances[order])
+        ]
+
+    def _recommend_objects_knn(
+        self, node_id, project_id, path, prots, max_n, max_k_factor=64
+    ):
+        """
+        Recommend objects for a node using the GiST index on objects.vector.
+
+        Every prototype issues one index-backed `ORDER BY vector <-> prototype LIMIT k` scan.
+        The candidates are then merged and filtered by ancestor membership and rejection.
+        If this leaves fewer than max_n objects, k is doubled (up to max_k_factor * max_n).
+        """
+
+        rejected_object_ids = select([nodes_rejected_objects.c.object_id]).where(
+            nodes_rejected_objects.c.node_id == node_id
+        )
+
+        # One KNN scan per prototype
+        scans = []
+        for p in prots.prototypes_:
+            distance = objects.c.vector.dist_euclidean(p)
+            scan = (
+                select([objects.c.object_id, distance.label("distance")])
+                .where(objects.c.vector.isnot(None))
+                .order_by(distance)
+                .limit(bindparam("k"))
+                .alias()
+            )
+            scans.append(select([scan.c.object_id, scan.c.distance]))
+        candidates = union_all(*scans).alias("candidates")
+
+        stmt = (
+            select(
+                [
+                    candidates.c.object_id,
+                    objects.c.path,
+                    nodes_objects.c.node_id,
+                    func.min(candidates.c.distance).label("distance"),
+                ]
+            )
+            .select_from(
+                candidates.join(
+                    nodes_objects, nodes_objects.c.object_id == candidates.c.object_id
+                ).join(objects, objects.c.object_id == candidates.c.object_id)
+            )
+            .where(
+                nodes_objects.c.node_id.in_(path)
+                & (nodes_objects.c.project_id == project_id)
+                & (~candidates.c.object_id.in_(rejected_object_ids))
+            )
+            .group_by(candidates.c.object_id, objects.c.path, nodes_objects.c.node_id)
+        )
+
+        k = max_n
+        while True:
+            rows = self.connection.execute(stmt, k=k).fetchall()
+
+            if len(rows) >= max_n or k >= max_k_factor * max_n:
+                break
+
+            k *= 2
+
+        by_node = collections.defaultdict(list)
+        for r in rows:
+            by_node[r["node_id"]].append(r)
+
+        # Like the "sql" backend, prefer objects of closer ancestors
+        objects_ = []
+        for parent_id in path[::-1]:
+            if len(objects_) >= max_n:
+                break
+            objects_.extend(by_node[parent_id])
+
+        objects_.sort(key=lambda r: r["distance"])
+
+        return [
+            {"object_id": r["object_id"], "path": r["path"], "distance": r["distance"]}
+            for r in objects_[:max_n]
+        ]
+
+    def _recommend_objects_blas(self, node_id, project_id, path, prots, max_n):
+        """
+        Recommend objects for a node by calculating exact distances in-process.
+
+        Only the object_ids are queried per ancestor. The vectors come from the
+        vector store and the distances are calculated in float32 chunks
+        (see processing.distance.top_k_min_distances).
+        """
+
+        rejected_object_ids = select([nodes_rejected_objects.c.object_id]).where(
+            nodes_rejected_objects.c.node_id == node_id
+        )
+
+        members_stmt = select([nodes_objects.c.object_id]).where(
+            (nodes_objects.c.node_id == bindparam("parent_id"))
+            & (nodes_objects.c.project_id == project_id)
+            & (~nodes_objects.c.object_id.in_(rejected_object_ids))
+        )
+
+        normalized = _get_config("FEATURES_NORMALIZED", False)
+        store = self._get_vector_store()
+
+        candidate_ids = []
+        candidate_distances = []
+        n_candidates = 0
+
+        # Traverse the path in reverse
+        for parent_id in path[::-1]:
+            n_left = max_n - n_candidates
+
+            # Break if we already have enough objects
+            if n_left <= 0:
+                break
+
+            object_ids = np.array(
+                [
+                    r
+                    for (r,) in self.connection.execute(
+                        members_stmt, parent_id=parent_id
+                    )
+                ],
+                dtype=object,
+            )
+
+            if not len(object_ids):
+                continue
+
+            rows = store.lookup(object_ids) if store is not None else None
+
+            if rows is not None and (rows >= 0).all():
+                X = store.vectors
+            else:
+                # Fall back to the database for objects that are not in the store
+                vectors = self.get_vectors(object_ids, store)
+                valid = np.array([v is not None for v in vectors], dtype=bool)
+                object_ids = object_ids[valid]
+                if not len(object_ids):
+                    continue
+                X = np.stack([v for v in vectors if v is not None])
+                rows = None
+
+            indices, distances = top_k_min_distances(
+                X, prots.prototypes_, max_n, rows=rows, normalized=normalized
+            )
+
+            candidate_ids.append(object_ids[indices])
+            candidate_distances.append(distances)
+            n_candidates += len(indices)
+
+        if not n_candidates:
+            return []
+
+        candidate_ids = np.concatenate(candidate_ids)
+        candidate_distances = np.concatenate(candidate_distances)
+
+        order = np.argsort(candidate_distances, kind="stable")[:max_n]
+        candidate_ids = candidate_ids[order].tolist()
+
+        stmt = select([objects.c.object_id, objects.c.path]).where(
+            objects.c.object_id == any_(bindparam("object_ids", type_=ARRAY(String)))
+        )
+        paths = dict(
+            self.connection.execute(stmt, object_ids=candidate_ids).fetchall()
+        )
+
+        return [
+            {"object_id": o, "path": paths[o], "distance": float(d)}
+            for o, d in zip(candidate_ids, candidate_distances[order])
+        ]
+
+    def _get_ann_index_path(self, project_id):
+        """
+        Directory of the index of a project or None if ANN_INDEX_DIR is not configured.
+        """
+        path = _get_config("ANN_INDEX_DIR", None)
+
+        if path is None:
+            return None
+
+        return os.path.join(path, str(project_id))
+
+    def build_ann_index(self, project_id, n_lists=None):
+        """
+        Build the approximate nearest neighbour index of a project (see recommend_objects).
+
+        The index has to be rebuilt when objects are added to the project
+        or their vectors change. Relocations do not require a rebuild.
+
+        Returns:
+            IVFIndex
+        """
+
+        index_path = self._get_ann_index_path(project_id)
+        if index_path is None:
+            raise TreeError("ANN_INDEX_DIR is not configured.")
+
+        vector = _vector_column()
+        stmt = (
+            select([objects.c.object_id, vector.label("vector")])
+            .select_from(objects.join(nodes_objects))
+            .where((nodes_objects.c.project_id == project_id) & (vector.isnot(None)))
+        )
+
+        result = self.connection.execution_options(stream_results=True).execute(stmt)
+
+        object_ids = []
+        vectors = []
+        for r in result:
+            object_ids.append(r["object_id"])
+            vectors.append(r["vector"])
+
+        if not object_ids:
+            raise TreeError("Project {} has no object vectors.".format(project_id))
+
+        index = IVFIndex.build(object_ids, np.stack(vectors), n_lists)
+        index.save(index_path)
+
+        return index
+
+    def invalidate_nodes(self, nodes_to_invalidate, unapprove=False):
+        """
+        Invalidate the provided nodes.
+
+        Parameters:
+            nodes_to_invalidate: Collection of `node_id`s
+        """
+
+        # TODO: Get project ids for requested node ids and lock the projects
+        # Otherwise a deadlock might occur.
+
+        values = {nodes.c.cache_valid: False}
+
+        if unapprove:
+            values[nodes.c.approved] = False
+
+        stmt = (
+            nodes.update()
+            .values(values)
+            .where(nodes.c.node_id.in_(nodes_to_invalidate))
+        )
+        self.connection.execute(stmt)
+
+        self.bump_versions(nodes_to_invalidate)
+
+        self._schedule_consolidation(nodes_to_invalidate)
+
+    def _schedule_consolidation(self, node_ids):
+        """
+        Schedule the background consolidation of the projects of the provided nodes.
+
+        Only active if CONSOLIDATE_IN_BACKGROUND is set in the app config.
+        """
+
+        if not _get_config("CONSOLIDATE_IN_BACKGROUND", False):
+            return
+
+        # Imported here to avoid a circular import
+        from morphocluster.background import schedule_consolidation
+
+        stmt = (
+            select([nodes.c.project_id])
+            .distinct()
+            .where(nodes.c.node_id.in_(list(node_ids)))
+        )
+
+        for (project_id,) in self.connection.execute(stmt).fetchall():
+            schedule_consolidation(project_id)
+
+    def _revalidate(self, node_ids):
+        """
+        Consolidate the provided nodes asynchronously after a stale read.
+
+        With CONSOLIDATE_IN_BACKGROUND, the consolidation of their projects is scheduled,
+        otherwise the nodes are consolidated in a thread of the current process.
+        """
+
+        if _get_config("CONSOLIDATE_IN_BACKGROUND", False):
+            self._schedule_consolidation(node_ids)
+            return
+
+        if not has_app_context():
+            return
+
+        # Imported here to avoid a circular import
+        from morphocluster.background import revalidate_nodes
+
+        revalidate_nodes(node_ids)
+
+    def consolidate_invalid(self, project_id):
+        """
+        Consolidate all invalid nodes of a project.
 
-            # Get the path to the node (without the node itself)
-            path = self.get_path_ids(node_id)[:-1]
+        Only the subtrees below the topmost invalid nodes are read
+        and each one is consolidated in its own transaction.
 
-            objects_ = []
+        Returns:
+            Number of consolidated subtrees.
+        """
 
-            rejected_object_ids = select([nodes_rejected_objects.c.object_id]).where(
-                nodes_rejected_objects.c.node_id == node_id
+        with self.connection.begin():
+            # Wait for running modifications of the project
+            self.lock_project(project_id)
+
+            parents = nodes.alias("parents")
+            stmt = (
+                select([nodes.c.node_id])
+                .select_from(
+                    nodes.outerjoin(parents, nodes.c.parent_id == parents.c.node_id)
+                )
+                .where(
+                    (nodes.c.project_id == project_id)
+                    & (nodes.c.cache_valid == False)
+                    & coalesce(parents.c.cache_valid, True)
+                )
             )
 
-            prots: Prototypes = node["_prototypes"]
-            if prots is None:
-                raise TreeError(f"Node {node_id} has no prototypes!")
+            node_ids = [r for (r,) in self.connection.execute(stmt).fetchall()]
 
-            distances_expression = [
-                objects.c.vector.dist_euclidean(p) for p in prots.prototypes_
-            ]
+        for node_id in node_ids:
+            self.consolidate_node(node_id)
 
-            print("Tree.recommend_objects: Querying candidates...")
-            with timer.child("Query matching objects") as c:
-                # Traverse the parse in reverse
-                for parent_id in path[::-1]:
-                    n_left = max_n - len(objects_)
+        return len(node_ids)
 
-                    # Break if we already have enough objects
-                    if n_left <= 0:
-                        break
+    def _apply_cache_deltas(self, deltas):
+        """
+        Update the additive cached values (_n_objects, _n_children,
+        _n_objects_deep, _vector_sum and the derived _centroid) by delta.
 
-                    # Get objects below parent_id that are not rejected by node_id
-                    stmt = (
-                        select(
-                            [
-                                objects.c.object_id,
-                                objects.c.path,
-                                func.least(*distances_expression).label("distance"),
-                            ]
-                        )
-                        .select_from(objects.join(nodes_objects))
-                        .where(
-                            (nodes_objects.c.node_id == parent_id)
-                            & (nodes_objects.c.project_id == project_id)
-                            & (~objects.c.object_id.in_(rejected_object_ids))
-                        )
-                    )
+        This keeps these values valid when members are relocated.
+        Values that are not yet known (NULL) are left for consolidation.
 
-                    with c.child("execute"):
-                        r = self.connection.execute(stmt)
+        Parameters:
+            deltas: Mapping of node_id to _CacheDelta.
+        """
 
-                    with c.child("fetch"):
-                        result = r.fetchall()
+        if not deltas:
+            return
+
+        stmt = (
+            select(
+                [
+                    nodes.c.node_id,
+                    nodes.c._n_objects,
+                    nodes.c._n_children,
+                    nodes.c._n_objects_deep,
+                    nodes.c._vector_sum,
+                    nodes.c._centroid,
+                ]
+            )
+            .where(nodes.c.node_id.in_(list(deltas.keys())))
+            .with_for_update()
+        )
+
+        updates = []
+        for row in self.connection.execute(stmt).fetchall():
+            delta = deltas[row["node_id"]]
 
-                    objects_.extend(dict(r) for r in result)
+            values = {"node_id": row["node_id"]}
 
-            if not objects_:
-                return []
+            for field, change in (
+                ("_n_objects", delta.n_objects),
+                ("_n_children", delta.n_children),
+                ("_n_objects_deep", delta.n_objects_deep),
+            ):
+                values[field] = (
+                    row[field] + int(change) if row[field] is not None else None
+                )
 
-            with timer.child("Convert to array"):
-                distances = np.array([o["distance"] for o in objects_])
-                objects_ = np.array(objects_, dtype=object)
+            vector_sum = _get_vector_sum(row)
+            if vector_sum is not None:
+                vector_sum = vector_sum + delta.vector_sum
 
-            with timer.child("Sorting"):
-                order = np.argsort(distances)[:max_n]
+            if vector_sum is not None and values["_n_objects_deep"]:
+                values["_vector_sum"] = vector_sum
+                values["_centroid"] = vector_sum / values["_n_objects_deep"]
+            else:
+                values["_vector_sum"] = None
+                values["_centroid"] = None
 
-            with timer.child("Result assembly"):
-                return objects_[order].tolist()
+            updates.append(values)
 
-    def invalidate_nodes(self, nodes_to_invalidate, unapprove=False):
+        bulk_update(self.connection, nodes, "node_id", updates)
+
+    def _move_paths(self, node_ids, parent_path):
         """
-        Invalidate the provided nodes.
+        Update the materialized paths of the subtrees below node_ids
+        after these nodes were moved below the node with the path parent_path.
 
-        Parameters:
-            nodes_to_invalidate: Collection of `node_id`s
+        If a node and one of its descendants are moved together,
+        the descendant keeps its own position below parent_path.
         """
 
-        # TODO: Get project ids for requested node ids and lock the projects
-        # Otherwise a deadlock might occur.
+        node_ids = [int(n) for n in node_ids]
 
-        values = {nodes.c.cache_valid: False}
+        if not node_ids:
+            return
 
-        if unapprove:
-            values[nodes.c.approved] = False
+        stmt = text(
+            """
+        UPDATE  nodes AS d
+        SET     path = CAST(:parent_path AS BIGINT[]) || d.path[s.pos:]
+        FROM    (
+                    SELECT DISTINCT ON (n.node_id)
+                            n.node_id, array_position(n.path, m.node_id) AS pos
+                    FROM    nodes AS n
+                    JOIN    unnest(CAST(:node_ids AS BIGINT[])) AS m(node_id)
+                    ON      n.path @> ARRAY[m.node_id]
+                    ORDER BY n.node_id, pos DESC
+                ) AS s
+        WHERE   d.node_id = s.node_id
+        """
+        )
 
-        stmt = (
-            nodes.update()
-            .values(values)
-            .where(nodes.c.node_id.in_(nodes_to_invalidate))
+        self.connection.execute(
+            stmt, node_ids=node_ids, parent_path=[int(n) for n in parent_path]
         )
-        self.connection.execute(stmt)
 
     def relocate_nodes(self, node_ids, parent_id, unapprove=False):
         """
@@ -1209,8 +2593,8 @@ class Tree(object):
             return
 
         with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(parent_id)
+            # Acquire lock for the subtree that contains the nodes and the new parent
+            self.lock_subtree([parent_id, *node_ids])
 
             new_parent_path = self.get_path_ids(parent_id)
 
@@ -1226,7 +2610,7 @@ class Tree(object):
 
             # stmt = nodes.update().values({"parent_id": parent_id}).where(nodes.c.node_id.in_(node_ids))
 
-            # Return distinct old `parent_id`s
+            # Return the old `parent_id` and the cached deep values of every moved node
             stmt = text(
                 """
             WITH updater AS (
@@ -1234,10 +2618,16 @@ class Tree(object):
                 SET parent_id = :new_parent_id
                 FROM  (SELECT node_id, parent_id FROM nodes WHERE node_id IN :node_ids FOR UPDATE) y
                 WHERE  x.node_id = y.node_id
-                RETURNING y.parent_id AS old_parent_id
+                RETURNING x.*, y.parent_id AS old_parent_id
             )
-            SELECT DISTINCT old_parent_id FROM updater;
+            SELECT node_id, old_parent_id, _n_objects_deep, _vector_sum, _centroid FROM updater;
             """
+            ).columns(
+                nodes.c.node_id,
+                nodes.c._n_objects_deep,
+                nodes.c._vector_sum,
+                nodes.c._centroid,
+                old_parent_id=BigInteger,
             )
 
             # Fetch old_parent_ids
@@ -1245,23 +2635,50 @@ class Tree(object):
                 stmt, new_parent_id=parent_id, node_ids=tuple(node_ids)
             ).fetchall()
 
-            # Invalidate subtree rooted at first common ancestor
-            parent_paths = [new_parent_path] + [
-                self.get_path_ids(r["old_parent_id"]) for r in result
-            ]
-            paths_to_update = _paths_from_common_ancestor(parent_paths)
-            nodes_to_invalidate = set(sum(paths_to_update, []))
+            self._move_paths(node_ids, new_parent_path)
+
+            # Invalidate the paths from the first common ancestor of new and old parent
+            # and transfer the deep values of the moved nodes
+            deltas = collections.defaultdict(_CacheDelta)
+            nodes_to_invalidate = {parent_id}
+            old_parent_paths = {}
+
+            for row in result:
+                old_parent_id = row["old_parent_id"]
+
+                if old_parent_id is None or old_parent_id == parent_id:
+                    continue
+
+                if old_parent_id not in old_parent_paths:
+                    old_parent_paths[old_parent_id] = self.get_path_ids(old_parent_id)
+
+                dst_path, src_path = _paths_from_common_ancestor(
+                    [new_parent_path, old_parent_paths[old_parent_id]]
+                )
+                nodes_to_invalidate.update(dst_path + src_path)
+
+                deltas[parent_id].n_children += 1
+                deltas[old_parent_id].n_children -= 1
+
+                vector_sum = _get_vector_sum(row)
+                if vector_sum is not None:
+                    _add_transfer_deltas(
+                        deltas, dst_path, src_path, row["_n_objects_deep"], vector_sum
+                    )
 
-            assert parent_id in nodes_to_invalidate
+            self._apply_cache_deltas(deltas)
 
             self.invalidate_nodes(nodes_to_invalidate, unapprove)
 
-    def relocate_objects(self, object_ids, node_id, unapprove=False, src_node_id=None):
+    def relocate_objects(
+        self, object_ids, node_id, unapprove=False, src_node_id=None, src_node_ids=None
+    ):
         """
         Relocate an object to another node.
 
         Args:
             src_node_id: If not None, transfer only objects from this node.
+            src_node_ids: If not None, transfer only objects from these nodes.
 
         TODO: This is slow!
         """
@@ -1269,35 +2686,79 @@ class Tree(object):
         if len(object_ids) == 0:
             return
 
-        with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(node_id)
+        if src_node_id is not None:
+            src_node_ids = [src_node_id]
 
+        with self.connection.begin():
             # Poject id of the new node
             project_id = select([nodes.c.project_id]).where(nodes.c.node_id == node_id)
             project_id = self.connection.execute(project_id).scalar()
 
-            new_node_path = self.get_path_ids(node_id)
+            # Current nodes of the objects
+            old_node_stmt = (
+                select([nodes_objects.c.node_id])
+                .distinct()
+                .where(
+                    nodes_objects.c.object_id.in_(object_ids)
+                    & (nodes_objects.c.project_id == project_id)
+                )
+            )
+            if src_node_ids is not None:
+                old_node_stmt = old_node_stmt.where(
+                    nodes_objects.c.node_id.in_(list(src_node_ids))
+                )
 
-            # Find current node_ids of the objects
+            # Find current node_ids and vectors of the objects
             # This is slow!
-            # old_node_ids is required for invalidation
-            # TODO: Distinct!
-            stmt = (
-                select([nodes_objects.c.node_id])
-                .with_for_update()
+            # old_node_ids is required for invalidation and the update of the cached values
+            transfer_stmt = (
+                select([nodes_objects.c.node_id, _vector_column().label("vector")])
+                .select_from(nodes_objects.join(objects))
+                .with_for_update(of=nodes_objects)
                 .where(
                     nodes_objects.c.object_id.in_(object_ids)
                     & (nodes_objects.c.project_id == project_id)
                 )
             )
 
-            if src_node_id is not None:
-                stmt = stmt.where(nodes_objects.c.node_id == src_node_id)
+            if src_node_ids is not None:
+                transfer_stmt = transfer_stmt.where(
+                    nodes_objects.c.node_id.in_(list(src_node_ids))
+                )
 
-            old_node_ids = [
-                r["node_id"] for r in self.connection.execute(stmt).fetchall()
-            ]
+            while True:
+                savepoint = self.connection.begin_nested()
+
+                try:
+                    # Acquire lock for the subtree that contains the new node and the current nodes
+                    old_node_ids = {
+                        r for (r,) in self.connection.execute(old_node_stmt)
+                    }
+                    self.lock_subtree(old_node_ids | {node_id})
+
+                    # Number of objects and sum of their vectors per old node
+                    transfers = {}
+                    for r in self.connection.execute(transfer_stmt):
+                        if r["node_id"] == node_id:
+                            continue
+
+                        transfer = transfers.setdefault(r["node_id"], [0, 0])
+                        transfer[0] += 1
+                        if r["vector"] is not None:
+                            transfer[1] = transfer[1] + r["vector"]
+                except:
+                    savepoint.rollback()
+                    raise
+
+                if old_node_ids.issuperset(transfers):
+                    savepoint.commit()
+                    break
+
+                # Objects were moved while we were waiting for the lock:
+                # Release all locks and start over, so that all locks are taken top-down
+                savepoint.rollback()
+
+            new_node_path = self.get_path_ids(node_id)
 
             # Update assignments
             stmt = (
@@ -1307,41 +2768,43 @@ class Tree(object):
                     nodes_objects.c.object_id.in_(object_ids)
                     & (nodes_objects.c.project_id == project_id)
                 )
+                .returning(nodes_objects.c.object_id)
             )
 
-            if src_node_id is not None:
-                stmt = stmt.where(nodes_objects.c.node_id == src_node_id)
+            if src_node_ids is not None:
+                stmt = stmt.where(nodes_objects.c.node_id.in_(list(src_node_ids)))
 
-            self.connection.execute(stmt)
+            moved_object_ids = [r for (r,) in self.connection.execute(stmt)]
 
-            # # Return distinct old `parent_id`s
-            # stmt = text("""
-            # WITH updater AS (
-            #     UPDATE nodes_objects x
-            #     SET node_id = :node_id
-            #     FROM  (SELECT object_id, node_id FROM nodes_objects
-            #         WHERE project_id = :project_id AND object_id IN :object_ids FOR UPDATE) y
-            #     WHERE  project_id = :project_id AND x.object_id = y.object_id
-            #     RETURNING y.node_id AS old_node_id
-            # )
-            # SELECT DISTINCT old_node_id FROM updater;
-            # """)
-
-            # # Fetch old_parent_ids
-            # result = self.connection.execute(stmt,
-            #                                  node_id=node_id,
-            #                                  project_id=project_id,
-            #                                  object_ids=tuple(object_ids)
-            #                                  ).fetchall()
-
-            # Invalidate subtree rooted at first common ancestor
-            paths = [new_node_path] + [old_node_ids]
-            paths_to_update = _paths_from_common_ancestor(paths)
-            nodes_to_invalidate = set(sum(paths_to_update, []))
+            # Update the persisted samples
+            if transfers:
+                stmt = nodes_samples.delete().where(
+                    nodes_samples.c.node_id.in_(list(transfers.keys()))
+                    & nodes_samples.c.object_id.in_(moved_object_ids)
+                )
+                self.connection.execute(stmt)
+            self._add_to_sample(node_id, moved_object_ids)
+            self._bump_objects_versions(set(transfers) | {node_id})
 
-            print("Invalidating {!r}...".format(nodes_to_invalidate))
+            # Invalidate the paths from the first common ancestor of new and old node
+            # and transfer the counts and vector sums
+            deltas = collections.defaultdict(_CacheDelta)
+            nodes_to_invalidate = {node_id}
+
+            for old_node_id, (n_objects, vector_sum) in transfers.items():
+                dst_path, src_path = _paths_from_common_ancestor(
+                    [new_node_path, self.get_path_ids(old_node_id)]
+                )
+                nodes_to_invalidate.update(dst_path + src_path)
+
+                deltas[node_id].n_objects += n_objects
+                deltas[old_node_id].n_objects -= n_objects
+
+                _add_transfer_deltas(deltas, dst_path, src_path, n_objects, vector_sum)
 
-            assert node_id in nodes_to_invalidate
+            self._apply_cache_deltas(deltas)
+
+            print("Invalidating {!r}...".format(nodes_to_invalidate))
 
             self.invalidate_nodes(nodes_to_invalidate, unapprove)
 
@@ -1354,8 +2817,8 @@ class Tree(object):
             return
 
         with self.connection.begin():
-            # Acquire project lock
-            self.lock_project_for_node(node_id)
+            # Acquire subtree lock
+            self.lock_subtree([node_id])
 
             # Poject id of the node
             project_id = select([nodes.c.project_id]).where(nodes.c.node_id == node_id)
@@ -1373,6 +2836,22 @@ class Tree(object):
                 ],
             )
 
+            self.bump_versions([node_id])
+
+    def get_rejected_object_ids(self, node_id, limit=None):
+        """
+        Get objects that were rejected for a node (see reject_objects).
+        """
+
+        stmt = select([nodes_rejected_objects.c.object_id]).where(
+            nodes_rejected_objects.c.node_id == node_id
+        )
+
+        if limit is not None:
+            stmt = stmt.limit(limit)
+
+        return [r for (r,) in self.connection.execute(stmt)]
+
     def update_node(self, node_id, data):
         if "parent_id" in data:
             warnings.warn("parent_id in data")
@@ -1383,6 +2862,8 @@ class Tree(object):
         stmt = nodes.update().values(data).where(nodes.c.node_id == node_id)
         self.connection.execute(stmt)
 
+        self.bump_versions([node_id])
+
     def get_tip(self, node_id):
         """
         Get the id of the tip (descendant with maximum depth) below a node.
@@ -1393,26 +2874,24 @@ class Tree(object):
             - is has children
         """
 
+        topology = self._get_topology(node_id)
+        if topology is not None:
+            return topology.tip(node_id)
+
+        # Descendants that are only separated from node_id by unapproved and unstarred nodes
         stmt = text(
             """
-        WITH    RECURSIVE
-        q AS
-        (
-            SELECT  node_id, starred, 1 as level
-            FROM    nodes AS n
-            WHERE   node_id = :node_id
-            UNION ALL
-            SELECT  nd.node_id, nd.starred, level + 1
-            FROM    q
-            JOIN    nodes AS nd
-            ON      nd.parent_id = q.node_id
-            WHERE nd.approved = 'f' AND nd.starred = 'f'
-        )
-        SELECT q.node_id
-        FROM q LEFT JOIN nodes as c ON c.parent_id = q.node_id
-        GROUP BY q.node_id, q.level
-        HAVING COUNT(c.*) > 0
-        ORDER BY q.level desc
+        SELECT  d.node_id
+        FROM    nodes AS d
+        WHERE   d.path @> ARRAY[CAST(:node_id AS BIGINT)]
+        AND     NOT EXISTS (
+                    SELECT  1
+                    FROM    nodes AS a
+                    WHERE   a.node_id = ANY(d.path[array_position(d.path, CAST(:node_id AS BIGINT)) + 1:])
+                    AND     (a.approved OR a.starred)
+                )
+        AND     EXISTS (SELECT 1 FROM nodes AS c WHERE c.parent_id = d.node_id)
+        ORDER BY array_length(d.path, 1) DESC
         LIMIT 1
         """
         )
@@ -1426,21 +2905,23 @@ class Tree(object):
         Descend into the tree while a node is not starred. Return only starred nodes.
         """
 
-        rquery = (
-            select([nodes]).where(nodes.c.node_id == root_node_id).cte(recursive=True)
-        )
-
-        parents = rquery.alias("n")
-        descendants = nodes.alias("nd")
-
-        rquery = rquery.union_all(
-            # Include descendants when the parent is not starred
-            select([descendants]).where(
-                (not parents.c.starred) & (descendants.c.parent_id == parents.c.node_id)
-            )
-        )
+        # Starred descendants without starred nodes between root_node_id and them
+        starred_ids = text(
+            """
+        SELECT  d.node_id
+        FROM    nodes AS d
+        WHERE   d.path @> ARRAY[CAST(:node_id AS BIGINT)]
+        AND     d.starred
+        AND     NOT EXISTS (
+                    SELECT  1
+                    FROM    nodes AS a
+                    WHERE   a.node_id = ANY(d.path[array_position(d.path, CAST(:node_id AS BIGINT)):array_length(d.path, 1) - 1])
+                    AND     a.starred
+                )
+        """
+        ).bindparams(node_id=root_node_id).columns(node_id=BigInteger)
 
-        stmt = select([rquery]).where(rquery.c.starred)
+        stmt = select([nodes]).where(nodes.c.node_id.in_(starred_ids))
 
         result = self.connection.execute(stmt).fetchall()
 
@@ -1448,6 +2929,30 @@ class Tree(object):
             self._upgrade_node(dict(r), require_valid=require_valid) for r in result
         ]
 
+    def get_next_unapproved(self, node_id, leaf=False):
+        """
+        Get the id of the next unapproved node (see get_next_node).
+
+        Descend only into unapproved nodes, as approval is for a whole subtree.
+
+        Parameters:
+            leaf: Only return leaves.
+        """
+
+        topology = self._get_topology(node_id)
+        if topology is not None:
+            return topology.next_unapproved(node_id, leaf)
+
+        # Descend if the successor is not approved
+        def recurse_cb(_, s):
+            return s.c.approved == False
+
+        # Filter descendants that are not approved
+        def filter(subtree):
+            return subtree.c.approved == False
+
+        return self.get_next_node(node_id, leaf=leaf, recurse_cb=recurse_cb, filter=filter)
+
     def get_next_node(
         self,
         node_id,
@@ -1528,7 +3033,218 @@ class Tree(object):
 
         return None
 
-    def consolidate_node(self, node_id, depth=0, descend_approved=True, return_=None):
+    def _refill_samples(self, node_ids):
+        """
+        Recreate the persisted object samples of the provided nodes.
+
+        This sorts all objects of each node and is only required if a sample
+        became too small.
+        """
+
+        node_ids = [int(n) for n in node_ids]
+
+        if not node_ids:
+            return
+
+        self.connection.execute(
+            nodes_samples.delete().where(nodes_samples.c.node_id.in_(node_ids))
+        )
+
+        rand = coalesce(objects.c.rand, 1.0)
+        rank = (
+            func.row_number()
+            .over(partition_by=nodes_objects.c.node_id, order_by=rand)
+            .label("rank")
+        )
+
+        ranked = (
+            select(
+                [
+                    nodes_objects.c.node_id,
+                    objects.c.object_id,
+                    rand.label("rand"),
+                    rank,
+                ]
+            )
+            .select_from(objects.join(nodes_objects))
+            .where(
+                nodes_objects.c.node_id
+                == any_(bindparam("node_ids", type_=ARRAY(BigInteger)))
+            )
+            .alias("ranked")
+        )
+
+        stmt = nodes_samples.insert().from_select(
+            ["node_id", "object_id", "rand"],
+            select([ranked.c.node_id, ranked.c.object_id, ranked.c.rand]).where(
+                ranked.c.rank <= SAMPLE_SIZE
+            ),
+        )
+
+        self.connection.execute(stmt, node_ids=node_ids)
+
+    def _add_to_sample(self, node_id, object_ids):
+        """
+        Add objects that were moved into a node to its persisted sample.
+
+        The sample consists of the objects with the smallest objects.rand.
+        If the sample does not contain all objects of the node, only objects below its
+        largest rand are added because larger ones might be preceded by objects
+        that are not in the sample.
+        The sample is then truncated to SAMPLE_SIZE.
+
+        Must be called before the cached _n_objects of the node are updated.
+        """
+
+        if not object_ids:
+            return
+
+        stmt = select([func.count(), func.max(nodes_samples.c.rand)]).where(
+            nodes_samples.c.node_id == node_id
+        )
+        n_sample, max_rand = self.connection.execute(stmt).fetchone()
+
+        stmt = select([nodes.c._n_objects]).where(nodes.c.node_id == node_id)
+        n_objects = self.connection.execute(stmt).scalar()
+
+        rand = coalesce(objects.c.rand, 1.0)
+
+        select_stmt = select([literal(node_id), objects.c.object_id, rand]).where(
+            objects.c.object_id.in_(list(object_ids))
+        )
+
+        if n_objects is None or n_sample < n_objects:
+            if max_rand is None:
+                return
+            select_stmt = select_stmt.where(rand < max_rand)
+
+        stmt = (
+            pg_insert(nodes_samples)
+            .from_select(["node_id", "object_id", "rand"], select_stmt)
+            .on_conflict_do_nothing()
+        )
+        self.connection.execute(stmt)
+
+        # Truncate to SAMPLE_SIZE
+        surplus = (
+            select([nodes_samples.c.object_id])
+            .where(nodes_samples.c.node_id == node_id)
+            .order_by(nodes_samples.c.rand)
+            .offset(SAMPLE_SIZE)
+        )
+        stmt = nodes_samples.delete().where(
+            (nodes_samples.c.node_id == node_id)
+            & nodes_samples.c.object_id.in_(surplus)
+        )
+        self.connection.execute(stmt)
+
+    def _query_object_samples(self, n_objects, chunksize=10000):
+        """
+        Read the persisted object samples of multiple nodes in a single query.
+
+        Samples that are smaller than min(n_objects, SAMPLE_SIZE / 2)
+        (because objects were removed or the sample was never filled) are refilled first.
+
+        Parameters:
+            n_objects: Series of the number of objects directly below each node, indexed by node_id.
+
+        Returns:
+            _ObjectSamples
+        """
+
+        node_ids = [int(n) for n in n_objects.index]
+
+        stmt = (
+            select([nodes_samples.c.node_id, func.count()])
+            .where(
+                nodes_samples.c.node_id
+                == any_(bindparam("node_ids", type_=ARRAY(BigInteger)))
+            )
+            .group_by(nodes_samples.c.node_id)
+        )
+        n_sample = pd.Series(
+            dict(self.connection.execute(stmt, node_ids=node_ids).fetchall()),
+            index=n_objects.index,
+            dtype=float,
+        ).fillna(0)
+
+        incomplete = n_sample < np.minimum(n_objects, SAMPLE_SIZE // 2)
+        self._refill_samples(n_objects.index[incomplete])
+
+        store = self._get_vector_store()
+
+        columns = [nodes_samples.c.node_id, objects.c.object_id]
+        if store is None:
+            columns.append(_vector_column().label("vector"))
+
+        stmt = (
+            select(columns)
+            .select_from(nodes_samples.join(objects))
+            .where(
+                nodes_samples.c.node_id
+                == any_(bindparam("node_ids", type_=ARRAY(BigInteger)))
+            )
+            .order_by(nodes_samples.c.node_id, nodes_samples.c.rand)
+        )
+
+        result = self.connection.execution_options(stream_results=True).execute(
+            stmt, node_ids=node_ids
+        )
+
+        sample_node_ids = []
+        sample_object_ids = []
+        sample_vectors = []
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+
+            if store is None:
+                vectors = [r["vector"] for r in rows]
+            else:
+                vectors = self.get_vectors([r["object_id"] for r in rows], store)
+            n_none = sum(1 for v in vectors if v is None)
+            if n_none:
+                raise ValueError(
+                    f"vectors contain {n_none} None entries (out of {len(vectors)})"
+                )
+
+            sample_node_ids.append(np.array([r["node_id"] for r in rows]))
+            sample_object_ids.append(
+                np.array([r["object_id"] for r in rows], dtype=object)
+            )
+            sample_vectors.append(np.array(vectors))
+
+        if not sample_node_ids:
+            return _ObjectSamples(
+                np.empty(0, dtype=int), np.empty(0, dtype=object), np.empty((0, 0))
+            )
+
+        return _ObjectSamples(
+            np.concatenate(sample_node_ids),
+            np.concatenate(sample_object_ids),
+            np.concatenate(sample_vectors),
+        )
+
+    def _write_back_consolidated(self, values: pd.DataFrame):
+        """
+        Write consolidated values back to the database in one bulk update.
+
+        Parameters:
+            values: DataFrame indexed by node_id containing _CONSOLIDATED_FIELDS.
+        """
+
+        # Build the result list of dicts with node_id and only _CONSOLIDATED_FIELDS
+        result = values[_CONSOLIDATED_FIELDS].copy()
+        result["_n_objects_deep"] = result["_n_objects_deep"].astype(int)
+        result.index.rename("node_id", inplace=True)
+        result.reset_index(inplace=True)
+
+        bulk_update(self.connection, nodes, "node_id", result.to_dict("records"))
+
+    def consolidate_node(
+        self, node_id, depth=0, descend_approved=True, return_=None, workers=None
+    ):
         """
         Ensures that the calculated values of this node are valid.
 
@@ -1538,6 +3254,8 @@ class Tree(object):
             node_id: Root of the subtree that gets consolidated.
             depth: Ensure validity of cached values at least up to a certain depth.
             return_: None | "node" | "children". Return this node or its children.
+            workers: Number of worker processes. If greater than one, the nodes of each
+                level of the subtree are calculated in parallel.
 
         Returns:
             node dict or list of children, depending on return_ parameter.
@@ -1555,8 +3273,8 @@ class Tree(object):
 
             # Wrap everything in a transaction
             with self.connection.begin():
-                # Acquire project lock
-                self.lock_project_for_node(node_id)
+                # Acquire subtree lock
+                self.lock_subtree([node_id])
 
                 if depth == -1:
                     if descend_approved:
@@ -1614,142 +3332,129 @@ class Tree(object):
                     invalid_subtree["_n_objects"] = invalid_subtree["_n_objects_"]
                     invalid_subtree["_n_children"] = invalid_subtree["_n_children_"]
 
-                    invalid_subtree["__updated"] = False
+                    n_updated = 0
+                    bar = ProgressBar(
+                        (~invalid_subtree["cache_valid"]).sum(), max_width=40
+                    )
+
+                    # Index the subtree and extract the columns that are required
+                    # to calculate the parents
+                    subtree = Subtree(
+                        invalid_subtree.index, invalid_subtree["parent_id"]
+                    )
+                    cache_valid = invalid_subtree["cache_valid"].to_numpy(dtype=bool)
+                    n_objects = invalid_subtree["_n_objects"].to_numpy()
+                    child_values = {
+                        "node_id": subtree.node_ids,
+                        "_n_objects_deep": invalid_subtree["_n_objects_deep"].to_numpy(
+                            dtype=float, na_value=np.nan
+                        ),
+                    }
+                    for field in _CHILD_FIELDS:
+                        if field not in child_values:
+                            child_values[field] = invalid_subtree[field].to_numpy(
+                                dtype=object, copy=True
+                            )
+                    own_prototypes = invalid_subtree["_own_prototypes"].to_numpy(
+                        dtype=object
+                    )
+
+                    # Use a bounded sample of objects per node to speed up the calculation
+                    with t.child("_query_object_samples"):
+                        samples = self._query_object_samples(
+                            invalid_subtree.loc[
+                                ~invalid_subtree["cache_valid"], "_n_objects_"
+                            ]
+                        )
 
-                    # Initialize clusterer
-                    clusterer = KMeans(N_PROTOTYPES, n_init=2)
+                    n_prototypes = self.get_n_prototypes(
+                        int(invalid_subtree["project_id"].iloc[0])
+                    )
 
-                    # Iterate over DataFrame fixing the values along the way
-                    bar = ProgressBar(len(invalid_subtree), max_width=40)
-                    for node_id in invalid_subtree.index:
-                        try:
-                            if invalid_subtree.at[node_id, "cache_valid"]:
-                                # Don't recalculate valid nodes as invalid_subtree (rightly)
-                                # doesn't include their children.
+                    if workers is not None and workers > 1:
+                        executor = concurrent.futures.ProcessPoolExecutor(
+                            workers, initializer=_init_consolidation_worker
+                        )
+                        map_ = functools.partial(executor.map, chunksize=16)
+                    else:
+                        executor = None
+                        map_ = map
+
+                    try:
+                        # Process the subtree level by level, deepest first.
+                        # All nodes on one level only depend on their children,
+                        # so they can be calculated independently.
+                        for level_rows in reversed(subtree.levels):
+                            # Don't recalculate valid nodes as invalid_subtree (rightly)
+                            # doesn't include their children.
+                            level_rows = level_rows[~cache_valid[level_rows]]
+
+                            if len(level_rows) == 0:
                                 continue
 
-                            child_selector = invalid_subtree["parent_id"] == node_id
-                            children = invalid_subtree.loc[child_selector]
-                            # Build collection of children. (Set centroid of children without a vector to zero to allow alignment with cardinalities.)
-                            children_dict = MemberCollection(
-                                children.reset_index().to_dict("records"), "zero"
-                            )
+                            level_node_ids = subtree.node_ids[level_rows]
 
                             # 2. _n_objects_deep
-                            _n_objects = invalid_subtree.loc[node_id, "_n_objects"]
-                            _n_objects_deep = (
-                                _n_objects + children["_n_objects_deep"].sum()
-                            )
-                            invalid_subtree.at[
-                                node_id, "_n_objects_deep"
-                            ] = _n_objects_deep
-
-                            # Sample 1000 objects to speed up the calculation
-                            with t.child("get_objects"):
-                                objects_ = MemberCollection(
-                                    self.get_objects(
-                                        node_id, order_by=objects.c.rand, limit=1000
-                                    ),
-                                    "raise",
-                                )
+                            n_objects_deep = child_values["_n_objects_deep"]
+                            n_objects_deep[level_rows] = n_objects[
+                                level_rows
+                            ] + subtree.sum_children(n_objects_deep, level_rows)
+                            invalid_subtree.loc[
+                                level_node_ids, "_n_objects_deep"
+                            ] = n_objects_deep[level_rows]
+
+                            level_children = [
+                                [
+                                    {f: child_values[f][c] for f in _CHILD_FIELDS}
+                                    for c in subtree.child_rows(row)
+                                ]
+                                for row in level_rows
+                            ]
 
-                            # 3. _own_type_objects, _type_objects
-                            # TODO: Replace _own_type_objects with "_atypical_objects"
-                            with t.child("_calc_own_type_objects"):
-                                invalid_subtree.at[
-                                    node_id, "_own_type_objects"
-                                ] = self._calc_own_type_objects(children_dict, objects_)
-                                # self._calc_own_type_objects(children_dict, objects_)
-
-                            with t.child("_calc_type_objects"):
-                                invalid_subtree.at[
-                                    node_id, "_type_objects"
-                                ] = self._calc_type_objects(children_dict, objects_)
-
-                            if (
-                                len(children_dict) > 0
-                                and len(invalid_subtree.at[node_id, "_type_objects"])
-                                == 0
-                            ):
-                                print(
-                                    "\nNode {} has no type objects although it has children!".format(
-                                        node_id
-                                    )
+                            level_object_ids = []
+                            level_object_vectors = []
+                            for nid in level_node_ids:
+                                object_ids, object_vectors = samples[nid]
+                                level_object_ids.append(object_ids)
+                                level_object_vectors.append(object_vectors)
+
+                            # 3. _own_type_objects, _type_objects, _centroid, _prototypes
+                            with t.child("_consolidate_values"):
+                                results = map_(
+                                    _consolidate_values,
+                                    level_node_ids,
+                                    n_objects[level_rows],
+                                    level_children,
+                                    level_object_ids,
+                                    level_object_vectors,
+                                    itertools.repeat(n_prototypes),
+                                    # Previous prototypes of the own objects to warm-start the fit
+                                    own_prototypes[level_rows],
                                 )
 
-                            # 4. _centroid
-                            with t.child("_centroid"):
-                                _centroid = []
-                                _centroid_support = 0
-
-                                if len(objects_) > 0:
-                                    # Object mean, weighted with number of objects
-                                    _centroid.append(np.sum(objects_.vectors, axis=0))
-                                    _centroid_support += len(objects_)
-
-                                if len(children_dict) > 0:
-                                    # Children mean
-                                    cardinalities = children_dict.cardinalities
-                                    children_mean = np.sum(
-                                        cardinalities[:, np.newaxis]
-                                        * children_dict.vectors,
-                                        axis=0,
-                                    )
-                                    _centroid.append(children_mean)
-                                    _centroid_support += cardinalities.sum()
-
-                                if len(_centroid) > 0 and _centroid_support > 0:
-                                    _centroid = (
-                                        np.sum(_centroid, axis=0) / _centroid_support
-                                    )
-                                else:
-                                    _centroid = None
-
-                                invalid_subtree.at[node_id, "_centroid"] = _centroid
-
-                                if invalid_subtree.loc[node_id, "_centroid"] is None:
-                                    print("\nNode {} has no centroid!".format(node_id))
-
-                            # 5. _prototypes
-                            with t.child("_prototypes"):
-                                _prototypes = []
-
-                                if len(objects_) > 0:
-                                    prots = Prototypes(clusterer)
-                                    prots.fit(objects_.vectors)
-                                    _prototypes.append(prots)
-                                if len(children_dict) > 0:
-                                    _prototypes.extend(
-                                        c["_prototypes"]
-                                        for c in children_dict
-                                        if c["_prototypes"] is not None
-                                    )
-
-                                if len(_prototypes) > 0:
-                                    try:
-                                        _prototypes = merge_prototypes(
-                                            _prototypes, N_PROTOTYPES
-                                        )
-                                    except:
-                                        for prots in _prototypes:
-                                            print(prots.prototypes_)
-                                        raise
-                                else:
-                                    _prototypes = None
-                                    print(
-                                        "\nNode {} has no prototypes!".format(node_id)
-                                    )
-
-                                invalid_subtree.at[node_id, "_prototypes"] = _prototypes
-
-                            # Finally, flag as updated
-                            invalid_subtree.at[node_id, "__updated"] = True
-
-                            bar.numerator += 1
-                            print(node_id, bar, end="    \r")
-                        except:
-                            print(f"Error processing node {node_id}")
-                            raise
+                                for row, nid, values in zip(
+                                    level_rows, level_node_ids, results
+                                ):
+                                    for k, v in values.items():
+                                        invalid_subtree.at[nid, k] = v
+                                        if k in child_values:
+                                            child_values[k][row] = v
+
+                                    bar.numerator += 1
+                                    print(nid, bar, end="    \r")
+
+                            # Write the completed level back to the database
+                            with t.child("write back"):
+                                invalid_subtree.loc[
+                                    level_node_ids, "cache_valid"
+                                ] = True
+                                self._write_back_consolidated(
+                                    invalid_subtree.loc[level_node_ids]
+                                )
+                                n_updated += len(level_node_ids)
+                    finally:
+                        if executor is not None:
+                            executor.shutdown()
                     print()
 
                     # Convert _n_objects_deep to int (might be object when containing NULL values in the database)
@@ -1757,41 +3462,7 @@ class Tree(object):
                         "_n_objects_deep"
                     ].astype(int)
 
-                    # Flag all rows as valid
-                    invalid_subtree["cache_valid"] = True
-
-                    # Mask for updated rows
-                    updated_selection = invalid_subtree["__updated"] == True
-                    n_updated = updated_selection.sum()
-
-                    # Write back to database (if necessary)
-                    if n_updated > 0:
-                        # Write results back to database
-                        update_fields = [
-                            "cache_valid",
-                            "_centroid",
-                            "_prototypes",
-                            "_type_objects",
-                            "_own_type_objects",
-                            "_n_objects_deep",
-                            "_n_objects",
-                            "_n_children",
-                        ]
-
-                        stmt = (
-                            nodes.update()
-                            .where(nodes.c.node_id == bindparam("_node_id"))
-                            .values({k: bindparam(k) for k in update_fields})
-                        )
-
-                        # Build the result list of dicts with _node_id and only update_fields
-                        result = invalid_subtree.loc[updated_selection, update_fields]
-                        result.index.rename("_node_id", inplace=True)
-                        result.reset_index(inplace=True)
-
-                        self.connection.execute(stmt, result.to_dict("records"))
-
-                        print("Updated {:d} nodes.".format(n_updated))
+                    print("Updated {:d} nodes.".format(n_updated))
 
                 if return_ == "node":
                     return invalid_subtree.loc[node_id].to_dict()
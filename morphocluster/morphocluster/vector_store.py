@@ -0,0 +1,117 @@
+"""
+Memory-mapped store of object vectors.
+
+The vectors are kept in a float32 .npy file that is mapped read-only by every worker,
+so that all workers share the same pages and lookups need neither a database
+round-trip nor parsing of the CUBE text representation.
+"""
+
+import functools
+import os
+import shutil
+
+import numpy as np
+
+
+class VectorStore:
+    """
+    Read-only mapping of object_id to vector.
+
+    Attributes:
+        vectors: float32 array of shape = [n_objects, n_features]
+        sorted_ids: Sorted object_ids.
+        sorted_rows: Row in vectors for every entry of sorted_ids.
+    """
+
+    _FIELDS = ("vectors", "sorted_ids", "sorted_rows")
+
+    def __init__(self, vectors, sorted_ids, sorted_rows):
+        self.vectors = vectors
+        self.sorted_ids = sorted_ids
+        self.sorted_rows = sorted_rows
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map a store read-only.
+        """
+        return cls(
+            **{
+                field: np.load(os.path.join(path, field + ".npy"), mmap_mode="r")
+                for field in cls._FIELDS
+            }
+        )
+
+    @staticmethod
+    def save(path, object_ids, vectors):
+        """
+        Write a store.
+
+        The store is written next to path and then moved into place,
+        so that readers never see an incomplete store.
+        Workers that still map the previous version keep a valid mapping.
+        """
+        object_ids = np.asarray(object_ids, dtype=str)
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        order = np.argsort(object_ids)
+
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        np.save(os.path.join(tmp_path, "vectors.npy"), vectors)
+        np.save(os.path.join(tmp_path, "sorted_ids.npy"), object_ids[order])
+        np.save(os.path.join(tmp_path, "sorted_rows.npy"), order.astype(np.int64))
+
+        old_path = path + ".old"
+        if os.path.exists(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def lookup(self, object_ids):
+        """
+        Find the rows of object_ids.
+
+        Returns:
+            Array of rows in self.vectors (-1 for unknown objects).
+        """
+        object_ids = np.asarray(object_ids, dtype=str)
+
+        if len(self.sorted_ids) == 0:
+            return np.full(len(object_ids), -1, dtype=np.int64)
+
+        pos = np.searchsorted(self.sorted_ids, object_ids)
+        pos = np.minimum(pos, len(self.sorted_ids) - 1)
+        found = self.sorted_ids[pos] == object_ids
+
+        return np.where(found, self.sorted_rows[pos], -1)
+
+
+@functools.lru_cache(maxsize=2)
+def _load_cached(path, mtime):
+    # mtime is part of the cache key so that a rewritten store is mapped again
+    return VectorStore.load(path)
+
+
+def load_vector_store(path):
+    """
+    Map a vector store and keep it mapped until it is rewritten.
+
+    Returns:
+        VectorStore or None if path is None or no store exists at path.
+    """
+    if path is None:
+        return None
+
+    try:
+        mtime = os.path.getmtime(os.path.join(path, "vectors.npy"))
+    except FileNotFoundError:
+        return None
+
+    return _load_cached(path, mtime)
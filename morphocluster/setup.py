@@ -16,6 +16,7 @@ setup(
         "h5py>=3.1.0",
         "scikit-learn",
         "scipy",
+        "threadpoolctl",
         "redis>=3.5.0",
         "hiredis",
         "flask-restful",
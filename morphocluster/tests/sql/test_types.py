@@ -1,8 +1,19 @@
+import struct
+
+import numpy as np
 import pytest
 from sqlalchemy import Column, Table
 
 from morphocluster.extensions import database
-from morphocluster.sql.types import Point
+from morphocluster.processing.prototypes import Prototypes
+from morphocluster.sql.types import (
+    FloatArray,
+    Point,
+    decode_array,
+    decode_prototypes,
+    encode_array,
+    encode_prototypes,
+)
 
 _point_table = Table(
     "point_table",
@@ -47,3 +58,76 @@ def test_point(point_table, db_connection):
     ]
 
     assert values_actual == [v[1] for v in values_target]
+
+
+@pytest.mark.parametrize("shape", [(0,), (32,), (16, 32), (0, 32)])
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_array(shape, dtype):
+    value = np.random.rand(*shape)
+
+    buffer = encode_array(value, dtype)
+    decoded, offset = decode_array(memoryview(buffer))
+
+    assert offset == len(buffer)
+    assert decoded.dtype == np.dtype(dtype)
+    assert decoded.shape == shape
+    np.testing.assert_allclose(decoded, value, rtol=1e-6)
+
+    # Decoding does not copy
+    assert not decoded.flags.writeable
+
+
+def test_array_invalid():
+    with pytest.raises(ValueError):
+        encode_array(np.zeros((2, 2, 2)))
+
+    with pytest.raises(ValueError):
+        decode_array(b"XX" + encode_array(np.zeros(3))[2:])
+
+
+def test_prototypes():
+    prototypes = Prototypes(None)
+    prototypes.prototypes_ = np.random.rand(5, 32)
+    prototypes.support_ = np.arange(5)
+
+    decoded = decode_prototypes(encode_prototypes(prototypes))
+
+    assert decoded.prototypes_.dtype == np.float32
+    np.testing.assert_allclose(decoded.prototypes_, prototypes.prototypes_, rtol=1e-6)
+    np.testing.assert_array_equal(decoded.support_, prototypes.support_)
+
+
+def test_float_array():
+    float_array = FloatArray()
+    bind = float_array.bind_processor(None)
+    result = float_array.result_processor(None, None)
+
+    assert bind(None) is None
+    assert result(None) is None
+
+    value = np.random.rand(512)
+    bound = bind(value)
+
+    # 512 dimensions are no problem
+    assert len(bound) == 512
+    assert all(type(v) is float for v in bound)
+
+    decoded = result(bound)
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, value, rtol=1e-6)
+
+    # Binary representation (array_send)
+    buffer = struct.pack(">iiIii", 1, 0, 700, len(value), 1) + b"".join(
+        struct.pack(">if", 4, v) for v in value
+    )
+    decoded = result(memoryview(buffer))
+    assert decoded.dtype == np.float32
+    assert decoded.shape == (512,)
+    np.testing.assert_allclose(decoded, value, rtol=1e-6)
+
+    # Empty array
+    assert result(struct.pack(">iiI", 0, 0, 700)).shape == (0,)
+
+    # NULL elements
+    with pytest.raises(ValueError):
+        result(struct.pack(">iiIii", 1, 1, 700, 1, 1) + struct.pack(">i", -1))
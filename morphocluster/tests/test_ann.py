@@ -0,0 +1,75 @@
+"""
+pytest file for processing.ann.IVFIndex
+"""
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+from morphocluster.processing.ann import IVFIndex, load_index
+
+N_FEATURES = 16
+
+
+@pytest.fixture(params=[1, 10, 1000], name="dset")
+def fixture_dset(request):
+    rng = np.random.default_rng(request.param)
+    vectors = rng.random((request.param, N_FEATURES), dtype=np.float32)
+    object_ids = np.array(["obj{}".format(i) for i in range(request.param)])
+    return object_ids, vectors
+
+
+def test_iter_candidates(dset):
+    object_ids, vectors = dset
+    queries = np.random.rand(3, N_FEATURES)
+
+    index = IVFIndex.build(object_ids, vectors)
+
+    assert index.offsets[-1] == len(object_ids)
+
+    candidate_ids, distances = zip(*index.iter_candidates(queries, n_probe=2))
+    candidate_ids = np.concatenate(candidate_ids)
+    distances = np.concatenate(distances)
+
+    # Exhaustive iteration yields every object exactly once
+    assert sorted(candidate_ids) == sorted(object_ids)
+
+    expected = dict(zip(object_ids, cdist(vectors, queries).min(axis=1)))
+    np.testing.assert_allclose(
+        distances, [expected[o] for o in candidate_ids], rtol=1e-4, atol=1e-4
+    )
+
+
+def test_iter_candidates_max_cells(dset):
+    object_ids, vectors = dset
+    queries = np.random.rand(3, N_FEATURES)
+
+    index = IVFIndex.build(object_ids, vectors)
+
+    candidate_ids = [c for c, _ in index.iter_candidates(queries, 1, max_cells=1)]
+
+    assert len(candidate_ids) <= 1
+    assert sum(len(c) for c in candidate_ids) <= np.diff(index.offsets).max()
+
+
+def test_save_load(dset, tmp_path):
+    object_ids, vectors = dset
+
+    assert load_index(str(tmp_path / "missing")) is None
+
+    index = IVFIndex.build(object_ids, vectors)
+    index.save(str(tmp_path / "index"))
+
+    loaded = load_index(str(tmp_path / "index"))
+
+    np.testing.assert_array_equal(loaded.offsets, index.offsets)
+    np.testing.assert_array_equal(loaded.object_ids, index.object_ids)
+    np.testing.assert_array_equal(loaded.vectors, index.vectors)
+
+    # Rebuilding replaces the index as a whole
+    rebuilt = IVFIndex.build(object_ids[::-1], vectors[::-1])
+    rebuilt.save(str(tmp_path / "index"))
+
+    loaded = IVFIndex.load(str(tmp_path / "index"))
+    np.testing.assert_array_equal(loaded.object_ids, rebuilt.object_ids)
+    assert not (tmp_path / "index.tmp").exists()
@@ -0,0 +1,43 @@
+"""
+pytest file for processing.distance
+"""
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+from morphocluster.processing.distance import top_k_min_distances
+
+
+@pytest.mark.parametrize("n", [0, 1, 100, 1000])
+@pytest.mark.parametrize("k", [1, 10, 2000])
+@pytest.mark.parametrize("normalized", [False, True])
+def test_top_k_min_distances(n, k, normalized):
+    X = np.random.rand(n, 16)
+    if normalized:
+        X /= np.linalg.norm(X, axis=1, keepdims=True)
+    P = np.random.rand(4, 16)
+
+    indices, distances = top_k_min_distances(
+        X, P, k, normalized=normalized, chunksize=64
+    )
+
+    expected = cdist(X, P).min(axis=1) if n else np.empty(0)
+    expected_order = np.argsort(expected)[:k]
+
+    assert len(indices) == min(n, k)
+    np.testing.assert_allclose(distances, expected[expected_order], atol=1e-3)
+    np.testing.assert_allclose(expected[indices], distances, atol=1e-3)
+    assert np.all(np.diff(distances) >= 0)
+
+
+def test_top_k_min_distances_rows():
+    X = np.random.rand(100, 8)
+    P = np.random.rand(2, 8)
+    rows = np.array([5, 17, 42, 99])
+
+    indices, distances = top_k_min_distances(X, P, 2, rows=rows)
+
+    expected = cdist(X[rows], P).min(axis=1)
+    np.testing.assert_allclose(distances, np.sort(expected)[:2], atol=1e-4)
+    np.testing.assert_allclose(expected[indices], distances, atol=1e-4)
@@ -6,7 +6,12 @@ import numpy as np
 import pytest
 from sklearn.cluster import MiniBatchKMeans
 
-from morphocluster.processing.prototypes import Prototypes, merge_prototypes
+from morphocluster.processing.prototypes import (
+    Prototypes,
+    adaptive_k,
+    fit_prototypes,
+    merge_prototypes,
+)
 
 N_FEATURES = 32
 
@@ -75,3 +80,30 @@ def test_merge_prototypes(make_dset, k, n_children):
     assert result.prototypes_.shape[0] <= k
     assert result.prototypes_.shape[1] == N_FEATURES
     assert result.prototypes_.shape[0] == result.support_.shape[0]
+
+
+def test_fit_prototypes(make_dset, k):
+    train = make_dset()
+
+    prots = fit_prototypes(train, k)
+
+    assert prots.prototypes_.shape[0] <= k
+    assert prots.prototypes_.shape[1] == N_FEATURES
+    assert prots.prototypes_.shape[0] == prots.support_.shape[0]
+    assert prots.support_.sum() == train.shape[0]
+
+    # Warm start from the previous prototypes
+    warm = fit_prototypes(np.concatenate((train, make_dset())), k, init=prots)
+
+    assert warm.prototypes_.shape[0] <= k
+    assert warm.prototypes_.shape[1] == N_FEATURES
+    assert warm.prototypes_.dtype == np.float32
+    assert np.isfinite(warm.prototypes_).all()
+
+
+def test_adaptive_k(k):
+    assert adaptive_k(0, k) == 1
+    assert adaptive_k(10 ** 6, k) == k
+    assert all(
+        adaptive_k(n, k) <= adaptive_k(n + 1, k) for n in range(0, 20 * k, 7)
+    )
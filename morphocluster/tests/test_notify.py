@@ -0,0 +1,61 @@
+"""
+pytest file for the cross-worker invalidation (notify.InvalidationListener)
+"""
+
+import queue
+import uuid
+
+from morphocluster.extensions import database
+from morphocluster.notify import (
+    Invalidation,
+    InvalidationListener,
+    decode_payload,
+    encode_payload,
+)
+from morphocluster.tree import Tree
+
+
+def test_payload():
+    invalidation = Invalidation(1, [1, 2, 3], 5)
+    assert decode_payload(encode_payload(invalidation)) == invalidation
+
+    # Oversized payloads invalidate the whole project
+    invalidation = Invalidation(1, list(range(10000)), 5)
+    assert decode_payload(encode_payload(invalidation)) == Invalidation(1, None, 5)
+
+
+def test_listener(flask_app):
+    received = queue.Queue()
+
+    # Not registered with the app, so that no hook is added to the session app
+    listener = InvalidationListener()
+    listener.database_uri = flask_app.config["SQLALCHEMY_DATABASE_URI"]
+    listener.subscribe(received.put)
+    listener.start()
+
+    assert listener.ready.wait(10)
+
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+
+        # Notifications of rolled back transactions are not delivered
+        transaction = connection.begin()
+        tree.update_node(root_id, {"starred": True})
+        transaction.rollback()
+
+        with connection.begin():
+            tree.update_node(root_id, {"approved": True})
+
+        version = tree.get_node(root_id, require_valid=False)["version"]
+
+    # Skip the notification of create_node
+    invalidation = received.get(timeout=10)
+    while invalidation.version != version:
+        assert invalidation.version < version
+        invalidation = received.get(timeout=10)
+
+    assert invalidation == Invalidation(project_id, [root_id], version)
@@ -0,0 +1,64 @@
+"""
+pytest file for page_cache
+"""
+
+import uuid
+import zlib
+
+import pytest
+import redis
+
+from morphocluster.page_cache import CODECS, PageCache, _decode, _encode
+
+
+@pytest.fixture(name="page_cache")
+def _page_cache(docker_redis_persistent):
+    return PageCache(redis.Redis.from_url(docker_redis_persistent))
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_page_cache(page_cache: PageCache, codec):
+    page_cache.codec = codec
+    key = "test:{}".format(uuid.uuid4().hex)
+    pages = ["[1, 2]", "[3]"]
+
+    assert page_cache.get_page(key, 0) is None
+    assert page_cache.stats["misses"] == 1
+
+    page_cache.set(key, pages, ttl=60)
+    assert 0 < page_cache.redis.ttl(key) <= 60
+
+    assert page_cache.get_page(key, 1) == ("[3]", 2)
+    assert page_cache.get_page(key, 2) == ("[]", 2)
+    assert page_cache.stats["local_hits"] == 2
+
+    # A different process only has the shared tier
+    other = PageCache(page_cache.redis)
+    assert other.get_page(key, 0) == ("[1, 2]", 2)
+    assert other.get(key) == pages
+    assert other.stats["redis_hits"] == 1
+    assert other.stats["local_hits"] == 1
+
+
+def test_page_cache_local_size(page_cache: PageCache):
+    page_cache.local_size = 3
+
+    keys = ["test:{}".format(uuid.uuid4().hex) for _ in range(3)]
+    for key in keys:
+        page_cache.set(key, ["[1]", "[2]"])
+
+    # Only the most recent entry fits into the local tier
+    assert page_cache.get_stats()["local_n_pages"] == 2
+
+    assert page_cache.get(keys[0]) == ["[1]", "[2]"]
+    assert page_cache.stats["redis_hits"] == 1
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_decode(codec):
+    page = '[{"object_id": "a:b"}]'
+    assert _decode(_encode(page, codec)) == page
+
+    # Entries without codec prefix (written by previous versions)
+    assert _decode(zlib.compress(page.encode())) == page
+    assert _decode(page.encode()) == page
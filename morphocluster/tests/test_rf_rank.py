@@ -0,0 +1,42 @@
+"""
+pytest file for processing.rf_rank
+"""
+
+import numpy as np
+
+from morphocluster.processing.rf_rank import rf_rank, rf_rank_incremental
+
+
+def _blobs(n, center, random_state):
+    return random_state.normal(center, 0.1, size=(n, 8))
+
+
+def test_rf_rank():
+    random_state = np.random.RandomState(0)
+    valid = _blobs(50, 0, random_state)
+    rejected = _blobs(50, 1, random_state)
+    candidates = np.concatenate((_blobs(10, 1, random_state), _blobs(10, 0, random_state)))
+
+    order = rf_rank(candidates, valid, rejected, n_estimators=10, random_state=0)
+
+    # Candidates close to the valid vectors come first
+    assert set(order[:10]) == set(range(10, 20))
+
+
+def test_rf_rank_incremental():
+    random_state = np.random.RandomState(0)
+    valid = _blobs(50, 0, random_state)
+    rejected = _blobs(5000, 1, random_state)
+    candidates = np.concatenate((_blobs(10, 1, random_state), _blobs(10, 0, random_state)))
+
+    order, classifier = rf_rank_incremental(
+        candidates, valid, rejected, n_estimators=4, max_samples=100, random_state=0
+    )
+    assert set(order[:10]) == set(range(10, 20))
+    assert len(classifier.estimators_) == 4
+
+    order, classifier = rf_rank_incremental(
+        candidates, valid, rejected, classifier, n_estimators=4, random_state=1
+    )
+    assert set(order[:10]) == set(range(10, 20))
+    assert len(classifier.estimators_) == 8
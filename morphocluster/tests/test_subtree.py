@@ -0,0 +1,85 @@
+"""
+pytest file for subtree.Subtree
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from morphocluster.subtree import Subtree
+
+
+@pytest.fixture(params=[1, 10, 1000], name="tree")
+def fixture_tree(request):
+    n_nodes = request.param
+    rng = np.random.default_rng(n_nodes)
+
+    # Random recursive tree with shuffled rows and non-contiguous ids
+    node_ids = rng.permutation(n_nodes) * 3 + 7
+    parent_ids = np.full(n_nodes, -1)
+    for i in range(1, n_nodes):
+        parent_ids[i] = node_ids[rng.integers(i)]
+
+    order = rng.permutation(n_nodes)
+    return pd.DataFrame(
+        {"parent_id": parent_ids[order], "value": rng.integers(0, 100, n_nodes)},
+        index=node_ids[order],
+    )
+
+
+def _deep_naive(tree, node_id, combine):
+    children = tree.index[tree["parent_id"] == node_id]
+    child_sum = sum(_deep_naive(tree, c, combine) for c in children)
+    return combine(tree.at[node_id, "value"], child_sum)
+
+
+def test_structure(tree):
+    subtree = Subtree(tree.index, tree["parent_id"])
+
+    assert len(subtree) == len(tree)
+    assert len(subtree.levels[0]) == 1
+    assert sum(len(l) for l in subtree.levels) == len(tree)
+
+    for node_id in tree.index[:50]:
+        row = subtree.get_row(node_id)
+        children = set(tree.index[tree["parent_id"] == node_id])
+        assert set(subtree.node_ids[subtree.child_rows(row)]) == children
+        assert subtree.n_children[row] == len(children)
+
+
+@pytest.mark.parametrize("combine", [np.add, np.maximum])
+def test_accumulate(tree, combine):
+    subtree = Subtree(tree.index, tree["parent_id"])
+    deep = subtree.accumulate(tree["value"].to_numpy(), combine)
+
+    for node_id in tree.index[:20]:
+        expected = _deep_naive(tree, node_id, combine)
+        assert deep[subtree.get_row(node_id)] == expected
+
+
+def test_sum_children(tree):
+    subtree = Subtree(tree.index, tree["parent_id"])
+    values = tree["value"].to_numpy()
+
+    rows = subtree.get_rows(tree.index[:20])
+    sums = subtree.sum_children(values, rows)
+
+    for node_id, s in zip(tree.index[:20], sums):
+        assert s == tree.loc[tree["parent_id"] == node_id, "value"].sum()
+
+    np.testing.assert_array_equal(
+        subtree.sum_children(values)[rows], subtree.sum_children(values, rows)
+    )
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        Subtree([1, 1], [None, 1])
+
+    with pytest.raises(ValueError):
+        # Cycle
+        Subtree([1, 2, 3], [None, 3, 2])
+
+    subtree = Subtree([1, 2], [None, 1])
+    with pytest.raises(KeyError):
+        subtree.get_rows([2, 5])
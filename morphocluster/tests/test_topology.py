@@ -0,0 +1,96 @@
+"""
+pytest file for topology.Topology
+"""
+
+import numpy as np
+import pytest
+
+from morphocluster.topology import Topology, get_topology
+
+
+@pytest.fixture(params=[1, 10, 1000], name="tree")
+def fixture_tree(request):
+    n_nodes = request.param
+    rng = np.random.default_rng(n_nodes)
+
+    # Random recursive tree with shuffled rows and non-contiguous ids
+    node_ids = rng.permutation(n_nodes) * 3 + 7
+    parent_ids = np.full(n_nodes, -1)
+    for i in range(1, n_nodes):
+        parent_ids[i] = node_ids[rng.integers(i)]
+
+    order = rng.permutation(n_nodes)
+    return (
+        node_ids[order],
+        parent_ids[order],
+        rng.random(n_nodes) < 0.2,
+        rng.random(n_nodes) < 0.1,
+    )
+
+
+def _children(node_ids, parent_ids):
+    children = {n: [] for n in node_ids}
+    for n, p in zip(node_ids, parent_ids):
+        if p in children:
+            children[p].append(n)
+    return children
+
+
+def _reachable_naive(children, node_id, blocked):
+    # Depth-first traversal that does not descend into blocked nodes
+    result = [(node_id, 0)]
+    stack = [(node_id, 0)]
+    while stack:
+        n, depth = stack.pop()
+        for c in children[n]:
+            if not blocked[c]:
+                result.append((c, depth + 1))
+                stack.append((c, depth + 1))
+    return result
+
+
+def test_topology(tree):
+    node_ids, parent_ids, approved, starred = tree
+    topology = Topology(node_ids, parent_ids, approved, starred)
+    children = _children(node_ids, parent_ids)
+    parents = dict(zip(node_ids, parent_ids))
+
+    flags = dict(zip(node_ids, approved | starred))
+
+    for node_id in node_ids[:50]:
+        # Path
+        path = [node_id]
+        while parents[path[0]] in parents:
+            path.insert(0, parents[path[0]])
+        assert topology.path_ids(node_id) == path
+
+        # Descendants
+        subtree = _reachable_naive(children, node_id, dict.fromkeys(node_ids, False))
+        assert topology.n_descendants(node_id) == len(subtree)
+        for d, _ in subtree[:10]:
+            assert topology.is_descendant(d, node_id)
+
+        # Tip: Maximum depth of the reachable nodes with children
+        reachable = _reachable_naive(children, node_id, flags)
+        depths = [depth for n, depth in reachable if children[n]]
+        tip = topology.tip(node_id)
+        if depths:
+            assert children[tip]
+            assert dict(reachable)[tip] == max(depths)
+        else:
+            assert tip is None
+
+
+def test_get_topology():
+    calls = []
+
+    def load():
+        calls.append(None)
+        return [1, 2], [-1, 1], [False, False], [False, False]
+
+    assert get_topology(-1, 0, load) is get_topology(-1, 0, load)
+    assert len(calls) == 1
+
+    # A new version is loaded again
+    assert get_topology(-1, 1, load).version == 1
+    assert len(calls) == 2
@@ -0,0 +1,326 @@
+"""
+pytest file for tree.Tree
+"""
+
+import concurrent.futures
+import time
+import uuid
+
+import pytest
+import sqlalchemy
+from sqlalchemy.pool import NullPool
+
+from morphocluster.extensions import database
+from morphocluster.models import nodes_objects, objects
+from morphocluster.tree import Tree, TreeError, _node_lock_key
+
+
+@pytest.fixture(name="chain")
+def _chain(flask_app):
+    """
+    A project with a root and two branches of depth 3 (node_ids, root first).
+    """
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+            a1 = tree.create_node(project_id, parent_id=root_id)
+            a2 = tree.create_node(project_id, parent_id=a1)
+            b1 = tree.create_node(project_id, parent_id=root_id)
+            b2 = tree.create_node(project_id, parent_id=b1)
+            b3 = tree.create_node(project_id, parent_id=b2)
+
+        yield [root_id, a1, a2, b1, b2, b3]
+
+
+def test_get_paths(flask_app, chain):
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        paths = tree.get_paths(chain)
+
+        assert set(paths) == set(chain)
+        for node_id in chain:
+            assert paths[node_id] == tree.get_path_ids(node_id)
+
+        assert tree.get_paths([]) == {}
+
+
+def test_materialized_path(flask_app, chain):
+    root_id, a1, a2, b1, b2, b3 = chain
+
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        def check_paths():
+            for node_id in chain:
+                assert tree.get_path_ids(node_id) == tree._get_path_ids_recursive(
+                    node_id
+                )
+
+        check_paths()
+        assert tree.node_n_descendants(root_id) == 6
+
+        # Move b1 (with b2 and b3) below a2
+        tree.relocate_nodes([b1], a2)
+        check_paths()
+        assert tree.get_path_ids(b3) == [root_id, a1, a2, b1, b2, b3]
+        assert tree.node_n_descendants(a1) == 5
+
+        # Merge b2 into a1 (b3 becomes a child of a1)
+        tree.merge_node_into(b2, a1)
+        assert tree.get_path_ids(b3) == [root_id, a1, b3]
+
+        # The deepest node with children
+        assert tree.get_tip(root_id) == a2
+
+
+def test_consolidate_node_return(flask_app, chain):
+    root_id, a1, a2, *_ = chain
+
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        node = tree.consolidate_node(a1, depth="full", return_="node")
+        assert node["parent_id"] == root_id
+        assert node["cache_valid"]
+
+        children = tree.consolidate_node(a1, depth="full", return_="children")
+        assert [c["parent_id"] for c in children] == [a1]
+
+
+def test_get_node_stale(flask_app, chain):
+    root_id, a1, *_ = chain
+
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+        tree.consolidate_node(root_id, depth="full")
+
+        with connection.begin():
+            tree.invalidate_nodes([a1])
+
+        project_id = tree.get_node(root_id, require_valid=False)["project_id"]
+
+        # Hold the project lock in a separate session
+        engine = sqlalchemy.create_engine(
+            flask_app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+        )
+        with engine.connect() as other:
+            transaction = other.begin()
+            tree_other = Tree(other)
+            tree_other.lock_project(project_id)
+
+            # The stale read does not wait for the lock
+            node = tree.get_node(a1, allow_stale=True)
+            assert node["stale"]
+
+            transaction.rollback()
+
+        # The node is revalidated asynchronously
+        for _ in range(100):
+            if tree.get_node(a1, require_valid=False)["cache_valid"]:
+                break
+            time.sleep(0.1)
+        else:
+            pytest.fail("Node was not revalidated.")
+
+        assert not tree.get_node(a1, allow_stale=True)["stale"]
+
+
+def test_lock_subtree(flask_app, chain):
+    root_id, a1, a2, b1, b2, b3 = chain
+
+    engine = sqlalchemy.create_engine(
+        flask_app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+    )
+
+    with flask_app.app_context(), engine.connect() as conn_a, engine.connect() as conn_b:
+        tree_a, tree_b = Tree(conn_a), Tree(conn_b)
+        project_id = tree_a.get_node(root_id, require_valid=False)["project_id"]
+
+        def assert_blocked(lock):
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                with conn_b.begin():
+                    conn_b.execute("SET LOCAL lock_timeout = '100ms'")
+                    lock()
+
+        with conn_a.begin():
+            assert tree_a.lock_subtree([a2]) == a2
+
+            # Disjoint subtree
+            with conn_b.begin():
+                assert tree_b.lock_subtree([b2, b3]) == b2
+
+            # Ancestor of a2
+            assert_blocked(lambda: tree_b.lock_subtree([a1]))
+
+            # The common ancestor of a2 and b1 is the root
+            assert_blocked(lambda: tree_b.lock_subtree([a2, b1]))
+
+            # Whole project
+            assert_blocked(lambda: tree_b.lock_project(project_id))
+
+
+def test_lock_subtree_moved(flask_app, chain):
+    """
+    If a node is moved while waiting for the lock, the locks of the old path are released.
+    """
+    root_id, a1, a2, b1, b2, b3 = chain
+
+    engine = sqlalchemy.create_engine(
+        flask_app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+    )
+
+    with flask_app.app_context(), engine.connect() as conn_a, engine.connect() as conn_b:
+        conn_c = engine.connect()
+        tree_a, tree_b, tree_c = Tree(conn_a), Tree(conn_b), Tree(conn_c)
+
+        with conn_b.begin():
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                with conn_a.begin():
+                    # Move a2 below b1, while b is waiting for the lock
+                    tree_a.lock_subtree([a2, b1])
+                    future = executor.submit(tree_b.lock_subtree, [a2])
+                    time.sleep(0.5)
+                    assert not future.done()
+                    tree_a.relocate_nodes([a2], b1)
+
+                assert future.result(10) == a2
+
+            # b holds no lock on the old path of a2
+            with conn_c.begin():
+                conn_c.execute("SET LOCAL lock_timeout = '100ms'")
+                assert tree_c.lock_subtree([a1]) == a1
+
+            # ...but on the new one
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                with conn_c.begin():
+                    conn_c.execute("SET LOCAL lock_timeout = '100ms'")
+                    tree_c.lock_subtree([b1])
+
+        conn_c.close()
+
+
+def test_disjoint_edits(flask_app, chain):
+    """
+    Modifications of disjoint branches (including their version bumps) do not block each other.
+    """
+    root_id, a1, a2, b1, b2, b3 = chain
+
+    engine = sqlalchemy.create_engine(
+        flask_app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+    )
+
+    with flask_app.app_context(), engine.connect() as conn_a, engine.connect() as conn_b:
+        tree_a, tree_b = Tree(conn_a), Tree(conn_b)
+        project_id = tree_a.get_node(root_id, require_valid=False)["project_id"]
+        version = tree_a.get_project_version(project_id)
+
+        with conn_a.begin():
+            tree_a.lock_subtree([a2])
+            tree_a.update_node(a2, {"starred": True})
+            tree_a.invalidate_nodes([a2])
+
+            # Fails with a lock timeout if b waits for a
+            with conn_b.begin():
+                conn_b.execute("SET LOCAL lock_timeout = '100ms'")
+                tree_b.lock_subtree([b2])
+                tree_b.update_node(b2, {"starred": True})
+                tree_b.invalidate_nodes([b2])
+
+        assert tree_a.get_project_version(project_id) != version
+
+
+def test_node_lock_key():
+    # Node keys are distinct and never collide with project keys
+    assert _node_lock_key(1) != _node_lock_key(1 + 2 ** 31)
+    assert _node_lock_key(1) > 2 ** 32
+    assert _node_lock_key(2 ** 48 - 1) < 2 ** 63
+
+    with pytest.raises(TreeError):
+        _node_lock_key(2 ** 48)
+
+
+def test_lock_subtree_throughput(flask_app):
+    """
+    Simulated annotators editing disjoint branches are not serialized.
+    """
+
+    n_annotators, n_edits, duration = 4, 5, 0.05
+
+    engine = sqlalchemy.create_engine(
+        flask_app.config["SQLALCHEMY_DATABASE_URI"], poolclass=NullPool
+    )
+
+    with flask_app.app_context(), engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+            branch_ids = [
+                tree.create_node(project_id, parent_id=root_id)
+                for _ in range(n_annotators)
+            ]
+
+    def annotate(lock, node_id):
+        with engine.connect() as connection:
+            tree = Tree(connection)
+
+            for _ in range(n_edits):
+                with connection.begin():
+                    lock(tree, node_id)
+                    connection.execute(
+                        sqlalchemy.select([sqlalchemy.func.pg_sleep(duration)])
+                    )
+                    tree.invalidate_nodes([node_id])
+
+    def run(lock):
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(n_annotators) as executor:
+            list(executor.map(lambda n: annotate(lock, n), branch_ids))
+        return time.perf_counter() - start
+
+    time_project = run(lambda tree, node_id: tree.lock_project_for_node(node_id))
+    time_subtree = run(lambda tree, node_id: tree.lock_subtree([node_id]))
+
+    print(
+        "{} annotators: {:.2f}s with project lock, {:.2f}s with subtree locks".format(
+            n_annotators, time_project, time_subtree
+        )
+    )
+
+    assert time_project >= n_annotators * n_edits * duration
+    assert time_subtree < time_project / 2
+
+
+def test_relocate_objects_src_node_ids(flask_app, chain):
+    root_id, a1, a2, b1, b2, b3 = chain
+
+    object_ids = ["test_{}".format(uuid.uuid4().hex) for _ in range(2)]
+
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            connection.execute(
+                objects.insert(), [{"object_id": o, "path": o} for o in object_ids]
+            )
+            project_id = tree.get_node(root_id, require_valid=False)["project_id"]
+            connection.execute(
+                nodes_objects.insert(),
+                [
+                    {"node_id": a1, "project_id": project_id, "object_id": o}
+                    for o in object_ids
+                ],
+            )
+
+        # Objects of a1 are not taken if only the path of b3 is allowed
+        tree.relocate_objects(object_ids, b3, src_node_ids=tree.get_path_ids(b3)[:-1])
+        assert tree.get_n_objects(a1) == 2
+
+        tree.relocate_objects(object_ids[:1], a2, src_node_ids=tree.get_path_ids(a2)[:-1])
+        assert tree.get_n_objects(a1) == 1
+        assert tree.get_n_objects(a2) == 1
@@ -0,0 +1,34 @@
+"""
+pytest file for vector_store.VectorStore
+"""
+
+import numpy as np
+
+from morphocluster.vector_store import VectorStore, load_vector_store
+
+
+def test_vector_store(tmp_path):
+    path = str(tmp_path / "vectors")
+
+    assert load_vector_store(None) is None
+    assert load_vector_store(path) is None
+
+    object_ids = ["c", "a", "b"]
+    vectors = np.random.rand(3, 8)
+
+    VectorStore.save(path, object_ids, vectors)
+    store = load_vector_store(path)
+
+    assert len(store) == 3
+
+    rows = store.lookup(["b", "x", "c", "a"])
+    np.testing.assert_array_equal(rows, [2, -1, 0, 1])
+    np.testing.assert_allclose(
+        store.vectors[rows[[0, 2, 3]]], vectors[[2, 0, 1]], rtol=1e-6
+    )
+
+    # Rewriting replaces the store
+    VectorStore.save(path, ["d"], np.random.rand(1, 8))
+    store = VectorStore.load(path)
+
+    np.testing.assert_array_equal(store.lookup(["a", "d"]), [-1, 0])
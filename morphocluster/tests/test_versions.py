@@ -0,0 +1,159 @@
+"""
+pytest file for the node and project versions (Tree.bump_versions)
+"""
+
+import uuid
+
+import numpy as np
+from requests.auth import _basic_auth_str
+
+from morphocluster.extensions import database
+from morphocluster.models import nodes_objects, objects
+from morphocluster.tree import Tree
+
+
+def test_bump_versions(flask_app):
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+            child_id = tree.create_node(project_id, parent_id=root_id)
+            sibling_id = tree.create_node(project_id, parent_id=root_id)
+
+        def versions():
+            return [
+                tree.get_node(n, require_valid=False)["version"]
+                for n in (root_id, child_id, sibling_id)
+            ] + [tree.get_project_version(project_id)]
+
+        before = versions()
+
+        with connection.begin():
+            tree.update_node(child_id, {"starred": True})
+
+        after = versions()
+
+        # Only the child is bumped, but the project version changes
+        assert after[0] == before[0]
+        assert after[1] > before[1]
+        assert after[2] == before[2]
+        assert after[3] != before[3]
+
+        # A later modification gets a larger version
+        with connection.begin():
+            tree.update_node(sibling_id, {"starred": True})
+
+        assert versions()[2] > after[1]
+
+
+def test_create_node_version(flask_app):
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+
+        before = tree.get_project_version(project_id)
+
+        with connection.begin():
+            child_id = tree.create_node(project_id, parent_id=root_id)
+
+        # The new node is versioned without an explicit bump_versions
+        assert tree.get_node(child_id, require_valid=False)["version"] > 0
+        assert tree.get_project_version(project_id) != before
+
+
+def test_etag(flask_app, flask_client):
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+
+        tree.consolidate_node(root_id)
+
+    headers = {"Authorization": _basic_auth_str("test_user", "test_user")}
+
+    response = flask_client.get("/api/nodes/{}".format(root_id), headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    headers["If-None-Match"] = etag
+    response = flask_client.get("/api/nodes/{}".format(root_id), headers=headers)
+    assert response.status_code == 304
+
+    response = flask_client.patch(
+        "/api/nodes/{}".format(root_id), json={"starred": True}, headers=headers
+    )
+    assert response.status_code == 200
+
+    response = flask_client.get("/api/nodes/{}".format(root_id), headers=headers)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_members_version_path(flask_app):
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+            a = tree.create_node(project_id, parent_id=root_id)
+            b = tree.create_node(project_id, parent_id=root_id)
+            child_id = tree.create_node(project_id, parent_id=b)
+
+        tree.consolidate_node(root_id, depth="full")
+        before = tree.get_members_version(child_id)
+
+        # Moving an ancestor changes the paths of the members
+        tree.relocate_nodes([b], a)
+        tree.consolidate_node(root_id, depth="full")
+
+        assert tree.get_members_version(child_id) != before
+
+
+def test_recommendation_version(flask_app):
+    with flask_app.app_context(), database.engine.connect() as connection:
+        tree = Tree(connection)
+
+        object_ids = ["test_{}".format(uuid.uuid4().hex) for _ in range(30)]
+
+        with connection.begin():
+            project_id = tree.create_project("test_{}".format(uuid.uuid4().hex))
+            root_id = tree.create_node(project_id)
+            a = tree.create_node(project_id, parent_id=root_id)
+            a_child = tree.create_node(project_id, parent_id=a)
+            b = tree.create_node(project_id, parent_id=root_id)
+
+            connection.execute(
+                objects.insert(),
+                [
+                    {"object_id": o, "path": o, "vector": np.random.rand(8)}
+                    for o in object_ids
+                ],
+            )
+            connection.execute(
+                nodes_objects.insert(),
+                [
+                    {"node_id": n, "project_id": project_id, "object_id": o}
+                    for n, o in zip([root_id, a, a_child, b] * 10, object_ids)
+                ],
+            )
+
+        tree.consolidate_node(root_id, depth="full")
+        before = tree.get_recommendation_version(b)
+        assert before is not None
+
+        # Modifications in another branch do not change the recommendations of b
+        tree.update_node(a, {"starred": True})
+        tree.relocate_objects(object_ids[1:2], a_child)
+        assert tree.get_recommendation_version(b) == before
+
+        # Relocating objects of an ancestor does
+        tree.relocate_objects(object_ids[:1], a)
+        assert tree.get_recommendation_version(b) != before